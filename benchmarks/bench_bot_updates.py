@@ -0,0 +1,118 @@
+"""
+Пропускная способность обработки обновлений бота против поддельного Bot API:
+последовательная обработка (как Application без concurrent_updates) против
+PerUserUpdateProcessor. Обработчик держит соединение «БД» DB_LATENCY секунд
+и затем отвечает через Bot API с задержкой API_LATENCY. Второй сценарий –
+один игрок шлёт поток обновлений, остальные по одному: задержка остальных
+с ограничением очереди на пользователя и без него.
+"""
+import asyncio
+import statistics
+import time
+
+from common import bot, table
+
+DB_LATENCY = 0.002
+API_LATENCY = 0.010
+USERS = 100
+UPDATES_PER_USER = 3
+SPAM_UPDATES = 400
+
+
+class FakeUser:
+    def __init__(self, uid: int):
+        self.id = uid
+
+
+def make_update(update_id: int, uid: int, api):
+    try:
+        from telegram import CallbackQuery, User
+    except ImportError:  # заменитель из tests/fake_deps.py
+        return bot.Update(update_id, effective_user=FakeUser(uid))
+    query = CallbackQuery(str(update_id), User(uid, 'miner', False), 'bench')
+    query.set_bot(api)  # отброшенным нажатиям процессор отвечает через Bot API
+    return bot.Update(update_id, callback_query=query)
+
+
+class FakeBotAPI:
+    """answerCallbackQuery с сетевой задержкой и счётчиком вызовов."""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def answer_callback_query(self, query_id: str, text: str = None, **kwargs):
+        await asyncio.sleep(API_LATENCY)
+        self.calls += 1
+
+
+class Run:
+    def __init__(self):
+        self.api = FakeBotAPI()
+        self.pool = asyncio.Semaphore(bot.BOT_CONCURRENT_UPDATES)
+        self.latency = {}
+
+    async def handle(self, update_id: int, submitted: float):
+        async with self.pool:
+            await asyncio.sleep(DB_LATENCY)
+        await self.api.answer_callback_query(str(update_id))
+        self.latency[update_id] = time.perf_counter() - submitted
+
+
+async def sequential(updates):
+    run = Run()
+    for update_id, _ in updates:
+        await run.handle(update_id, time.perf_counter())
+    return run
+
+
+async def concurrent(updates, processor):
+    run = Run()
+    tasks = [asyncio.create_task(processor.process_update(make_update(update_id, uid, run.api),
+                                                          run.handle(update_id, time.perf_counter())))
+             for update_id, uid in updates]
+    await asyncio.gather(*tasks)
+    return run
+
+
+def uniform_updates():
+    return [(i * USERS + uid, uid) for i in range(UPDATES_PER_USER) for uid in range(USERS)]
+
+
+def throughput():
+    updates = uniform_updates()
+    rows = []
+    for name, factory in (
+            ('sequential', lambda: sequential(updates)),
+            ('per-user', lambda: concurrent(updates, bot.PerUserUpdateProcessor(
+                bot.BOT_CONCURRENT_UPDATES, bot.BOT_PENDING_UPDATES)))):
+        started = time.perf_counter()
+        run = asyncio.run(factory())
+        elapsed = time.perf_counter() - started
+        rows.append((name, len(updates), run.api.calls, f"{elapsed:.2f}", f"{run.api.calls / elapsed:.0f}"))
+    table(('processor', 'updates', 'answered', 'время, с', 'обновлений/с'), rows)
+
+
+def spam():
+    spammer = -1
+    updates = [(i, spammer) for i in range(SPAM_UPDATES)]
+    updates += [(SPAM_UPDATES + uid, uid) for uid in range(USERS)]
+    others = {update_id for update_id, uid in updates if uid != spammer}
+    rows = []
+    for name, per_user in (('без ограничения', 10 ** 9), (f'не больше {bot.BOT_USER_PENDING_UPDATES}',
+                                                          bot.BOT_USER_PENDING_UPDATES)):
+        processor = bot.PerUserUpdateProcessor(bot.BOT_CONCURRENT_UPDATES, bot.BOT_PENDING_UPDATES, per_user)
+        run = asyncio.run(concurrent(updates, processor))
+        latency = sorted(run.latency[u] for u in others)
+        rows.append((name, processor.dropped, f"{statistics.median(latency) * 1000:.0f}",
+                     f"{latency[-1] * 1000:.0f}"))
+    table(('очередь игрока', 'отброшено', 'медиана остальных, мс', 'максимум, мс'), rows)
+
+
+def main():
+    throughput()
+    print()
+    spam()
+
+
+if __name__ == '__main__':
+    main()
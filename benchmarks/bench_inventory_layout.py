@@ -0,0 +1,159 @@
+"""
+INVENTORY_LAYOUT=rows против compact на настоящем PostgreSQL: на клик –
+запросов (без BEGIN/COMMIT), версий строк, записанных в players и inventory,
+байт WAL и время; на игрока – размер таблиц после VACUUM FULL.
+
+Раскладка выбирается при импорте bot.py, поэтому каждая меряется в своём
+процессе. BENCH_DATABASE_URL – сервер, на котором можно создать и удалить
+временную базу, например postgresql://postgres@localhost/postgres.
+"""
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+
+from common import bot, table
+
+BENCH_DATABASE_URL = os.environ.get('BENCH_DATABASE_URL')
+LAYOUTS = ('rows', 'compact')
+PLAYERS = 2000
+CLICKS = 5000
+TABLES = ('players', 'inventory')
+
+
+class CountingConnection:
+    """Соединение asyncpg, считающее выполненные запросы."""
+
+    def __init__(self, conn, counter):
+        self._conn = conn
+        self._counter = counter
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    async def _count(self, method, *args, **kwargs):
+        self._counter[0] += 1
+        return await getattr(self._conn, method)(*args, **kwargs)
+
+    async def execute(self, *args, **kwargs):
+        return await self._count('execute', *args, **kwargs)
+
+    async def executemany(self, *args, **kwargs):
+        return await self._count('executemany', *args, **kwargs)
+
+    async def fetch(self, *args, **kwargs):
+        return await self._count('fetch', *args, **kwargs)
+
+    async def fetchrow(self, *args, **kwargs):
+        return await self._count('fetchrow', *args, **kwargs)
+
+    async def fetchval(self, *args, **kwargs):
+        return await self._count('fetchval', *args, **kwargs)
+
+
+class CountingPool:
+    """Пул из одного соединения; подготовленные выражения не используются, чтобы все запросы шли через счётчик."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.counter = [0]
+
+    async def acquire(self, timeout=None):
+        return CountingConnection(await self.pool.acquire(timeout=timeout), self.counter)
+
+    async def release(self, conn):
+        await self.pool.release(conn._conn)
+
+
+async def written_rows(conn) -> int:
+    await conn.execute("SELECT pg_stat_clear_snapshot()")
+    return await conn.fetchval(
+        "SELECT COALESCE(SUM(n_tup_ins + n_tup_upd), 0) FROM pg_stat_user_tables WHERE relname = ANY($1::text[])",
+        list(TABLES))
+
+
+async def flush_stats(conn):
+    """Счётчики pg_stat_user_tables обновляются с задержкой: просим сбросить и ждём."""
+    try:
+        await conn.execute("SELECT pg_stat_force_next_flush()")
+    except Exception:  # до PostgreSQL 15 функции нет, хватает ожидания
+        pass
+    await asyncio.sleep(1.5)
+
+
+async def measure(layout: str) -> dict:
+    import asyncpg
+
+    database = f"bot_layout_{uuid.uuid4().hex[:12]}"
+    admin = await asyncpg.connect(BENCH_DATABASE_URL)
+    await admin.execute(f'CREATE DATABASE "{database}"')
+    await admin.close()
+    pool = await asyncpg.create_pool(BENCH_DATABASE_URL, database=database, min_size=1, max_size=1)
+    try:
+        bot.db_pool = counting = CountingPool(pool)
+        await bot.init_db()
+        await bot.provision_players([(uid, f"p{uid}") for uid in range(1, PLAYERS + 1)])
+        # Первый клик каждого игрока – чтобы дальше мерить установившийся режим
+        for uid in range(1, PLAYERS + 1):
+            await bot.process_click(uid)
+
+        async with pool.acquire() as conn:
+            await flush_stats(conn)
+            rows_before = await written_rows(conn)
+            wal_before = await conn.fetchval("SELECT pg_current_wal_insert_lsn()")
+        rng = random.Random(1)
+        queries_before = counting.counter[0]
+        started = time.perf_counter()
+        for _ in range(CLICKS):
+            await bot.process_click(rng.randint(1, PLAYERS))
+        elapsed = time.perf_counter() - started
+        queries = counting.counter[0] - queries_before
+
+        async with pool.acquire() as conn:
+            wal = await conn.fetchval("SELECT pg_wal_lsn_diff(pg_current_wal_insert_lsn(), $1)", wal_before)
+            await flush_stats(conn)
+            rows = await written_rows(conn) - rows_before
+            await conn.execute(f"VACUUM FULL {', '.join(TABLES)}")
+            size = await conn.fetchval(
+                "SELECT SUM(pg_total_relation_size(t::regclass)) FROM unnest($1::text[]) t", list(TABLES))
+            inventory_rows = await conn.fetchval("SELECT COUNT(*) FROM inventory")
+    finally:
+        await pool.close()
+        admin = await asyncpg.connect(BENCH_DATABASE_URL)
+        await admin.execute(f'DROP DATABASE "{database}"')
+        await admin.close()
+    return {
+        'layout': layout,
+        'queries': queries / CLICKS,
+        'rows': rows / CLICKS,
+        'wal': float(wal) / CLICKS,
+        'us': elapsed / CLICKS * 1e6,
+        'bytes_per_player': int(size) / PLAYERS,
+        'inventory_rows': inventory_rows,
+    }
+
+
+def main():
+    if len(sys.argv) > 1:
+        print(json.dumps(asyncio.run(measure(sys.argv[1]))))
+        return
+    if not BENCH_DATABASE_URL:
+        print("Нужен PostgreSQL: задайте BENCH_DATABASE_URL")
+        return
+    rows = []
+    for layout in LAYOUTS:
+        out = subprocess.run([sys.executable, __file__, layout], check=True, capture_output=True, text=True,
+                             env={**os.environ, 'INVENTORY_LAYOUT': layout}).stdout
+        r = json.loads(out.strip().splitlines()[-1])
+        rows.append((r['layout'], f"{r['queries']:.2f}", f"{r['rows']:.2f}", f"{r['wal']:.0f}",
+                     f"{r['us']:.0f}", r['inventory_rows'], f"{r['bytes_per_player']:.0f}"))
+    table(('layout', 'запросов/клик', 'строк/клик', 'WAL, байт/клик', 'мкс/клик',
+           'строк inventory', 'байт/игрок'), rows)
+
+
+if __name__ == '__main__':
+    main()
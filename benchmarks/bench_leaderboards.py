@@ -0,0 +1,45 @@
+"""
+Обновление рейтинга (SortedBoard.set) и поиск места при разном числе игроков:
+SortedList из sortedcontainers против запасного BisectList.
+"""
+import random
+
+from common import best_of, bot, table
+
+PLAYER_COUNTS = (10_000, 100_000, 1_000_000)
+UPDATES = 20_000
+
+
+def measure(container, players: int):
+    bot.SortedKeys = container
+    rng = random.Random(players)
+    board = bot.SortedBoard()
+    board.load({uid: rng.randrange(10 ** 6) for uid in range(players)})
+    uids = [rng.randrange(players) for _ in range(UPDATES)]
+    it = iter(range(10 ** 9))
+
+    def update():
+        i = next(it)
+        uid = uids[i % UPDATES]
+        board.set(uid, board.scores[uid] + rng.randrange(1, 100))
+
+    def rank():
+        board.rank(uids[next(it) % UPDATES])
+
+    return best_of(update, UPDATES, 3), best_of(rank, UPDATES, 3)
+
+
+def main():
+    containers = [bot.BisectList] + ([bot.SortedList] if bot.SortedList is not None else [])
+    rows = []
+    for players in PLAYER_COUNTS:
+        for container in containers:
+            update, rank = measure(container, players)
+            rows.append((players, container.__name__, f"{update * 1e6:.2f}", f"{rank * 1e6:.2f}"))
+    table(('players', 'container', 'set, мкс', 'rank, мкс'), rows)
+    if bot.SortedList is None:
+        print("sortedcontainers не установлен – измерен только BisectList")
+
+
+if __name__ == '__main__':
+    main()
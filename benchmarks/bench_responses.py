@@ -0,0 +1,93 @@
+"""
+Кодирование ответов API на типичных телах каждого эндпоинта: время и размер
+для stdlib json (JSONResponse) и orjson (FastJSONResponse), затем сжатие
+gzip и brotli с теми же параметрами, что в CompressionMiddleware. Тела меньше
+COMPRESS_MIN_SIZE middleware отдаёт несжатыми – они помечены в столбце «сжатие».
+"""
+import gzip
+import random
+
+from common import best_of, bot, table
+
+NUMBER = 2000
+
+
+def inventory(rng):
+    return {rid: rng.randrange(5000) for rid in bot.RESOURCE_IDS}
+
+
+def leaderboard_entries(rng, count, start=0):
+    return [{'rank': start + i + 1, 'name': f"Шахтёр_{rng.randrange(10 ** 6)}",
+             'score': 10 ** 6 - i * 37, 'me': False} for i in range(count)]
+
+
+def payloads():
+    rng = random.Random(1)
+    outcome = bot.build_click_outcome([(5, 2, i % 7 == 0, 'coal' if i % 3 == 0 else None, 1) for i in range(10)])
+    stats = {'gold': 123456, 'exp': 321, 'level': 17}
+    return {
+        '/api/user': {
+            'id': 123456789, 'level': 17, 'exp': 321, 'gold': 123456, 'location': 'iron_mine',
+            'inventory': inventory(rng), 'upgrades': {up: rng.randrange(20) for up in bot.UPGRADE_IDS},
+            'active_tool': 'Железная кирка',
+            'boss_progress': {bid: {'current_health': rng.randrange(1000), 'defeated': False}
+                              for bid in bot.BOSS_LOCATIONS},
+        },
+        '/api/click': {'gold': 7, 'exp': 2, 'is_crit': False, 'found_resource': 'coal', 'amount': 1,
+                       'new_gold': 123456, 'new_exp': 321, 'inventory': inventory(rng)},
+        '/api/click/batch': {**bot.click_batch_result(outcome, stats, inventory(rng)), 'accepted': 10},
+        '/api/boss/attack': {'damage': 42, 'is_crit': True, 'defeated': False, 'current_health': 958,
+                             'max_health': 1000, 'new_gold': 123456, 'new_exp': 321,
+                             'inventory': inventory(rng), 'loot': {}},
+        '/api/craft/recipes': {'recipes': [
+            {**recipe, 'can_craft': False,
+             'resources_available': {res: rng.randrange(50) for res in recipe['resources']}}
+            for recipe in bot.CRAFT_RECIPES_PUBLIC]},
+        '/api/items': {'items': [
+            {'id': recipe['result_item_id'], 'name': recipe['name'], 'description': recipe['description'],
+             'quantity': rng.randrange(1, 10), 'type': recipe['result_type'],
+             'effect': recipe.get('effect'), 'duration': recipe.get('duration')}
+            for recipe in bot.CRAFT_RECIPES_PUBLIC]},
+        '/api/leaderboard (100)': {
+            'category': 'gold', 'entries': leaderboard_entries(rng, 100), 'next': '996337:42',
+            'me': {'rank': 512, 'score': 4242}, 'around': leaderboard_entries(rng, 11, 506),
+        },
+    }
+
+
+def encoders():
+    result = [('json', lambda p: bot.JSONResponse.render(None, p))]
+    if bot.orjson is not None:
+        result.append(('orjson', lambda p: bot.FastJSONResponse.render(None, p)))
+    return result
+
+
+def compressors():
+    result = [('gzip', lambda b: gzip.compress(b, compresslevel=6))]
+    if bot.brotli is not None:
+        result.append(('br', lambda b: bot.brotli.compress(b, quality=4)))
+    return result
+
+
+def main():
+    rows = []
+    for endpoint, payload in payloads().items():
+        row = [endpoint]
+        for _, encode in encoders():
+            row.append(f"{best_of(lambda: encode(payload), NUMBER) * 1e6:.1f}")
+        body = encoders()[-1][1](payload)
+        row += [len(body), 'да' if len(body) >= bot.COMPRESS_MIN_SIZE else 'нет']
+        for name, compress in compressors():
+            row += [len(compress(body)), f"{best_of(lambda: compress(body), NUMBER // 10) * 1e6:.1f}"]
+        rows.append(row)
+    header = ['endpoint'] + [f"{name}, мкс" for name, _ in encoders()] + ['байт', 'сжатие']
+    for name, _ in compressors():
+        header += [f"{name}, байт", f"{name}, мкс"]
+    table(header, rows)
+    missing = [name for name, module in (('orjson', bot.orjson), ('brotli', bot.brotli)) if module is None]
+    if missing:
+        print(f"Не установлены: {', '.join(missing)} – их столбцы пропущены")
+
+
+if __name__ == '__main__':
+    main()
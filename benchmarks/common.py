@@ -0,0 +1,37 @@
+"""
+Общее для бенчмарков: импорт bot.py из корня репозитория и замер времени.
+Пакеты из requirements.txt, которых нет в окружении, подменяются
+tests/fake_deps.py, как в тестах. Запуск: python benchmarks/bench_<имя>.py
+"""
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+import fake_deps  # noqa: E402
+
+fake_deps.install()
+os.environ.setdefault('BOT_TOKEN', 'bench-token')
+os.environ.setdefault('DATABASE_URL', 'postgresql://localhost/bench')
+
+import bot  # noqa: E402
+
+
+def best_of(func, number: int, repeat: int = 5) -> float:
+    """Лучшее из repeat время одного вызова func (в секундах) при number вызовах подряд."""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - started) / number)
+    return best
+
+
+def table(header, rows):
+    widths = [max(len(str(x)) for x in col) for col in zip(header, *rows)]
+    for row in [header] + rows:
+        print('  '.join(str(x).rjust(w) for x, w in zip(row, widths)))
@@ -12,31 +12,46 @@ import os
 import hashlib
 import hmac
 import json
+import gzip
+import sys
+import math
+import bisect
+import contextvars
+import functools
 from typing import Dict, Tuple, Optional, Any, List
 from contextlib import asynccontextmanager
 from urllib.parse import parse_qsl
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
-from telegram.error import BadRequest
+from telegram import Update, Message, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
 from telegram.helpers import escape_markdown
 from starlette.applications import Starlette
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, Response
 from starlette.routing import Route
 from starlette.requests import Request
 from starlette.middleware.cors import CORSMiddleware
+from starlette.datastructures import MutableHeaders
 import uvicorn
 import asyncpg
 import time
-from collections import defaultdict
-from typing import Dict, List
-
-# Хранилище для rate limiting: user_id -> list of timestamps
-request_history: Dict[int, List[float]] = defaultdict(list)
-
-# Лимиты: максимальное количество запросов в секунду
-CLICK_LIMIT = 5          # для обычных кликов
-BOSS_ATTACK_LIMIT = 3    # для атак на босса
+try:
+    import numpy as np
+except ImportError:  # без numpy пачки кликов разыгрываются поштучно
+    np = None
+try:
+    import orjson
+except ImportError:  # без orjson ответы API кодируются стандартным json
+    orjson = None
+try:
+    import brotli
+except ImportError:  # без brotli ответы сжимаются только gzip
+    brotli = None
+try:
+    from sortedcontainers import SortedList
+except ImportError:  # без sortedcontainers рейтинги – отсортированные list (обновление за O(n))
+    SortedList = None
+from collections import OrderedDict
 
 # ==================== КОНФИГУРАЦИЯ ====================
 
@@ -51,20 +66,108 @@ DATABASE_URL = os.environ.get('DATABASE_URL')
 if not DATABASE_URL:
     raise ValueError("No DATABASE_URL environment variable set")
 
+# Получение обновлений бота: 'polling' (локальный запуск) или 'webhook' –
+# Telegram шлёт обновления на /telegram/webhook/{WEBHOOK_SECRET} этого же приложения
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '').rstrip('/')  # внешний адрес приложения
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+if BOT_MODE not in ('polling', 'webhook'):
+    raise ValueError(f"Unknown BOT_MODE: {BOT_MODE}")
+if BOT_MODE == 'webhook' and not (WEBHOOK_URL and WEBHOOK_SECRET):
+    raise ValueError("BOT_MODE=webhook requires WEBHOOK_URL and WEBHOOK_SECRET")
+
+# Пул соединений с БД
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', 2))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 10))
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get('DB_STATEMENT_CACHE_SIZE', 1024))  # на соединение
+DB_ACQUIRE_TIMEOUT = float(os.environ.get('DB_ACQUIRE_TIMEOUT', 10))
+DB_COMMAND_TIMEOUT = float(os.environ.get('DB_COMMAND_TIMEOUT', 30))
+
+# Параллельная обработка обновлений бота: одновременно выполняется не больше
+# BOT_CONCURRENT_UPDATES, всего в работе и в очередях пользователей – не больше
+# BOT_PENDING_UPDATES, из них от одного пользователя – не больше
+# BOT_USER_PENDING_UPDATES (лишние отбрасываются с ответом «подождите»,
+# чтобы один игрок не занял все слоты). DB_POOL_RESERVED соединений пула остаются API Mini App
+# и фоновым задачам (сброс кликов, outbox), сколько бы обновлений ни шло.
+DB_POOL_RESERVED = int(os.environ.get('DB_POOL_RESERVED', 3))
+BOT_CONCURRENT_UPDATES = int(os.environ.get('BOT_CONCURRENT_UPDATES', max(1, DB_POOL_MAX_SIZE - DB_POOL_RESERVED)))
+BOT_PENDING_UPDATES = int(os.environ.get('BOT_PENDING_UPDATES', 256))
+BOT_USER_PENDING_UPDATES = int(os.environ.get('BOT_USER_PENDING_UPDATES', 8))
+if BOT_CONCURRENT_UPDATES >= DB_POOL_MAX_SIZE:
+    raise ValueError("BOT_CONCURRENT_UPDATES must be below DB_POOL_MAX_SIZE, otherwise bot updates can take the whole pool")
+
+# Уведомления игрокам пишутся в таблицу outbox в транзакции игрового действия
+# и отправляются фоновым диспетчером. Лимиты Telegram – около 30 сообщений
+# в секунду на бота и около одного в секунду на чат.
+OUTBOX_GLOBAL_RATE = float(os.environ.get('OUTBOX_GLOBAL_RATE', 25))
+OUTBOX_CHAT_RATE = float(os.environ.get('OUTBOX_CHAT_RATE', 1))
+OUTBOX_CHAT_BURST = float(os.environ.get('OUTBOX_CHAT_BURST', 3))
+OUTBOX_POLL_INTERVAL = float(os.environ.get('OUTBOX_POLL_INTERVAL', 1.0))
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 200))
+OUTBOX_LEASE_SECONDS = 300    # на столько забранные строки скрыты от других экземпляров
+OUTBOX_MAX_ATTEMPTS = 8       # после стольких неудачных отправок сообщение удаляется
+OUTBOX_BACKOFF_BASE = 5.0     # секунд до повтора, удваивается с каждой попыткой
+OUTBOX_BACKOFF_MAX = 3600.0
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+
+# Ответы API от этого размера (байт) сжимаются, если клиент это поддерживает
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+
+# Кэш проверенных initData Mini App
+INIT_DATA_CACHE_SIZE = int(os.environ.get('INIT_DATA_CACHE_SIZE', 10000))
+INIT_DATA_MAX_AGE = int(os.environ.get('INIT_DATA_MAX_AGE', 86400))  # секунд с auth_date
+
+# Лимиты: максимальное количество запросов в секунду
+CLICK_LIMIT = 5          # для обычных кликов
+BOSS_ATTACK_LIMIT = 3    # для атак на босса
+CLICK_BATCH_LIMIT = 4    # для пачек кликов из Mini App (клиент шлёт раз в ~500 мс)
+CLICK_BATCH_MAX_WINDOW = 5.0  # сколько секунд кликов можно накопить в одной пачке
+CRAFT_LIMIT = 2          # для крафта
+USE_ITEM_LIMIT = 2       # для использования предметов
+RATE_LIMIT_IDLE_TTL = 60.0  # через столько секунд простоя ведро пользователя удаляется
+
+# Сколько отрисованных динамических экранов (инвентарь, рынок) держать в памяти
+VIEW_CACHE_SIZE = int(os.environ.get('VIEW_CACHE_SIZE', 4096))
+
 # Игровые константы
 EXP_PER_LEVEL = 100
 BASE_CLICK_REWARD = (3, 9)
 BASE_EXP_REWARD = (1, 3)
 MAX_RESOURCE_AMOUNT = 2_000_000_000  # защита от переполнения BIGINT
+BOSS_RESPAWN_HOURS = 6  # длина эпохи боссов: в новой эпохе все боссы снова с полным здоровьем
+
+# Режим записи кликов: 'direct' – каждый клик отдельной транзакцией,
+# 'buffered' – клики копятся в памяти и пишутся в БД пачками
+# (при падении процесса теряется не больше одного окна сброса, а также
+# дельты игроков, которые к этому моменту не удалось записать)
+CLICK_WRITE_MODE = os.environ.get('CLICK_WRITE_MODE', 'direct')
+CLICK_FLUSH_INTERVAL_MS = int(os.environ.get('CLICK_FLUSH_INTERVAL_MS', 1000))
+CLICK_FLUSH_MAX_CLICKS = int(os.environ.get('CLICK_FLUSH_MAX_CLICKS', 500))
+CLICK_FLUSH_MAX_RETRIES = 5  # после стольких неудачных сбросов подряд клики игрока пишутся напрямую
+
+# Пачки от этого размера разыгрываются массивами numpy (если он установлен)
+CLICK_VECTOR_MIN = 16
+click_rng = np.random.default_rng() if np is not None else None
+
+# Хранение инвентаря: 'rows' – строка inventory на каждую пару (игрок, ресурс),
+# 'compact' – один массив players.resources по порядку RESOURCES.
+# При смене значения init_db переносит данные в новую раскладку.
+INVENTORY_LAYOUT = os.environ.get('INVENTORY_LAYOUT', 'rows')
+
+# Кэш состояния игроков в памяти процесса
+PLAYER_CACHE_SIZE = int(os.environ.get('PLAYER_CACHE_SIZE', 10000))
+PLAYER_CACHE_TTL = float(os.environ.get('PLAYER_CACHE_TTL', 60))
 
 # ==================== МОДЕЛИ ДАННЫХ ====================
 
 class Achievement:
-    def __init__(self, id, name, desc, cond_func, reward_gold=0, reward_exp=0):
+    """Достижение открывается, когда метрика игрока достигает порога."""
+    def __init__(self, id, name, desc, metric, threshold, reward_gold=0, reward_exp=0):
         self.id = id
         self.name = name
         self.description = desc
-        self.condition_func = cond_func
+        self.metric = metric
+        self.threshold = threshold
         self.reward_gold = reward_gold
         self.reward_exp = reward_exp
 
@@ -333,33 +436,33 @@ TOOLS = {
 
 # Задания (шаблоны)
 DAILY_TASK_TEMPLATES = [
-    {'name': 'Труженик', 'description': 'Совершить {} кликов', 'goal': (50, 80), 'reward_gold': 70, 'reward_exp': 20},
-    {'name': 'Золотоискатель', 'description': 'Заработать {} золота', 'goal': (100, 500), 'reward_gold': 100, 'reward_exp': 30},
-    {'name': 'Покупатель', 'description': 'Купить улучшений на {} золота', 'goal': (150, 300), 'reward_gold': 80, 'reward_exp': 25},
-    {'name': 'Везунчик', 'description': 'Получить {} критических ударов', 'goal': (3, 8), 'reward_gold': 70, 'reward_exp': 40},
-    {'name': 'Рудокоп', 'description': 'Добыть {} ресурсов', 'goal': (5, 15), 'reward_gold': 60, 'reward_exp': 35},
-    {'name': 'Продавец', 'description': 'Продать ресурсов на {} золота', 'goal': (200, 500), 'reward_gold': 90, 'reward_exp': 45},
-    {'name': 'Ударник труда', 'description': 'Совершить {} кликов', 'goal': (80, 120), 'reward_gold': 90, 'reward_exp': 30},
-    {'name': 'Золотая жила', 'description': 'Заработать {} золота', 'goal': (500, 1000), 'reward_gold': 150, 'reward_exp': 50},
-    {'name': 'Транжира', 'description': 'Купить улучшений на {} золота', 'goal': (300, 600), 'reward_gold': 120, 'reward_exp': 40},
-    {'name': 'Счастливчик', 'description': 'Получить {} критических ударов', 'goal': (8, 15), 'reward_gold': 100, 'reward_exp': 60},
-    {'name': 'Горняк', 'description': 'Добыть {} ресурсов', 'goal': (15, 30), 'reward_gold': 90, 'reward_exp': 45},
-    {'name': 'Торговый магнат', 'description': 'Продать ресурсов на {} золота', 'goal': (500, 1000), 'reward_gold': 150, 'reward_exp': 70},
+    {'name': 'Труженик', 'type': 'clicks', 'description': 'Совершить {} кликов', 'goal': (50, 80), 'reward_gold': 70, 'reward_exp': 20},
+    {'name': 'Золотоискатель', 'type': 'gold_earned', 'description': 'Заработать {} золота', 'goal': (100, 500), 'reward_gold': 100, 'reward_exp': 30},
+    {'name': 'Покупатель', 'type': 'spent', 'description': 'Купить улучшений на {} золота', 'goal': (150, 300), 'reward_gold': 80, 'reward_exp': 25},
+    {'name': 'Везунчик', 'type': 'crits', 'description': 'Получить {} критических ударов', 'goal': (3, 8), 'reward_gold': 70, 'reward_exp': 40},
+    {'name': 'Рудокоп', 'type': 'resources', 'description': 'Добыть {} ресурсов', 'goal': (5, 15), 'reward_gold': 60, 'reward_exp': 35},
+    {'name': 'Продавец', 'type': 'sold', 'description': 'Продать ресурсов на {} золота', 'goal': (200, 500), 'reward_gold': 90, 'reward_exp': 45},
+    {'name': 'Ударник труда', 'type': 'clicks', 'description': 'Совершить {} кликов', 'goal': (80, 120), 'reward_gold': 90, 'reward_exp': 30},
+    {'name': 'Золотая жила', 'type': 'gold_earned', 'description': 'Заработать {} золота', 'goal': (500, 1000), 'reward_gold': 150, 'reward_exp': 50},
+    {'name': 'Транжира', 'type': 'spent', 'description': 'Купить улучшений на {} золота', 'goal': (300, 600), 'reward_gold': 120, 'reward_exp': 40},
+    {'name': 'Счастливчик', 'type': 'crits', 'description': 'Получить {} критических ударов', 'goal': (8, 15), 'reward_gold': 100, 'reward_exp': 60},
+    {'name': 'Горняк', 'type': 'resources', 'description': 'Добыть {} ресурсов', 'goal': (15, 30), 'reward_gold': 90, 'reward_exp': 45},
+    {'name': 'Торговый магнат', 'type': 'sold', 'description': 'Продать ресурсов на {} золота', 'goal': (500, 1000), 'reward_gold': 150, 'reward_exp': 70},
 ]
 
 WEEKLY_TASK_TEMPLATES = [
-    {'name': 'Шахтёр-неделя', 'description': 'Совершить {} кликов', 'goal': (400, 800), 'reward_gold': 500, 'reward_exp': 200},
-    {'name': 'Золотая лихорадка', 'description': 'Заработать {} золота', 'goal': (2000, 5000), 'reward_gold': 1000, 'reward_exp': 500},
-    {'name': 'Магнат', 'description': 'Купить улучшений на {} золота', 'goal': (1500, 3000), 'reward_gold': 800, 'reward_exp': 400},
-    {'name': 'Критический удар', 'description': 'Получить {} критических ударов', 'goal': (20, 50), 'reward_gold': 600, 'reward_exp': 300},
-    {'name': 'Коллекционер', 'description': 'Добыть {} ресурсов', 'goal': (50, 150), 'reward_gold': 700, 'reward_exp': 350},
-    {'name': 'Торговец', 'description': 'Продать ресурсов на {} золота', 'goal': (2000, 5000), 'reward_gold': 900, 'reward_exp': 450},
-    {'name': 'Шахтёр-профи', 'description': 'Совершить {} кликов', 'goal': (800, 1300), 'reward_gold': 1000, 'reward_exp': 400},
-    {'name': 'Золотой дождь', 'description': 'Заработать {} золота', 'goal': (5000, 10000), 'reward_gold': 2000, 'reward_exp': 1000},
-    {'name': 'Олигарх', 'description': 'Купить улучшений на {} золота', 'goal': (3000, 6000), 'reward_gold': 1500, 'reward_exp': 800},
-    {'name': 'Крит-мастер', 'description': 'Получить {} критических ударов', 'goal': (50, 100), 'reward_gold': 1200, 'reward_exp': 600},
-    {'name': 'Скряга', 'description': 'Добыть {} ресурсов', 'goal': (150, 300), 'reward_gold': 1400, 'reward_exp': 700},
-    {'name': 'Биржевой игрок', 'description': 'Продать ресурсов на {} золота', 'goal': (5000, 10000), 'reward_gold': 1800, 'reward_exp': 900},
+    {'name': 'Шахтёр-неделя', 'type': 'clicks', 'description': 'Совершить {} кликов', 'goal': (400, 800), 'reward_gold': 500, 'reward_exp': 200},
+    {'name': 'Золотая лихорадка', 'type': 'gold_earned', 'description': 'Заработать {} золота', 'goal': (2000, 5000), 'reward_gold': 1000, 'reward_exp': 500},
+    {'name': 'Магнат', 'type': 'spent', 'description': 'Купить улучшений на {} золота', 'goal': (1500, 3000), 'reward_gold': 800, 'reward_exp': 400},
+    {'name': 'Критический удар', 'type': 'crits', 'description': 'Получить {} критических ударов', 'goal': (20, 50), 'reward_gold': 600, 'reward_exp': 300},
+    {'name': 'Коллекционер', 'type': 'resources', 'description': 'Добыть {} ресурсов', 'goal': (50, 150), 'reward_gold': 700, 'reward_exp': 350},
+    {'name': 'Торговец', 'type': 'sold', 'description': 'Продать ресурсов на {} золота', 'goal': (2000, 5000), 'reward_gold': 900, 'reward_exp': 450},
+    {'name': 'Шахтёр-профи', 'type': 'clicks', 'description': 'Совершить {} кликов', 'goal': (800, 1300), 'reward_gold': 1000, 'reward_exp': 400},
+    {'name': 'Золотой дождь', 'type': 'gold_earned', 'description': 'Заработать {} золота', 'goal': (5000, 10000), 'reward_gold': 2000, 'reward_exp': 1000},
+    {'name': 'Олигарх', 'type': 'spent', 'description': 'Купить улучшений на {} золота', 'goal': (3000, 6000), 'reward_gold': 1500, 'reward_exp': 800},
+    {'name': 'Крит-мастер', 'type': 'crits', 'description': 'Получить {} критических ударов', 'goal': (50, 100), 'reward_gold': 1200, 'reward_exp': 600},
+    {'name': 'Скряга', 'type': 'resources', 'description': 'Добыть {} ресурсов', 'goal': (150, 300), 'reward_gold': 1400, 'reward_exp': 700},
+    {'name': 'Биржевой игрок', 'type': 'sold', 'description': 'Продать ресурсов на {} золота', 'goal': (5000, 10000), 'reward_gold': 1800, 'reward_exp': 900},
 ]
 
 FAQ = [
@@ -374,93 +477,423 @@ FAQ = [
     {"question": "🔨 Что такое крафт?", "answer": "В разделе «Крафт» ты можешь создавать полезные предметы из ресурсов: зелья, ключи для повторного боя с боссами, модификаторы для инструментов и конвертировать ресурсы."},
 ]
 
-# ==================== УСЛОВИЯ ДОСТИЖЕНИЙ ====================
-
-def cond_first_click(uid, data): stats = data['stats']; return stats['clicks'] >= 1, stats['clicks'], 1
-def cond_clicks_100(uid, data): stats = data['stats']; return stats['clicks'] >= 100, stats['clicks'], 100
-def condition_clicks_300(uid, data): stats = data['stats']; return stats['clicks'] >= 300, stats['clicks'], 300
-def condition_clicks_500(uid, data): stats = data['stats']; return stats['clicks'] >= 500, stats['clicks'], 500
-def condition_clicks_1000(uid, data): stats = data['stats']; return stats['clicks'] >= 1000, stats['clicks'], 1000
-def cond_gold_1000(uid, data): stats = data['stats']; return stats['total_gold'] >= 1000, stats['total_gold'], 1000
-def condition_gold_1500(uid, data): stats = data['stats']; return stats['total_gold'] >= 1500, stats['total_gold'], 1500
-def condition_gold_5000(uid, data): stats = data['stats']; return stats['total_gold'] >= 5000, stats['total_gold'], 5000
-def condition_gold_20000(uid, data): stats = data['stats']; return stats['total_gold'] >= 20000, stats['total_gold'], 20000
-def cond_resources_50(uid, data): return data['inv_total'] >= 50, data['inv_total'], 50
-def condition_collector_all(uid, data):
-    inv = data['inv']
-    min_amount = min(inv.get(rid, 0) for rid in RESOURCES)
-    return min_amount >= 100, min_amount, 100
-def cond_crits_50(uid, data): stats = data['stats']; return stats['total_crits'] >= 50, stats['total_crits'], 50
-def condition_crit_master(uid, data): stats = data['stats']; return stats['total_crits'] >= 100, stats['total_crits'], 100
-def cond_crit_streak_5(uid, data): stats = data['stats']; return stats['max_crit_streak'] >= 5, stats['max_crit_streak'], 5
-def condition_smith(uid, data):
-    tools = data['tools']
-    max_level = max(tools.values()) if tools else 0
-    return max_level >= 5, max_level, 5
-def condition_tool_master(uid, data):
-    tools = data['tools']
-    all_tools = list(TOOLS.keys())
-    min_level = min(tools.get(tid, 0) for tid in all_tools)
-    return min_level >= 3, min_level, 3
-def condition_tools_all_purchased(uid, data):
-    tools = data['tools']
-    all_tools = list(TOOLS.keys())
-    purchased = [tid for tid in all_tools if tid in tools]
-    return len(purchased) == len(all_tools), len(purchased), len(all_tools)
-def condition_tools_all_level5(uid, data):
-    tools = data['tools']
-    all_tools = list(TOOLS.keys())
-    if len(tools) != len(all_tools):
-        return False, len(tools), len(all_tools)
-    for tid in all_tools:
-        if tools.get(tid, 0) < 5:
-            return False, tools.get(tid, 0), 5
-    return True, 5, 5
-def condition_tools_total_level_50(uid, data):
-    tools = data['tools']
-    total = sum(tools.values())
-    return total >= 50, total, 50
-def condition_tools_total_level_100(uid, data):
-    tools = data['tools']
-    total = sum(tools.values())
-    return total >= 100, total, 100
-def condition_hardworker(uid, data):
-    total = data['daily_completed'] + data['weekly_completed']
-    return total >= 50, total, 50
-def condition_explorer(uid, data):
-    stats = data['stats']
-    max_loc_level = max(loc['min_level'] for loc in LOCATIONS.values())
-    return stats['level'] >= max_loc_level, stats['level'], max_loc_level
+# ==================== МЕТРИКИ ДОСТИЖЕНИЙ ====================
+
+def metric_clicks(data): return data['stats']['clicks']
+def metric_total_gold(data): return data['stats']['total_gold']
+def metric_total_crits(data): return data['stats']['total_crits']
+def metric_max_crit_streak(data): return data['stats']['max_crit_streak']
+def metric_level(data): return data['stats']['level']
+def metric_inv_total(data): return data['inv_total']
+def metric_inv_min(data): return min(data['inv'].get(rid, 0) for rid in RESOURCES)
+def metric_tool_max_level(data): return max(data['tools'].values()) if data['tools'] else 0
+def metric_tools_min_level(data): return min(data['tools'].get(tid, 0) for tid in TOOLS)
+def metric_tools_owned(data): return sum(1 for tid in TOOLS if tid in data['tools'])
+def metric_tools_total_level(data): return sum(data['tools'].values())
+def metric_tasks_completed(data): return data['daily_completed'] + data['weekly_completed']
+
+ACHIEVEMENT_METRICS = {
+    'clicks': metric_clicks,
+    'total_gold': metric_total_gold,
+    'total_crits': metric_total_crits,
+    'max_crit_streak': metric_max_crit_streak,
+    'level': metric_level,
+    'inv_total': metric_inv_total,
+    'inv_min': metric_inv_min,
+    'tool_max_level': metric_tool_max_level,
+    'tools_min_level': metric_tools_min_level,
+    'tools_owned': metric_tools_owned,
+    'tools_total_level': metric_tools_total_level,
+    'tasks_completed': metric_tasks_completed,
+}
+
+# Метрики, которые может изменить клик (вместе с наградами за задания)
+CLICK_METRICS = ('clicks', 'total_gold', 'total_crits', 'max_crit_streak', 'level',
+                 'inv_total', 'inv_min', 'tasks_completed')
+TOOL_METRICS = ('tool_max_level', 'tools_min_level', 'tools_owned', 'tools_total_level')
 
 ACHIEVEMENTS = [
-    Achievement('first_click', 'Первые шаги', 'Сделать первый клик', cond_first_click, 10, 5),
-    Achievement('clicks_100', 'Начинающий шахтёр', 'Сделать 100 кликов', cond_clicks_100, 50, 20),
-    Achievement('clicks_300', 'Трудоголик', 'Сделать 300 кликов', condition_clicks_300, 80, 35),
-    Achievement('clicks_500', 'Опытный шахтёр', 'Сделать 500 кликов', condition_clicks_500, 120, 50),
-    Achievement('clicks_1000', 'Ветеран', 'Сделать 1000 кликов', condition_clicks_1000, 200, 100),
-    Achievement('gold_1000', 'Золотая жила', 'Добыть 1000 золота', cond_gold_1000, 100, 50),
-    Achievement('gold_1500', 'Золотая лихорадка', 'Добыть 1500 золота', condition_gold_1500, 150, 75),
-    Achievement('gold_5000', 'Золотой магнат', 'Добыть 5000 золота', condition_gold_5000, 300, 150),
-    Achievement('gold_20000', 'Король золота', 'Добыть 20000 золота', condition_gold_20000, 600, 300),
-    Achievement('resources_50', 'Коллекционер', 'Собрать 50 любых ресурсов', cond_resources_50, 70, 35),
-    Achievement('collector_all', 'Абсолютный коллекционер', 'Собрать не менее 100 каждого ресурса', condition_collector_all, 400, 200),
-    Achievement('crits_50', 'Критическая масса', 'Получить 50 критических ударов', cond_crits_50, 80, 30),
-    Achievement('crit_master', 'Критический удар', 'Получить 100 критических ударов', condition_crit_master, 250, 120),
-    Achievement('crit_streak_5', 'Везунчик', 'Достичь серии критов в 5', cond_crit_streak_5, 60, 25),
-    Achievement('smith', 'Кузнец', 'Улучшить любой инструмент до 5 уровня', condition_smith, 150, 50),
-    Achievement('tool_master', 'Мастер инструментов', 'Все инструменты минимум 3 уровня', condition_tool_master, 350, 180),
-    Achievement('tools_all_purchased', 'Коллекционер инструментов', 'Купить все виды кирок', condition_tools_all_purchased, 200, 100),
-    Achievement('tools_all_level5', 'Легендарный кузнец', 'Все инструменты 5 уровня', condition_tools_all_level5, 500, 250),
-    Achievement('tools_total_50', 'Сила инструментов I', 'Суммарный уровень инструментов 50', condition_tools_total_level_50, 150, 60),
-    Achievement('tools_total_100', 'Сила инструментов II', 'Суммарный уровень инструментов 100', condition_tools_total_level_100, 300, 150),
-    Achievement('hardworker', 'Трудяга', 'Выполнить 50 заданий', condition_hardworker, 200, 100),
-    Achievement('explorer', 'Исследователь', 'Достичь максимального уровня', condition_explorer, 300, 150),
+    Achievement('first_click', 'Первые шаги', 'Сделать первый клик', 'clicks', 1, 10, 5),
+    Achievement('clicks_100', 'Начинающий шахтёр', 'Сделать 100 кликов', 'clicks', 100, 50, 20),
+    Achievement('clicks_300', 'Трудоголик', 'Сделать 300 кликов', 'clicks', 300, 80, 35),
+    Achievement('clicks_500', 'Опытный шахтёр', 'Сделать 500 кликов', 'clicks', 500, 120, 50),
+    Achievement('clicks_1000', 'Ветеран', 'Сделать 1000 кликов', 'clicks', 1000, 200, 100),
+    Achievement('gold_1000', 'Золотая жила', 'Добыть 1000 золота', 'total_gold', 1000, 100, 50),
+    Achievement('gold_1500', 'Золотая лихорадка', 'Добыть 1500 золота', 'total_gold', 1500, 150, 75),
+    Achievement('gold_5000', 'Золотой магнат', 'Добыть 5000 золота', 'total_gold', 5000, 300, 150),
+    Achievement('gold_20000', 'Король золота', 'Добыть 20000 золота', 'total_gold', 20000, 600, 300),
+    Achievement('resources_50', 'Коллекционер', 'Собрать 50 любых ресурсов', 'inv_total', 50, 70, 35),
+    Achievement('collector_all', 'Абсолютный коллекционер', 'Собрать не менее 100 каждого ресурса', 'inv_min', 100, 400, 200),
+    Achievement('crits_50', 'Критическая масса', 'Получить 50 критических ударов', 'total_crits', 50, 80, 30),
+    Achievement('crit_master', 'Критический удар', 'Получить 100 критических ударов', 'total_crits', 100, 250, 120),
+    Achievement('crit_streak_5', 'Везунчик', 'Достичь серии критов в 5', 'max_crit_streak', 5, 60, 25),
+    Achievement('smith', 'Кузнец', 'Улучшить любой инструмент до 5 уровня', 'tool_max_level', 5, 150, 50),
+    Achievement('tool_master', 'Мастер инструментов', 'Все инструменты минимум 3 уровня', 'tools_min_level', 3, 350, 180),
+    Achievement('tools_all_purchased', 'Коллекционер инструментов', 'Купить все виды кирок', 'tools_owned', len(TOOLS), 200, 100),
+    Achievement('tools_all_level5', 'Легендарный кузнец', 'Все инструменты 5 уровня', 'tools_min_level', 5, 500, 250),
+    Achievement('tools_total_50', 'Сила инструментов I', 'Суммарный уровень инструментов 50', 'tools_total_level', 50, 150, 60),
+    Achievement('tools_total_100', 'Сила инструментов II', 'Суммарный уровень инструментов 100', 'tools_total_level', 100, 300, 150),
+    Achievement('hardworker', 'Трудяга', 'Выполнить 50 заданий', 'tasks_completed', 50, 200, 100),
+    Achievement('explorer', 'Исследователь', 'Достичь максимального уровня', 'level', max(loc['min_level'] for loc in LOCATIONS.values()), 300, 150),
 ]
 
+class AchievementIndex:
+    """
+    Пороговый индекс достижений. Открытые достижения игрока хранятся
+    битовой маской (бит — позиция в ACHIEVEMENTS). Для каждой метрики
+    пороги отсортированы, а prefix[k] — маска первых k достижений, поэтому
+    «что открылось при таком значении» — это bisect и одна битовая операция.
+    """
+
+    def __init__(self, achievements: List[Achievement]):
+        self.achievements = achievements
+        self.bits = {ach.id: 1 << i for i, ach in enumerate(achievements)}
+        self.metrics: Dict[str, Tuple[List[int], List[int]]] = {}
+        for metric in ACHIEVEMENT_METRICS:
+            achs = sorted((a for a in achievements if a.metric == metric), key=lambda a: a.threshold)
+            prefix = [0]
+            for a in achs:
+                prefix.append(prefix[-1] | self.bits[a.id])
+            self.metrics[metric] = ([a.threshold for a in achs], prefix)
+
+    def mask(self, ids) -> int:
+        mask = 0
+        for aid in ids:
+            mask |= self.bits.get(aid, 0)
+        return mask
+
+    def pending(self, mask: int, metrics=None) -> List[str]:
+        """Метрики, у которых остались неоткрытые достижения."""
+        return [m for m in (metrics or self.metrics) if self.metrics[m][1][-1] & ~mask]
+
+    def crossed(self, metric: str, value: int, mask: int) -> int:
+        """Маска неоткрытых достижений метрики, порог которых уже достигнут."""
+        thresholds, prefix = self.metrics[metric]
+        return prefix[bisect.bisect_right(thresholds, value)] & ~mask
+
+    def unpack(self, mask: int) -> List[Achievement]:
+        return [ach for ach in self.achievements if mask & self.bits[ach.id]]
+
+ACHIEVEMENT_INDEX = AchievementIndex(ACHIEVEMENTS)
+
+# ==================== ОГРАНИЧЕНИЕ ЧАСТОТЫ ЗАПРОСОВ ====================
+
+class TokenBucket:
+    __slots__ = ('tokens', 'last')
+
+    def __init__(self, tokens: float, last: float):
+        self.tokens = tokens
+        self.last = last
+
+class RateLimiter:
+    """
+    Token bucket на пользователя: rate токенов в секунду, не больше burst.
+    Вёдра лежат в OrderedDict в порядке последнего обращения, поэтому
+    простаивающие дольше idle_ttl удаляются с головы за O(1) на запрос.
+    Удалённое ведро к этому моменту всё равно было бы полным.
+    """
+
+    def __init__(self, rate: float, burst: float = None, idle_ttl: float = RATE_LIMIT_IDLE_TTL):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.idle_ttl = max(idle_ttl, self.burst / rate)
+        self.buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+
+    def take(self, uid: int, n: int = 1, now: float = None) -> int:
+        """Списывает до n токенов и возвращает, сколько удалось списать."""
+        if now is None:
+            now = time.monotonic()
+        bucket = self.buckets.get(uid)
+        if bucket is None:
+            bucket = self.buckets[uid] = TokenBucket(self.burst, now)
+        else:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.last) * self.rate)
+            bucket.last = now
+            self.buckets.move_to_end(uid)
+        granted = min(n, int(bucket.tokens))
+        bucket.tokens -= granted
+        self._evict(now)
+        return granted
+
+    def allow(self, uid: int, now: float = None) -> bool:
+        return self.take(uid, 1, now) == 1
+
+    def give_back(self, uid: int, n: int = 1):
+        """Возвращает списанные, но не использованные токены."""
+        bucket = self.buckets.get(uid)
+        if bucket is not None:
+            bucket.tokens = min(self.burst, bucket.tokens + n)
+
+    def _evict(self, now: float):
+        buckets = self.buckets
+        while buckets:
+            uid, bucket = next(iter(buckets.items()))
+            if now - bucket.last < self.idle_ttl:
+                break
+            del buckets[uid]
+
+    def memory_usage(self) -> int:
+        """Примерный объём памяти в байтах: словарь, ключи и вёдра."""
+        if not self.buckets:
+            return sys.getsizeof(self.buckets)
+        bucket = next(iter(self.buckets.values()))
+        per_item = sys.getsizeof(bucket) + sys.getsizeof(bucket.tokens) + sys.getsizeof(bucket.last) + 28
+        return sys.getsizeof(self.buckets) + len(self.buckets) * per_item
+
+# Лимитеры по эндпоинтам (для отчёта о памяти в /healthcheck)
+rate_limiters: Dict[str, RateLimiter] = {}
+
+# Клики из пачек: CLICK_LIMIT в секунду, накопить можно CLICK_BATCH_MAX_WINDOW секунд
+click_tokens = RateLimiter(CLICK_LIMIT, CLICK_LIMIT * CLICK_BATCH_MAX_WINDOW)
+rate_limiters['click_tokens'] = click_tokens
+
 # ==================== ГЛОБАЛЬНЫЙ ПУЛ БД ====================
 
 db_pool: Optional[asyncpg.Pool] = None
 
+class QueryRegistry:
+    """
+    Именованные запросы горячего пути. На каждом соединении пула они
+    заранее готовятся (init пула и прогрев при старте), так что первый
+    клик после открытия соединения не платит за разбор и планирование.
+    Подготовленные выражения хранятся по PID серверного процесса и
+    удаляются, когда соединение закрывается. По каждому запросу копятся
+    число и время подготовок и выполнений.
+    """
+
+    def __init__(self):
+        self.sql: Dict[str, str] = {}
+        # name -> [подготовок, сек на подготовку, вызовов, сек на выполнение]
+        self.stats: Dict[str, List[float]] = {}
+        self.prepared: Dict[int, Dict[str, Any]] = {}
+        self.ready = False  # схема создана – можно готовить
+
+    def register(self, name: str, sql: str) -> str:
+        self.sql[name] = sql
+        self.stats[name] = [0, 0.0, 0, 0.0]
+        return sql
+
+    async def prepare_all(self, conn):
+        """Готовит все запросы на соединении (используется как init пула)."""
+        if not self.ready:
+            return
+        pid = conn.get_server_pid()
+        if pid in self.prepared:
+            return
+        statements = {}
+        for name, sql in self.sql.items():
+            started = time.perf_counter()
+            try:
+                statements[name] = await conn.prepare(sql)
+            except asyncpg.PostgresError as e:
+                logger.warning(f"Prepare {name} failed: {e}")
+                continue
+            st = self.stats[name]
+            st[0] += 1
+            st[1] += time.perf_counter() - started
+        self.prepared[pid] = statements
+        conn.add_termination_listener(lambda c, pid=pid: self.prepared.pop(pid, None))
+
+    async def _run(self, method: str, conn, name: str, args):
+        stmt = self.prepared.get(conn.get_server_pid(), {}).get(name)
+        started = time.perf_counter()
+        try:
+            if stmt is not None:
+                return await getattr(stmt, method)(*args)
+            return await getattr(conn, method)(self.sql[name], *args)
+        finally:
+            st = self.stats[name]
+            st[2] += 1
+            st[3] += time.perf_counter() - started
+
+    async def fetch(self, conn, name: str, *args):
+        return await self._run('fetch', conn, name, args)
+
+    async def fetchrow(self, conn, name: str, *args):
+        return await self._run('fetchrow', conn, name, args)
+
+    async def fetchval(self, conn, name: str, *args):
+        return await self._run('fetchval', conn, name, args)
+
+    def report(self) -> dict:
+        return {
+            name: {
+                'prepares': int(st[0]),
+                'prepare_ms': round(st[1] * 1000, 2),
+                'calls': int(st[2]),
+                'avg_ms': round(st[3] * 1000 / st[2], 3) if st[2] else 0.0,
+            }
+            for name, st in self.stats.items()
+        }
+
+queries = QueryRegistry()
+
+async def warm_pool():
+    """Готовит запросы на min_size соединениях пула сразу после init_db."""
+    queries.ready = True
+    conns = [await db_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) for _ in range(db_pool.get_min_size())]
+    try:
+        await asyncio.gather(*(queries.prepare_all(c) for c in conns))
+    finally:
+        for c in conns:
+            await db_pool.release(c)
+
+# Ожидание свободного соединения в пуле
+pool_wait = {'acquires': 0, 'timeouts': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+
+async def pool_acquire():
+    started = time.perf_counter()
+    try:
+        conn = await db_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        pool_wait['timeouts'] += 1
+        raise
+    waited = time.perf_counter() - started
+    pool_wait['acquires'] += 1
+    pool_wait['wait_total'] += waited
+    pool_wait['wait_max'] = max(pool_wait['wait_max'], waited)
+    return conn
+
+class RequestConnection:
+    """
+    Одно соединение на обновление бота или запрос API. Берётся из пула при
+    первом обращении к БД и возвращается в конце запроса или перед ответом
+    в Telegram (release_request_connection); используется только задачей,
+    открывшей запрос (задачи из create_task наследуют контекст, но не
+    должны работать с тем же соединением параллельно).
+    Вложенные транзакции на общем соединении – это savepoint'ы, поэтому
+    инвалидации player_cache внутри блока acquire_conn() откладываются
+    до выхода из самого внешнего блока, когда все транзакции уже закрыты.
+    """
+    __slots__ = ('task', 'conn', 'depth', 'deferred')
+
+    def __init__(self):
+        self.task = asyncio.current_task()
+        self.conn = None
+        self.depth = 0       # вложенность открытых блоков acquire_conn()
+        self.deferred = set()  # user_id, чьи инвалидации ждут конца блока
+
+    def run_deferred(self):
+        uids, self.deferred = self.deferred, set()
+        for uid in uids:
+            player_cache.invalidate(uid)
+
+request_scope: contextvars.ContextVar[Optional[RequestConnection]] = contextvars.ContextVar('request_scope', default=None)
+
+def current_scope() -> Optional[RequestConnection]:
+    """Область запроса, если её открыла текущая задача."""
+    scope = request_scope.get()
+    if scope is not None and scope.task is asyncio.current_task():
+        return scope
+    return None
+
+@asynccontextmanager
+async def acquire_conn():
+    """Соединение текущего запроса, а вне запроса – отдельное из пула."""
+    scope = current_scope()
+    if scope is not None:
+        if scope.conn is None:
+            scope.conn = await pool_acquire()
+        scope.depth += 1
+        try:
+            yield scope.conn
+        finally:
+            scope.depth -= 1
+            if scope.depth == 0:
+                scope.run_deferred()
+        return
+    conn = await pool_acquire()
+    try:
+        yield conn
+    finally:
+        await db_pool.release(conn)
+
+async def release_request_connection():
+    """
+    Возвращает соединение запроса в пул перед сетевым вводом-выводом, чтобы
+    оно не простаивало, пока идёт запрос к Telegram. Следующее обращение
+    к БД в этом запросе возьмёт соединение заново.
+    """
+    scope = current_scope()
+    if scope is not None and scope.depth == 0 and scope.conn is not None:
+        conn, scope.conn = scope.conn, None
+        await db_pool.release(conn)
+
+# Колбэки, ждущие фиксации транзакции: id(conn) -> список по уровням вложенности
+commit_callbacks: Dict[int, List[list]] = {}
+
+@asynccontextmanager
+async def transaction(conn: asyncpg.Connection):
+    """
+    conn.transaction(), после фиксации самой внешней транзакции выполняющий
+    колбэки after_commit(). Откат (в том числе savepoint'а) отбрасывает
+    колбэки, зарегистрированные внутри откатившегося блока.
+    """
+    levels = commit_callbacks.setdefault(id(conn), [])
+    levels.append([])
+    try:
+        async with conn.transaction():
+            yield
+    except BaseException:
+        levels.pop()
+        if not levels:
+            del commit_callbacks[id(conn)]
+        raise
+    callbacks = levels.pop()
+    if levels:
+        levels[-1].extend(callbacks)  # savepoint отпущен – ждём внешнюю транзакцию
+        return
+    del commit_callbacks[id(conn)]
+    for callback in callbacks:
+        callback()
+
+def after_commit(conn: asyncpg.Connection, callback):
+    """Выполняет callback после фиксации открытой на conn транзакции, а вне транзакции – сразу."""
+    levels = commit_callbacks.get(id(conn))
+    if levels:
+        levels[-1].append(callback)
+    else:
+        callback()
+
+@asynccontextmanager
+async def request_connection():
+    """Открывает область запроса: все помощники внутри делят одно соединение."""
+    if current_scope() is not None:
+        yield
+        return
+    scope = RequestConnection()
+    token = request_scope.set(scope)
+    try:
+        yield
+    finally:
+        request_scope.reset(token)
+        if scope.conn is not None:
+            await db_pool.release(scope.conn)
+
+def request_scoped(func):
+    """Обработчик бота, выполняемый в request_connection()."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        async with request_connection():
+            return await func(*args, **kwargs)
+    return wrapper
+
+def pool_stats() -> dict:
+    if db_pool is None:
+        return {}
+    acquires = pool_wait['acquires']
+    return {
+        'size': db_pool.get_size(),
+        'idle': db_pool.get_idle_size(),
+        'min': db_pool.get_min_size(),
+        'max': db_pool.get_max_size(),
+        'prepared_connections': len(queries.prepared),
+        'acquires': acquires,
+        'acquire_timeouts': pool_wait['timeouts'],
+        'wait_avg_ms': round(pool_wait['wait_total'] * 1000 / acquires, 3) if acquires else 0.0,
+        'wait_max_ms': round(pool_wait['wait_max'] * 1000, 3),
+    }
+
 # ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
 
 def get_week_number(d=None):
@@ -494,184 +927,997 @@ def get_click_reward(stats: dict) -> Tuple[int, int, bool]:
     return gold, be, is_crit
 
 async def reply_or_edit(update_or_query, text: str, reply_markup=None, parse_mode=None):
+    await release_request_connection()
     if isinstance(update_or_query, Update):
-        await update_or_query.message.reply_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+        return await update_or_query.message.reply_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
     else:
         try:
-            await update_or_query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+            return await update_or_query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
         except BadRequest as e:
             if "Message is not modified" not in str(e):
                 raise
 
+async def answer_query(query, text: str = None, show_alert: bool = False):
+    """query.answer(), сначала вернувший соединение запроса в пул."""
+    await release_request_connection()
+    return await query.answer(text, show_alert=show_alert)
+
+async def send_text(update_or_query, text: str, parse_mode=None):
+    """Новое сообщение в чат update_or_query, сначала вернувшее соединение запроса в пул."""
+    await release_request_connection()
+    return await update_or_query.message.reply_text(text, parse_mode=parse_mode)
+
+class RenderedView:
+    __slots__ = ('text', 'markup', 'plain')
+
+    def __init__(self, text: str, rows):
+        self.text = text
+        self.markup = InlineKeyboardMarkup(rows)
+        self.plain: Optional[str] = None  # текст, каким его вернул Telegram (без разметки)
+
+class ViewCache:
+    """
+    Экраны бота. Статические собираются один раз при импорте, динамические –
+    функцией build(state) -> (текст, ряды кнопок) и кэшируются (LRU) по
+    (экран, state), где state – кортеж всего, от чего экран зависит. Если
+    сообщение под нажатой кнопкой уже показывает этот экран, повторный
+    edit_message_text не отправляется.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.static: Dict[str, RenderedView] = {}
+        self.builders: Dict[str, Any] = {}
+        self.rendered: "OrderedDict[tuple, RenderedView]" = OrderedDict()
+        self.counters = {'hits': 0, 'misses': 0, 'skipped_edits': 0}
+
+    def add_static(self, name: str, text: str, rows):
+        self.static[name] = RenderedView(text, rows)
+
+    def add(self, name: str):
+        """Декоратор для функции build(state) динамического экрана."""
+        def register(build):
+            self.builders[name] = build
+            return build
+        return register
+
+    def render(self, name: str, state: tuple = ()) -> RenderedView:
+        view = self.static.get(name)
+        if view is not None:
+            self.counters['hits'] += 1
+            return view
+        key = (name, state)
+        view = self.rendered.get(key)
+        if view is not None:
+            self.rendered.move_to_end(key)
+            self.counters['hits'] += 1
+            return view
+        self.counters['misses'] += 1
+        view = self.rendered[key] = RenderedView(*self.builders[name](state))
+        if len(self.rendered) > self.max_size:
+            self.rendered.popitem(last=False)
+        return view
+
+    async def show(self, update_or_query, name: str, state: tuple = ()):
+        view = self.render(name, state)
+        if not isinstance(update_or_query, Update):
+            msg = update_or_query.message
+            if (view.plain is not None and msg is not None
+                    and msg.text == view.plain and msg.reply_markup == view.markup):
+                self.counters['skipped_edits'] += 1
+                return
+        sent = await reply_or_edit(update_or_query, view.text, reply_markup=view.markup, parse_mode='Markdown')
+        if isinstance(sent, Message):
+            view.plain = sent.text
+
+    def stats(self) -> dict:
+        return {**self.counters, 'cached': len(self.rendered)}
+
+views = ViewCache(VIEW_CACHE_SIZE)
+
 # ==================== ФУНКЦИИ БАЗЫ ДАННЫХ (с поддержкой переданного соединения) ====================
 
+async def migrate_base(conn):
+    """Исходная схема (всё, что раньше создавалось при каждом старте)."""
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS players (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            level INTEGER DEFAULT 1,
+            exp INTEGER DEFAULT 0,
+            gold INTEGER DEFAULT 0,
+            total_clicks INTEGER DEFAULT 0,
+            total_gold_earned INTEGER DEFAULT 0,
+            total_crits INTEGER DEFAULT 0,
+            current_crit_streak INTEGER DEFAULT 0,
+            max_crit_streak INTEGER DEFAULT 0,
+            last_daily_reset DATE,
+            last_weekly_reset TEXT,
+            current_location TEXT DEFAULT 'coal_mine',
+            active_tool TEXT DEFAULT 'wooden_pickaxe'
+        )
+    ''')
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS upgrades (
+            user_id BIGINT,
+            upgrade_id TEXT,
+            level INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, upgrade_id)
+        )
+    ''')
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS daily_tasks (
+            user_id BIGINT,
+            task_id INTEGER,
+            task_name TEXT,
+            description TEXT,
+            goal INTEGER,
+            progress INTEGER DEFAULT 0,
+            completed BOOLEAN DEFAULT FALSE,
+            reward_gold INTEGER,
+            reward_exp INTEGER,
+            date DATE,
+            PRIMARY KEY (user_id, task_id, date)
+        )
+    ''')
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS weekly_tasks (
+            user_id BIGINT,
+            task_id INTEGER,
+            task_name TEXT,
+            description TEXT,
+            goal INTEGER,
+            progress INTEGER DEFAULT 0,
+            completed BOOLEAN DEFAULT FALSE,
+            reward_gold INTEGER,
+            reward_exp INTEGER,
+            week TEXT,
+            PRIMARY KEY (user_id, task_id, week)
+        )
+    ''')
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_achievements (
+            user_id BIGINT,
+            achievement_id TEXT,
+            unlocked_at DATE,
+            progress INTEGER,
+            max_progress INTEGER,
+            PRIMARY KEY (user_id, achievement_id)
+        )
+    ''')
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS inventory (
+            user_id BIGINT,
+            resource_id TEXT,
+            amount INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, resource_id)
+        )
+    ''')
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS player_tools (
+            user_id BIGINT,
+            tool_id TEXT,
+            level INTEGER DEFAULT 1,
+            experience INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, tool_id)
+        )
+    ''')
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS boss_progress (
+            user_id BIGINT,
+            boss_id TEXT,
+            current_health INTEGER,
+            defeated BOOLEAN DEFAULT FALSE,
+            last_attempt TIMESTAMP,
+            PRIMARY KEY (user_id, boss_id)
+        )
+    ''')
+    # Таблица для предметов крафта
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS player_items (
+            user_id BIGINT,
+            item_id TEXT,
+            quantity INTEGER DEFAULT 1,
+            expires_at TIMESTAMP,
+            PRIMARY KEY (user_id, item_id)
+        )
+    ''')
+    # Таблица для глобального состояния (автосброс боссов)
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS global_state (
+            id INTEGER PRIMARY KEY DEFAULT 1,
+            last_boss_reset TIMESTAMP
+        )
+    ''')
+    # Таблица для активных эффектов (зелья и т.п.)
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS active_effects (
+            user_id BIGINT,
+            effect_id TEXT,
+            expires_at TIMESTAMP,
+            effect_data JSONB,
+            PRIMARY KEY (user_id, effect_id)
+        )
+    ''')
+    # Добавляем колонки для постоянных бонусов в таблицу players, если их ещё нет
+    await conn.execute('''
+        ALTER TABLE players
+        ADD COLUMN IF NOT EXISTS perm_tool_power_bonus INTEGER DEFAULT 0,
+        ADD COLUMN IF NOT EXISTS perm_crit_bonus INTEGER DEFAULT 0
+    ''')
+    # Инициализация global_state, если нет записи
+    await conn.execute('''
+        INSERT INTO global_state (id, last_boss_reset)
+        SELECT 1, NOW() WHERE NOT EXISTS (SELECT 1 FROM global_state WHERE id = 1)
+    ''')
+
+async def migrate_task_types(conn):
+    """Тип задания вместо поиска по названию; старые строки размечаются по шаблонам."""
+    task_names = [t['name'] for t in DAILY_TASK_TEMPLATES + WEEKLY_TASK_TEMPLATES]
+    task_types = [t['type'] for t in DAILY_TASK_TEMPLATES + WEEKLY_TASK_TEMPLATES]
+    for table in ('daily_tasks', 'weekly_tasks'):
+        await conn.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS task_type TEXT")
+        await conn.execute(f'''
+            UPDATE {table} t SET task_type = m.task_type
+            FROM unnest($1::text[], $2::text[]) AS m(task_name, task_type)
+            WHERE t.task_type IS NULL AND t.task_name = m.task_name
+        ''', task_names, task_types)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_daily_tasks_type ON daily_tasks (user_id, date, task_type)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_weekly_tasks_type ON weekly_tasks (user_id, week, task_type)")
+
+async def migrate_boss_epoch(conn):
+    """Эпоха, к которой относится прогресс по боссу (см. boss_epoch)."""
+    await conn.execute("ALTER TABLE boss_progress ADD COLUMN IF NOT EXISTS epoch BIGINT DEFAULT 0")
+
+async def migrate_task_counters(conn):
+    """Счётчики выполненных заданий; при первом добавлении заполняются из истории."""
+    has_task_counters = await conn.fetchval(
+        "SELECT 1 FROM information_schema.columns WHERE table_name = 'players' AND column_name = 'tasks_completed_daily'"
+    )
+    if has_task_counters:
+        return
+    await conn.execute('''
+        ALTER TABLE players
+        ADD COLUMN IF NOT EXISTS tasks_completed_daily INTEGER DEFAULT 0,
+        ADD COLUMN IF NOT EXISTS tasks_completed_weekly INTEGER DEFAULT 0
+    ''')
+    await conn.execute('''
+        UPDATE players p
+        SET tasks_completed_daily = (SELECT COUNT(*) FROM daily_tasks WHERE user_id = p.user_id AND completed = TRUE),
+            tasks_completed_weekly = (SELECT COUNT(*) FROM weekly_tasks WHERE user_id = p.user_id AND completed = TRUE)
+    ''')
+    logger.info("Backfilled task completion counters")
+
+async def migrate_hot_indexes(conn):
+    """Индексы под рейтинги, поиск по ресурсу, выполненные задания и последние достижения."""
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_players_gold ON players (gold DESC)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_players_level ON players (level DESC, exp DESC)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_inventory_resource ON inventory (resource_id, amount DESC)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_daily_tasks_completed ON daily_tasks (user_id) WHERE completed")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_weekly_tasks_completed ON weekly_tasks (user_id) WHERE completed")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_achievements_recent ON user_achievements (user_id, unlocked_at DESC)")
+
+async def migrate_inventory_layout(conn):
+    """Колонка для компактного инвентаря и отметка текущей раскладки."""
+    await conn.execute("ALTER TABLE players ADD COLUMN IF NOT EXISTS resources BIGINT[]")
+    await conn.execute("ALTER TABLE global_state ADD COLUMN IF NOT EXISTS inventory_layout TEXT DEFAULT 'rows'")
+    await conn.execute("UPDATE global_state SET inventory_layout = 'rows' WHERE inventory_layout IS NULL")
+
+async def migrate_outbox(conn):
+    """Очередь исходящих сообщений Telegram."""
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id BIGSERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            kind TEXT NOT NULL DEFAULT 'text',
+            text TEXT NOT NULL,
+            parse_mode TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            created_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+    ''')
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (next_attempt_at, id)")
+
+UNUSED_INDEXES = ('idx_players_gold', 'idx_players_level', 'idx_inventory_resource',
+                  'idx_daily_tasks_completed', 'idx_weekly_tasks_completed')
+
+async def migrate_drop_unused_indexes(conn):
+    """
+    Индексы миграции 5, которые больше нечему обслуживать: рейтинги читаются
+    из памяти, выполненные задания – из счётчиков на players. Остался только
+    idx_user_achievements_recent; планы проверяет tests/test_query_plans.py.
+    """
+    for name in UNUSED_INDEXES:
+        await conn.execute(f"DROP INDEX IF EXISTS {name}")
+
+async def convert_inventory_to_compact(conn):
+    """Строки inventory -> players.resources (по порядку RESOURCE_IDS)."""
+    await conn.execute('''
+        UPDATE players p
+        SET resources = ARRAY(SELECT COALESCE(i.amount, 0)::bigint
+                              FROM unnest($1::text[]) WITH ORDINALITY AS k(id, ord)
+                              LEFT JOIN inventory i ON i.user_id = p.user_id AND i.resource_id = k.id
+                              ORDER BY k.ord)
+    ''', RESOURCE_IDS)
+    await conn.execute("DELETE FROM inventory")
+
+async def convert_inventory_to_rows(conn):
+    """players.resources -> строки inventory."""
+    await conn.execute('''
+        INSERT INTO inventory (user_id, resource_id, amount)
+        SELECT p.user_id, k.id, COALESCE(p.resources[k.ord], 0)
+        FROM players p CROSS JOIN unnest($1::text[]) WITH ORDINALITY AS k(id, ord)
+        ON CONFLICT (user_id, resource_id) DO UPDATE SET amount = EXCLUDED.amount
+    ''', RESOURCE_IDS)
+    await conn.execute("UPDATE players SET resources = NULL WHERE resources IS NOT NULL")
+
+INVENTORY_CONVERSIONS = {
+    'compact': convert_inventory_to_compact,
+    'rows': convert_inventory_to_rows,
+}
+
+# Миграции схемы: (версия, описание, функция). Только дописываются в конец,
+# уже выпущенные не меняются. Все шаги идемпотентны, поэтому базы, созданные
+# до появления schema_version, проходят их с версии 0 без потерь.
+MIGRATIONS = [
+    (1, 'base tables', migrate_base),
+    (2, 'task types', migrate_task_types),
+    (3, 'boss epoch', migrate_boss_epoch),
+    (4, 'task completion counters', migrate_task_counters),
+    (5, 'hot query indexes', migrate_hot_indexes),
+    (6, 'inventory layout', migrate_inventory_layout),
+    (7, 'outbox', migrate_outbox),
+    (8, 'drop unused indexes', migrate_drop_unused_indexes),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+MIGRATION_LOCK_ID = 0x6D696E65  # ключ pg_advisory_lock, общий для всех воркеров
+
+async def get_schema_version(conn) -> int:
+    if not await conn.fetchval("SELECT to_regclass('schema_version') IS NOT NULL"):
+        return 0
+    return await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+
+async def get_inventory_layout(conn) -> str:
+    return await conn.fetchval("SELECT inventory_layout FROM global_state WHERE id = 1")
+
 async def init_db():
-    async with db_pool.acquire() as conn:
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS players (
-                user_id BIGINT PRIMARY KEY,
-                username TEXT,
-                level INTEGER DEFAULT 1,
-                exp INTEGER DEFAULT 0,
-                gold INTEGER DEFAULT 0,
-                total_clicks INTEGER DEFAULT 0,
-                total_gold_earned INTEGER DEFAULT 0,
-                total_crits INTEGER DEFAULT 0,
-                current_crit_streak INTEGER DEFAULT 0,
-                max_crit_streak INTEGER DEFAULT 0,
-                last_daily_reset DATE,
-                last_weekly_reset TEXT,
-                current_location TEXT DEFAULT 'coal_mine',
-                active_tool TEXT DEFAULT 'wooden_pickaxe'
-            )
-        ''')
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS upgrades (
-                user_id BIGINT,
-                upgrade_id TEXT,
-                level INTEGER DEFAULT 0,
-                PRIMARY KEY (user_id, upgrade_id)
-            )
-        ''')
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS daily_tasks (
-                user_id BIGINT,
-                task_id INTEGER,
-                task_name TEXT,
-                description TEXT,
-                goal INTEGER,
-                progress INTEGER DEFAULT 0,
-                completed BOOLEAN DEFAULT FALSE,
-                reward_gold INTEGER,
-                reward_exp INTEGER,
-                date DATE,
-                PRIMARY KEY (user_id, task_id, date)
-            )
-        ''')
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS weekly_tasks (
-                user_id BIGINT,
-                task_id INTEGER,
-                task_name TEXT,
-                description TEXT,
-                goal INTEGER,
-                progress INTEGER DEFAULT 0,
-                completed BOOLEAN DEFAULT FALSE,
-                reward_gold INTEGER,
-                reward_exp INTEGER,
-                week TEXT,
-                PRIMARY KEY (user_id, task_id, week)
-            )
-        ''')
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS user_achievements (
-                user_id BIGINT,
-                achievement_id TEXT,
-                unlocked_at DATE,
-                progress INTEGER,
-                max_progress INTEGER,
-                PRIMARY KEY (user_id, achievement_id)
-            )
-        ''')
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS inventory (
-                user_id BIGINT,
-                resource_id TEXT,
-                amount INTEGER DEFAULT 0,
-                PRIMARY KEY (user_id, resource_id)
-            )
-        ''')
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS player_tools (
-                user_id BIGINT,
-                tool_id TEXT,
-                level INTEGER DEFAULT 1,
-                experience INTEGER DEFAULT 0,
-                PRIMARY KEY (user_id, tool_id)
-            )
-        ''')
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS boss_progress (
-                user_id BIGINT,
-                boss_id TEXT,
-                current_health INTEGER,
-                defeated BOOLEAN DEFAULT FALSE,
-                last_attempt TIMESTAMP,
-                PRIMARY KEY (user_id, boss_id)
-            )
-        ''')
-        # Таблица для предметов крафта
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS player_items (
-                user_id BIGINT,
-                item_id TEXT,
-                quantity INTEGER DEFAULT 1,
-                expires_at TIMESTAMP,
-                PRIMARY KEY (user_id, item_id)
-            )
-        ''')
-        # Таблица для глобального состояния (автосброс боссов)
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS global_state (
-                id INTEGER PRIMARY KEY DEFAULT 1,
-                last_boss_reset TIMESTAMP
-            )
-        ''')
-                # Таблица для активных эффектов (зелья и т.п.)
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS active_effects (
-                user_id BIGINT,
-                effect_id TEXT,
-                expires_at TIMESTAMP,
-                effect_data JSONB,
-                PRIMARY KEY (user_id, effect_id)
-            )
-        ''')
-        # Добавляем колонки для постоянных бонусов в таблицу players, если их ещё нет
-        await conn.execute('''
-            ALTER TABLE players
-            ADD COLUMN IF NOT EXISTS perm_tool_power_bonus INTEGER DEFAULT 0,
-            ADD COLUMN IF NOT EXISTS perm_crit_bonus INTEGER DEFAULT 0
-        ''')
-        # Инициализация global_state, если нет записи
-        await conn.execute('''
-            INSERT INTO global_state (id, last_boss_reset)
-            SELECT 1, NOW() WHERE NOT EXISTS (SELECT 1 FROM global_state WHERE id = 1)
-        ''')
-        logger.info("Database tables initialized (if not existed)")
+    """
+    Приводит схему к SCHEMA_VERSION, а инвентарь – к INVENTORY_LAYOUT.
+    На актуальной базе это пара запросов; иначе под advisory lock (чтобы
+    параллельно стартующие воркеры не гонялись) применяются недостающие
+    миграции, каждая в своей транзакции.
+    """
+    if INVENTORY_LAYOUT not in INVENTORY_CONVERSIONS:
+        raise ValueError(f"Unknown INVENTORY_LAYOUT: {INVENTORY_LAYOUT}")
+    async with acquire_conn() as conn:
+        if (await get_schema_version(conn) >= SCHEMA_VERSION
+                and await get_inventory_layout(conn) == INVENTORY_LAYOUT):
+            return
+        await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK_ID)
+        try:
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TIMESTAMP DEFAULT NOW()
+                )
+            ''')
+            current = await get_schema_version(conn)
+            for version, description, migrate in MIGRATIONS:
+                if version <= current:
+                    continue
+                async with transaction(conn):
+                    await migrate(conn)
+                    await conn.execute(
+                        "INSERT INTO schema_version (version, description) VALUES ($1, $2)",
+                        version, description
+                    )
+                logger.info(f"Applied migration {version}: {description}")
+            layout = await get_inventory_layout(conn)
+            if layout != INVENTORY_LAYOUT:
+                async with transaction(conn):
+                    await INVENTORY_CONVERSIONS[INVENTORY_LAYOUT](conn)
+                    await conn.execute("UPDATE global_state SET inventory_layout = $1 WHERE id = 1", INVENTORY_LAYOUT)
+                logger.info(f"Inventory converted from {layout} to {INVENTORY_LAYOUT} layout")
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
+
+# ---------- Кэш состояния игрока ----------
+# Фиксированный порядок ключей: индекс в массивах PlayerState
+RESOURCE_IDS = list(RESOURCES)
+RESOURCE_INDEX = {rid: i for i, rid in enumerate(RESOURCE_IDS)}
+UPGRADE_IDS = list(UPGRADES)
+UPGRADE_INDEX = {up_id: i for i, up_id in enumerate(UPGRADE_IDS)}
+
+# Фрагменты SQL для выбранной INVENTORY_LAYOUT. Во всех запросах инвентарь
+# игрока p читается как массив длины len(RESOURCE_IDS) по порядку RESOURCE_IDS.
+RESOURCE_IDS_SQL = "ARRAY[" + ", ".join(f"'{rid}'" for rid in RESOURCE_IDS) + "]::text[]"
+
+if INVENTORY_LAYOUT == 'compact':
+    INVENTORY_ARRAY_SQL = f"""ARRAY(SELECT COALESCE(p.resources[k], 0)
+                 FROM generate_series(1, {len(RESOURCE_IDS)}) AS k
+                 ORDER BY k)"""
+    INVENTORY_READ_SQL = f"""
+        SELECT k.id AS resource_id, COALESCE(p.resources[k.ord], 0) AS amount
+        FROM players p CROSS JOIN unnest({RESOURCE_IDS_SQL}) WITH ORDINALITY AS k(id, ord)
+        WHERE p.user_id = $1
+    """
+    INVENTORY_AMOUNT_SQL = f"""
+        SELECT COALESCE(resources[array_position({RESOURCE_IDS_SQL}, $2)], 0)
+        FROM players WHERE user_id = $1
+    """
+    # Все дельты игрока – одна перезапись массива с насыщением по каждому слоту;
+    # строка игрока блокируется, и если какое-то списание уводит остаток в минус,
+    # не меняется ничего
+    RESOURCE_DELTA_SQL = f"""
+        WITH d AS (
+            SELECT k.ord, SUM(d.delta) AS delta
+            FROM unnest($2::text[], $3::bigint[]) AS d(resource_id, delta)
+            JOIN unnest({RESOURCE_IDS_SQL}) WITH ORDINALITY AS k(id, ord) ON k.id = d.resource_id
+            GROUP BY k.ord
+        ),
+        cur AS (
+            SELECT resources FROM players WHERE user_id = $1 FOR UPDATE
+        ),
+        upd AS (
+            UPDATE players p
+            SET resources = ARRAY(SELECT LEAST(COALESCE(p.resources[k], 0) + COALESCE(d.delta, 0), $4)
+                                  FROM generate_series(1, {len(RESOURCE_IDS)}) AS k
+                                  LEFT JOIN d ON d.ord = k
+                                  ORDER BY k)
+            FROM cur
+            WHERE p.user_id = $1
+              AND NOT EXISTS (SELECT 1 FROM d WHERE COALESCE(cur.resources[d.ord], 0) + d.delta < 0)
+            RETURNING p.resources
+        )
+        SELECT k.id AS resource_id, upd.resources[k.ord] AS amount
+        FROM upd CROSS JOIN unnest({RESOURCE_IDS_SQL}) WITH ORDINALITY AS k(id, ord)
+        JOIN d ON d.ord = k.ord
+    """
+    # Части CLICK_COMMIT_SQL: игрок обновляется одним UPDATE вместе с ресурсами
+    CLICK_INVENTORY_CTE = f"""
+    inv AS (
+        SELECT r.user_id, k.ord, SUM(r.amount) AS amount
+        FROM unnest($11::bigint[], $12::text[], $13::bigint[]) AS r(user_id, resource_id, amount)
+        JOIN unnest({RESOURCE_IDS_SQL}) WITH ORDINALITY AS k(id, ord) ON k.id = r.resource_id
+        GROUP BY r.user_id, k.ord
+    ),"""
+    CLICK_INVENTORY_SET = f"""resources = ARRAY(SELECT LEAST(COALESCE(p.resources[k], 0) + COALESCE(inv.amount, 0), $16)
+                              FROM generate_series(1, {len(RESOURCE_IDS)}) AS k
+                              LEFT JOIN inv ON inv.user_id = p.user_id AND inv.ord = k
+                              ORDER BY k),
+            """
+    CLICK_INVENTORY_RETURNING = ", p.resources"
+    CLICK_INVENTORY_RESULT = f"""(SELECT json_object_agg(k.id, player.resources[k.ord])
+            FROM unnest({RESOURCE_IDS_SQL}) WITH ORDINALITY AS k(id, ord))"""
+else:
+    INVENTORY_ARRAY_SQL = f"""ARRAY(SELECT COALESCE(i.amount, 0)
+                 FROM unnest({RESOURCE_IDS_SQL}) WITH ORDINALITY AS k(id, ord)
+                 LEFT JOIN inventory i ON i.user_id = p.user_id AND i.resource_id = k.id
+                 ORDER BY k.ord)"""
+    INVENTORY_READ_SQL = "SELECT resource_id, amount FROM inventory WHERE user_id = $1"
+    INVENTORY_AMOUNT_SQL = "SELECT amount FROM inventory WHERE user_id = $1 AND resource_id = $2"
+    # Все дельты одним upsert с насыщением; затронутые строки блокируются,
+    # и если какое-то списание уводит остаток в минус, не меняется ничего
+    RESOURCE_DELTA_SQL = """
+        WITH d AS (
+            SELECT * FROM unnest($2::text[], $3::bigint[]) AS d(resource_id, delta)
+        ),
+        cur AS (
+            SELECT resource_id, amount FROM inventory
+            WHERE user_id = $1 AND resource_id = ANY($2::text[])
+            FOR UPDATE
+        ),
+        ok AS (
+            SELECT NOT EXISTS (
+                SELECT 1 FROM d LEFT JOIN cur ON cur.resource_id = d.resource_id
+                WHERE COALESCE(cur.amount, 0) + d.delta < 0
+            ) AS ok
+        )
+        INSERT INTO inventory AS i (user_id, resource_id, amount)
+        SELECT $1, d.resource_id, LEAST(d.delta, $4) FROM d, ok WHERE ok.ok
+        ON CONFLICT (user_id, resource_id) DO UPDATE
+        SET amount = LEAST(i.amount::bigint + (SELECT d.delta FROM d WHERE d.resource_id = EXCLUDED.resource_id), $4)
+        RETURNING i.resource_id, i.amount
+    """
+    CLICK_INVENTORY_CTE = """
+    inv AS (
+        INSERT INTO inventory AS i (user_id, resource_id, amount)
+        SELECT r.user_id, r.resource_id, LEAST(r.amount, $16)
+        FROM unnest($11::bigint[], $12::text[], $13::bigint[]) AS r(user_id, resource_id, amount)
+        ON CONFLICT (user_id, resource_id) DO UPDATE
+        SET amount = LEAST(i.amount::bigint + EXCLUDED.amount, $16)
+        RETURNING i.user_id, i.resource_id, i.amount
+    ),"""
+    CLICK_INVENTORY_SET = ""
+    CLICK_INVENTORY_RETURNING = ""
+    CLICK_INVENTORY_RESULT = "(SELECT json_object_agg(inv.resource_id, inv.amount) FROM inv WHERE inv.user_id = player.user_id)"
+
+queries.register('inventory_read', INVENTORY_READ_SQL)
+queries.register('inventory_amount', INVENTORY_AMOUNT_SQL)
+queries.register('resource_delta', RESOURCE_DELTA_SQL)
+
+PLAYER_STATE_SQL = queries.register('player_state', f"""
+    SELECT p.level, p.exp, p.gold, p.total_clicks, p.total_gold_earned, p.total_crits,
+           p.current_crit_streak, p.max_crit_streak, p.perm_tool_power_bonus, p.perm_crit_bonus,
+           p.current_location, p.active_tool,
+           ARRAY(SELECT COALESCE(u.level, 0)
+                 FROM unnest($2::text[]) WITH ORDINALITY AS k(id, ord)
+                 LEFT JOIN upgrades u ON u.user_id = p.user_id AND u.upgrade_id = k.id
+                 ORDER BY k.ord) AS upgrades,
+           {INVENTORY_ARRAY_SQL} AS inventory,
+           COALESCE((SELECT json_object_agg(tool_id, level) FROM player_tools WHERE user_id = p.user_id), '{{}}') AS tools,
+           ARRAY(SELECT achievement_id FROM user_achievements WHERE user_id = p.user_id) AS achievements,
+           COALESCE((SELECT json_agg(json_build_array(a.achievement_id, a.unlocked_at))
+                     FROM (SELECT achievement_id, unlocked_at FROM user_achievements
+                           WHERE user_id = p.user_id ORDER BY unlocked_at DESC LIMIT 5) a), '[]') AS recent_achievements,
+           COALESCE((SELECT json_object_agg(item_id, quantity) FROM player_items WHERE user_id = p.user_id), '{{}}') AS items,
+           COALESCE((SELECT json_agg(json_build_array(effect_id, EXTRACT(EPOCH FROM expires_at - NOW()), effect_data))
+                     FROM active_effects WHERE user_id = p.user_id AND expires_at > NOW()), '[]') AS effects,
+           COALESCE((SELECT json_object_agg(boss_id, json_build_object('current_health', current_health,
+                                                                      'defeated', defeated, 'epoch', epoch))
+                     FROM boss_progress WHERE user_id = p.user_id), '{{}}') AS bosses
+    FROM players p
+    WHERE p.user_id = $1
+""")
+
+class PlayerState:
+    """
+    Компактный снимок игрока, из которого рисуются все экраны бота: улучшения
+    и ресурсы лежат в массивах по индексам UPGRADE_IDS/RESOURCE_IDS, открытые
+    достижения — битовой маской ACHIEVEMENT_INDEX. Эффекты хранят срок по
+    time.monotonic(), прогресс по боссам — сырые строки (эпоха проверяется при чтении).
+    """
+    __slots__ = ('user_id', 'level', 'exp', 'gold', 'total_clicks', 'total_gold_earned', 'total_crits',
+                 'current_crit_streak', 'max_crit_streak', 'perm_tool_power_bonus', 'perm_crit_bonus',
+                 'current_location', 'active_tool', 'upgrades', 'inventory', 'tools', 'achievements',
+                 'recent_achievements', 'items', 'effects', 'bosses', 'loaded_at')
+
+    def __init__(self, uid: int, row):
+        self.loaded_at = time.monotonic()
+        self.user_id = uid
+        self.level = row['level']
+        self.exp = row['exp']
+        self.gold = row['gold']
+        self.total_clicks = row['total_clicks']
+        self.total_gold_earned = row['total_gold_earned']
+        self.total_crits = row['total_crits']
+        self.current_crit_streak = row['current_crit_streak']
+        self.max_crit_streak = row['max_crit_streak']
+        self.perm_tool_power_bonus = row['perm_tool_power_bonus'] or 0
+        self.perm_crit_bonus = row['perm_crit_bonus'] or 0
+        self.current_location = row['current_location'] or 'coal_mine'
+        self.active_tool = row['active_tool'] or 'wooden_pickaxe'
+        self.upgrades = list(row['upgrades'])
+        self.inventory = list(row['inventory'])
+        self.tools = json.loads(row['tools'])
+        self.achievements = ACHIEVEMENT_INDEX.mask(row['achievements'])
+        self.recent_achievements = [tuple(a) for a in json.loads(row['recent_achievements'])]
+        self.items = json.loads(row['items'])
+        self.effects = {}
+        for effect_id, remaining, data in json.loads(row['effects']):
+            self.effects[effect_id] = (self.loaded_at + remaining, json.loads(data) if isinstance(data, str) else data)
+        self.bosses = json.loads(row['bosses'])
+
+    def stats(self) -> dict:
+        """Тот же словарь, что возвращает get_player_stats."""
+        return {
+            'level': self.level,
+            'exp': self.exp,
+            'total_exp': (self.level - 1) * EXP_PER_LEVEL + self.exp,
+            'exp_next': EXP_PER_LEVEL,
+            'gold': self.gold,
+            'clicks': self.total_clicks,
+            'total_gold': self.total_gold_earned,
+            'total_crits': self.total_crits,
+            'current_crit_streak': self.current_crit_streak,
+            'max_crit_streak': self.max_crit_streak,
+            'upgrades': dict(zip(UPGRADE_IDS, self.upgrades)),
+            'perm_tool_power_bonus': self.perm_tool_power_bonus,
+            'perm_crit_bonus': self.perm_crit_bonus
+        }
+
+    def inventory_dict(self) -> dict:
+        return dict(zip(RESOURCE_IDS, self.inventory))
+
+    def active_effects(self) -> dict:
+        now = time.monotonic()
+        return {eid: data for eid, (deadline, data) in self.effects.items() if deadline > now}
+
+    def boss_progress(self, boss_id: str) -> dict:
+        return boss_state(self.bosses.get(boss_id), boss_id, boss_epoch())
+
+    def apply_stats(self, stats: dict):
+        self.level = stats['level']
+        self.exp = stats['exp']
+        self.gold = stats['gold']
+        self.total_clicks = stats['clicks']
+        self.total_gold_earned = stats['total_gold']
+        self.total_crits = stats['total_crits']
+        self.current_crit_streak = stats['current_crit_streak']
+        self.max_crit_streak = stats['max_crit_streak']
+
+    def apply_inventory(self, inv: dict):
+        for rid, amt in inv.items():
+            idx = RESOURCE_INDEX.get(rid)
+            if idx is not None:
+                self.inventory[idx] = amt
+
+class PlayerStateCache:
+    """
+    LRU-кэш PlayerState с TTL. Все функции, меняющие игрока, обязаны
+    вызвать invalidate() (после фиксации своей транзакции) или обновить
+    состояние сами. Отметка времени инвалидации не даёт положить в кэш
+    данные, прочитанные до неё.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._states: "OrderedDict[int, PlayerState]" = OrderedDict()
+        self._invalidated: Dict[int, float] = {}
+        self.on_invalidate: List[Any] = []  # вызываются с uid при каждой инвалидации
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, uid: int) -> Optional[PlayerState]:
+        state = self._states.get(uid)
+        if state is None or time.monotonic() - state.loaded_at > self.ttl:
+            if state is not None:
+                del self._states[uid]
+            self.misses += 1
+            return None
+        self._states.move_to_end(uid)
+        self.hits += 1
+        return state
+
+    def put(self, state: PlayerState, started_at: float):
+        uid = state.user_id
+        if self._invalidated.get(uid, 0.0) >= started_at:
+            return
+        self._store(state)
+
+    def _store(self, state: PlayerState):
+        self._states[state.user_id] = state
+        self._states.move_to_end(state.user_id)
+        while len(self._states) > self.maxsize:
+            self._states.popitem(last=False)
+
+    def update(self, uid: int, stats: dict = None, inv: dict = None):
+        """Переносит в закэшированное состояние уже зафиксированные изменения."""
+        state = self._states.pop(uid, None)
+        if state is None:
+            self.invalidate(uid)
+            return
+        if stats is not None:
+            state.apply_stats(stats)
+        if inv is not None:
+            state.apply_inventory(inv)
+        scope = current_scope()
+        if scope is not None:
+            # Изменения уже зафиксированы: отложенная инвалидация выбросила бы свежую запись
+            scope.deferred.discard(uid)
+        self._mark_invalidated(uid)
+        state.loaded_at = time.monotonic()
+        self._store(state)
+
+    def invalidate(self, uid: int):
+        self._states.pop(uid, None)
+        scope = current_scope()
+        if scope is not None and scope.depth > 0:
+            # Транзакция запроса может быть ещё открыта: отметка времени и
+            # слушатели – после выхода из внешнего блока acquire_conn()
+            scope.deferred.add(uid)
+            return
+        self._mark_invalidated(uid)
+
+    def _mark_invalidated(self, uid: int):
+        """Отметка времени (загрузки, начатые раньше, не попадут в кэш) и слушатели."""
+        now = time.monotonic()
+        self._invalidated[uid] = now
+        for listener in self.on_invalidate:
+            listener(uid)
+        if len(self._invalidated) > self.maxsize:
+            # Отметки нужны только на время загрузки, которая идёт не дольше TTL
+            self._invalidated = {u: t for u, t in self._invalidated.items() if now - t < self.ttl}
+
+player_cache = PlayerStateCache(PLAYER_CACHE_SIZE, PLAYER_CACHE_TTL)
+
+async def get_player_state(uid: int) -> Optional[PlayerState]:
+    """Возвращает состояние игрока из кэша, при промахе загружает его одним запросом."""
+    state = player_cache.get(uid)
+    if state is not None:
+        return state
+    started_at = time.monotonic()
+    async with acquire_conn() as conn:
+        row = await queries.fetchrow(conn, 'player_state', uid, UPGRADE_IDS)
+        # Внутри открытой транзакции строка может оказаться незафиксированной
+        cacheable = not conn.is_in_transaction()
+    if not row:
+        return None
+    state = PlayerState(uid, row)
+    if cacheable:
+        player_cache.put(state, started_at)
+    return state
+
+# ---------- Рейтинги ----------
+LEADERBOARD_CATEGORIES = (['level', 'gold', 'achievements', 'tasks_completed', 'tools', 'total_resources']
+                          + [f'res_{rid}' for rid in RESOURCE_IDS])
+
+LEADERBOARD_SQL = queries.register('leaderboard', f"""
+    SELECT p.user_id, p.username, p.level, p.exp, p.gold,
+           (SELECT COUNT(*) FROM user_achievements WHERE user_id = p.user_id) AS achievements,
+           p.tasks_completed_daily + p.tasks_completed_weekly AS tasks_completed,
+           (SELECT COALESCE(SUM(level), 0) FROM player_tools WHERE user_id = p.user_id) AS tools,
+           {INVENTORY_ARRAY_SQL} AS inventory
+    FROM players p
+""")
+
+class BisectList(list):
+    """Замена SortedList без sortedcontainers: тот же интерфейс, вставка и удаление за O(n)."""
+
+    def __init__(self, iterable=()):
+        super().__init__(sorted(iterable))
+
+    def add(self, value):
+        bisect.insort(self, value)
+
+    def remove(self, value):
+        del self[bisect.bisect_left(self, value)]
+
+    def bisect_left(self, value) -> int:
+        return bisect.bisect_left(self, value)
+
+    def bisect_right(self, value) -> int:
+        return bisect.bisect_right(self, value)
+
+# Отсортированный контейнер рейтингов: SortedList обновляет и ищет место за O(log n)
+SortedKeys = SortedList if SortedList is not None else BisectList
+
+class SortedBoard:
+    """Рейтинг одной категории: ключи (-очки, user_id) в отсортированном контейнере."""
+    __slots__ = ('keys', 'scores')
+
+    def __init__(self):
+        self.keys = SortedKeys()
+        self.scores: Dict[int, int] = {}
+
+    def set(self, uid: int, score: int):
+        old = self.scores.get(uid)
+        if old == score:
+            return
+        if old is not None:
+            self.keys.remove((-old, uid))
+        self.keys.add((-score, uid))
+        self.scores[uid] = score
+
+    def load(self, scores: Dict[int, int]):
+        self.scores = dict(scores)
+        self.keys = SortedKeys((-score, uid) for uid, score in self.scores.items())
+
+    def rank(self, uid: int) -> Optional[int]:
+        """Место игрока (с нуля) бинарным поиском по ключу."""
+        score = self.scores.get(uid)
+        if score is None:
+            return None
+        return self.keys.bisect_left((-score, uid))
+
+    def slice(self, start: int, stop: int) -> List[Tuple[int, int, int]]:
+        """[(место, user_id, очки)] для мест start..stop-1."""
+        start = max(start, 0)
+        return [(start + i, uid, -neg) for i, (neg, uid) in enumerate(self.keys[start:stop])]
+
+    def page(self, after: Optional[Tuple[int, int]], limit: int) -> List[Tuple[int, int, int]]:
+        """Keyset-страница: limit игроков строго после курсора (очки, user_id)."""
+        start = 0 if after is None else self.keys.bisect_right((-after[0], after[1]))
+        return self.slice(start, start + limit)
+
+class Leaderboards:
+    """
+    Рейтинги в памяти. Строятся из Postgres при старте (rebuild) и
+    обновляются путями записи: клик, задания, достижения, крафт, продажа –
+    только после фиксации транзакции (after_commit), чтобы откат или повтор
+    записи не оставлял в рейтинге несуществующих очков.
+    Чтение топа — срез первых n ключей, без запросов к БД.
+    Рейтинги свои у каждого процесса: при нескольких экземплярах (webhook за
+    балансировщиком) записи другого экземпляра видны только после rebuild.
+    """
+
+    def __init__(self):
+        self.boards = {cat: SortedBoard() for cat in LEADERBOARD_CATEGORIES}
+        self.names: Dict[int, str] = {}
+
+    def set(self, category: str, uid: int, score: int):
+        self.boards[category].set(uid, score)
+
+    def add(self, category: str, uid: int, delta: int):
+        if delta:
+            board = self.boards[category]
+            board.set(uid, board.scores.get(uid, 0) + delta)
+
+    def set_name(self, uid: int, username: Optional[str]):
+        if username:
+            self.names[uid] = username
+
+    def update_player(self, uid: int, stats: dict = None, inv: dict = None, tools: dict = None):
+        if stats:
+            self.set('level', uid, stats['total_exp'])
+            self.set('gold', uid, stats['gold'])
+        if inv is not None:
+            for rid in RESOURCE_IDS:
+                self.set(f'res_{rid}', uid, inv.get(rid, 0))
+            self.set('total_resources', uid, sum(inv.values()))
+        if tools is not None:
+            self.set('tools', uid, sum(tools.values()))
+
+    def add_players(self, rows):
+        """Новички (строки players) сразу попадают во все рейтинги со стартовыми значениями."""
+        for row in rows:
+            uid = row['user_id']
+            self.set_name(uid, row['username'])
+            self.update_player(uid, {'total_exp': (row['level'] - 1) * EXP_PER_LEVEL + row['exp'],
+                                     'gold': row['gold']}, {}, {'wooden_pickaxe': 1})
+            self.set('achievements', uid, 0)
+            self.set('tasks_completed', uid, 0)
+
+    def _named(self, entries) -> List[Tuple[int, int, Optional[str], int]]:
+        return [(rank, uid, self.names.get(uid), score) for rank, uid, score in entries]
+
+    def page(self, category: str, after: Optional[Tuple[int, int]] = None,
+             limit: int = 10) -> List[Tuple[int, int, Optional[str], int]]:
+        """[(место, user_id, имя, очки)] — первая страница или следующая после курсора."""
+        return self._named(self.boards[category].page(after, limit))
+
+    def rank(self, category: str, uid: int) -> Optional[Tuple[int, int]]:
+        """(место с нуля, очки) игрока или None, если его нет в рейтинге."""
+        board = self.boards[category]
+        rank = board.rank(uid)
+        return None if rank is None else (rank, board.scores[uid])
+
+    def around(self, category: str, uid: int, radius: int = 5) -> List[Tuple[int, int, Optional[str], int]]:
+        """Окно ±radius соседей вокруг игрока."""
+        board = self.boards[category]
+        rank = board.rank(uid)
+        if rank is None:
+            return []
+        return self._named(board.slice(rank - radius, rank + radius + 1))
+
+    async def rebuild(self, conn: asyncpg.Connection):
+        rows = await queries.fetch(conn, 'leaderboard')
+        scores = {cat: {} for cat in LEADERBOARD_CATEGORIES}
+        names = {}
+        for row in rows:
+            uid = row['user_id']
+            if row['username']:
+                names[uid] = row['username']
+            scores['level'][uid] = (row['level'] - 1) * EXP_PER_LEVEL + row['exp']
+            scores['gold'][uid] = row['gold']
+            scores['achievements'][uid] = row['achievements']
+            scores['tasks_completed'][uid] = row['tasks_completed']
+            scores['tools'][uid] = row['tools']
+            scores['total_resources'][uid] = sum(row['inventory'])
+            for rid, amt in zip(RESOURCE_IDS, row['inventory']):
+                scores[f'res_{rid}'][uid] = amt
+        for cat, board in self.boards.items():
+            board.load(scores[cat])
+        self.names = names
+        logger.info(f"Leaderboards rebuilt for {len(rows)} players")
+
+leaderboards = Leaderboards()
+
+async def refresh_leaderboards(uid: int):
+    """Переносит в рейтинги состояние игрока после записи вне пути клика."""
+    state = await get_player_state(uid)
+    if state is not None:
+        leaderboards.update_player(uid, state.stats(), state.inventory_dict(), state.tools)
 
 # ---------- Игроки ----------
+PROVISION_BATCH_SIZE = 1000
+
+def roll_tasks(templates: list) -> List[dict]:
+    """Случайный набор заданий по шаблонам (не больше четырёх)."""
+    tasks = []
+    for i, t in enumerate(random.sample(templates, min(4, len(templates)))):
+        goal = random.randint(*t['goal'])
+        tasks.append({
+            'task_id': i,
+            'task_name': t['name'],
+            'task_type': t['type'],
+            'description': t['description'].format(goal),
+            'goal': goal,
+            'reward_gold': t['reward_gold'],
+            'reward_exp': t['reward_exp'],
+        })
+    return tasks
+
+# Новый игрок целиком (строка игрока, улучшения, ресурсы, кирка и задания)
+# одним оператором для любого числа user_id; уже существующие пропускаются
+PROVISION_SQL = queries.register('provision', """
+    WITH new AS (
+        INSERT INTO players (user_id, username, last_daily_reset, last_weekly_reset)
+        SELECT n.user_id, n.username, $3, $4
+        FROM unnest($1::bigint[], $2::text[]) AS n(user_id, username)
+        ON CONFLICT (user_id) DO NOTHING
+        RETURNING *
+    ),
+    ups AS (
+        INSERT INTO upgrades (user_id, upgrade_id, level)
+        SELECT new.user_id, u.id, 0 FROM new CROSS JOIN unnest($5::text[]) AS u(id)
+        ON CONFLICT DO NOTHING
+    ),
+    inv AS (
+        INSERT INTO inventory (user_id, resource_id, amount)
+        SELECT new.user_id, r.id, 0 FROM new CROSS JOIN unnest($6::text[]) AS r(id)
+        ON CONFLICT DO NOTHING
+    ),
+    tools AS (
+        INSERT INTO player_tools (user_id, tool_id, level, experience)
+        SELECT new.user_id, 'wooden_pickaxe', 1, 0 FROM new
+        ON CONFLICT DO NOTHING
+    ),
+    daily AS (
+        INSERT INTO daily_tasks (user_id, task_id, task_name, task_type, description, goal, reward_gold, reward_exp, date)
+        SELECT t.user_id, t.task_id, t.task_name, t.task_type, t.description, t.goal, t.reward_gold, t.reward_exp, $3
+        FROM jsonb_to_recordset($7::jsonb) AS t(user_id bigint, task_id int, task_name text, task_type text,
+                                                description text, goal int, reward_gold int, reward_exp int)
+        JOIN new ON new.user_id = t.user_id
+    ),
+    weekly AS (
+        INSERT INTO weekly_tasks (user_id, task_id, task_name, task_type, description, goal, reward_gold, reward_exp, week)
+        SELECT t.user_id, t.task_id, t.task_name, t.task_type, t.description, t.goal, t.reward_gold, t.reward_exp, $4
+        FROM jsonb_to_recordset($8::jsonb) AS t(user_id bigint, task_id int, task_name text, task_type text,
+                                                description text, goal int, reward_gold int, reward_exp int)
+        JOIN new ON new.user_id = t.user_id
+    )
+    SELECT * FROM new
+""")
+
+async def provision_players(players: List[Tuple[int, Optional[str]]], conn: asyncpg.Connection = None) -> list:
+    """
+    Создаёт игроков [(user_id, username), ...] пачками по PROVISION_BATCH_SIZE,
+    каждая пачка – один оператор. Возвращает строки players созданных игроков
+    (уже существующие user_id пропускаются). Подходит для импорта и нагрузочных тестов.
+    """
+    async def _provision(conn):
+        today = datetime.date.today()
+        cur_week = get_week_number()
+        inv_ids = RESOURCE_IDS if INVENTORY_LAYOUT == 'rows' else []
+        created = []
+        for start in range(0, len(players), PROVISION_BATCH_SIZE):
+            batch = players[start:start + PROVISION_BATCH_SIZE]
+            daily, weekly = [], []
+            for uid, _ in batch:
+                daily.extend(dict(t, user_id=uid) for t in roll_tasks(DAILY_TASK_TEMPLATES))
+                weekly.extend(dict(t, user_id=uid) for t in roll_tasks(WEEKLY_TASK_TEMPLATES))
+            async with transaction(conn):
+                rows = await queries.fetch(
+                    conn, 'provision',
+                    [uid for uid, _ in batch], [name for _, name in batch],
+                    today, cur_week, UPGRADE_IDS, inv_ids,
+                    json.dumps(daily), json.dumps(weekly)
+                )
+                after_commit(conn, functools.partial(leaderboards.add_players, rows))
+            created.extend(rows)
+        return created
+
+    if conn is None:
+        async with acquire_conn() as conn:
+            return await _provision(conn)
+    else:
+        return await _provision(conn)
+
 async def get_player(uid: int, username: str = None, conn: asyncpg.Connection = None) -> dict:
     async def _get(conn):
         row = await conn.fetchrow("SELECT * FROM players WHERE user_id = $1", uid)
         if not row:
-            today = datetime.date.today()
-            cur_week = get_week_number()
-            await conn.execute(
-                "INSERT INTO players (user_id, username, last_daily_reset, last_weekly_reset) VALUES ($1, $2, $3, $4)",
-                uid, username, today, cur_week
-            )
-            for up_id in UPGRADES:
-                await conn.execute(
-                    "INSERT INTO upgrades (user_id, upgrade_id, level) VALUES ($1, $2, 0) ON CONFLICT DO NOTHING",
-                    uid, up_id
-                )
-            for rid in RESOURCES:
-                await conn.execute(
-                    "INSERT INTO inventory (user_id, resource_id, amount) VALUES ($1, $2, 0) ON CONFLICT DO NOTHING",
-                    uid, rid
-                )
-            await conn.execute(
-                "INSERT INTO player_tools (user_id, tool_id, level, experience) VALUES ($1, $2, 1, 0) ON CONFLICT DO NOTHING",
-                uid, 'wooden_pickaxe'
-            )
-            await generate_daily_tasks(uid, conn)
-            await generate_weekly_tasks(uid, conn)
-            row = await conn.fetchrow("SELECT * FROM players WHERE user_id = $1", uid)
+            created = await provision_players([(uid, username)], conn)
+            # Пусто, если параллельный запрос успел создать игрока первым
+            row = created[0] if created else await conn.fetchrow("SELECT * FROM players WHERE user_id = $1", uid)
         return dict(row)
 
     if conn is None:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             return await _get(conn)
     else:
         return await _get(conn)
@@ -679,39 +1925,41 @@ async def get_player(uid: int, username: str = None, conn: asyncpg.Connection =
 async def get_player_stats(uid: int, conn: asyncpg.Connection = None) -> dict:
     async def _get(conn):
         row = await conn.fetchrow(
-            "SELECT level, exp, gold, total_clicks, total_gold_earned, total_crits, current_crit_streak, max_crit_streak, perm_tool_power_bonus, perm_crit_bonus FROM players WHERE user_id = $1",
+            "SELECT level, exp, gold, total_clicks, total_gold_earned, total_crits, current_crit_streak, max_crit_streak, perm_tool_power_bonus, perm_crit_bonus, "
+            "COALESCE((SELECT json_object_agg(upgrade_id, level) FROM upgrades WHERE user_id = $1), '{}') AS upgrades "
+            "FROM players WHERE user_id = $1",
             uid
         )
         if not row:
             return {}
-        lvl, exp, gold, clicks, tg, crits, cstreak, mstreak, perm_tool_bonus, perm_crit_bonus = row
-        ups = {}
-        for up_id in UPGRADES:
-            level = await conn.fetchval("SELECT level FROM upgrades WHERE user_id = $1 AND upgrade_id = $2", uid, up_id)
-            ups[up_id] = level if level is not None else 0
-        total_exp = (lvl - 1) * EXP_PER_LEVEL + exp
-        return {
-            'level': lvl, 
-            'exp': exp, 
-            'total_exp': total_exp,
-            'exp_next': EXP_PER_LEVEL,
-            'gold': gold, 
-            'clicks': clicks, 
-            'total_gold': tg,
-            'total_crits': crits, 
-            'current_crit_streak': cstreak,
-            'max_crit_streak': mstreak, 
-            'upgrades': ups,
-            'perm_tool_power_bonus': perm_tool_bonus,
-            'perm_crit_bonus': perm_crit_bonus
-        }
+        levels = json.loads(row['upgrades'])
+        return build_stats(row, {up_id: levels.get(up_id, 0) for up_id in UPGRADES})
 
     if conn is None:
-        async with db_pool.acquire() as conn:
-            return await _get(conn)
+        state = await get_player_state(uid)
+        return state.stats() if state is not None else {}
     else:
         return await _get(conn)
 
+def build_stats(row, ups: dict) -> dict:
+    """Собирает словарь статистики из строки players и уровней улучшений."""
+    lvl, exp = row['level'], row['exp']
+    return {
+        'level': lvl,
+        'exp': exp,
+        'total_exp': (lvl - 1) * EXP_PER_LEVEL + exp,
+        'exp_next': EXP_PER_LEVEL,
+        'gold': row['gold'],
+        'clicks': row['total_clicks'],
+        'total_gold': row['total_gold_earned'],
+        'total_crits': row['total_crits'],
+        'current_crit_streak': row['current_crit_streak'],
+        'max_crit_streak': row['max_crit_streak'],
+        'upgrades': {up_id: ups.get(up_id, 0) for up_id in UPGRADES},
+        'perm_tool_power_bonus': row['perm_tool_power_bonus'],
+        'perm_crit_bonus': row['perm_crit_bonus']
+    }
+
 async def update_player(uid: int, conn: asyncpg.Connection = None, **kwargs):
     if not kwargs:
         return
@@ -721,10 +1969,11 @@ async def update_player(uid: int, conn: asyncpg.Connection = None, **kwargs):
         await conn.execute(f"UPDATE players SET {set_clause} WHERE user_id = $1", uid, *values)
 
     if conn is None:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await _update(conn)
     else:
         await _update(conn)
+    player_cache.invalidate(uid)
 
 async def level_up_if_needed(uid: int, conn: asyncpg.Connection = None):
     async def _level(conn):
@@ -736,52 +1985,91 @@ async def level_up_if_needed(uid: int, conn: asyncpg.Connection = None):
         await conn.execute("UPDATE players SET level = $1, exp = $2 WHERE user_id = $3", lvl, exp, uid)
 
     if conn is None:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await _level(conn)
     else:
         await _level(conn)
+    player_cache.invalidate(uid)
 
 # ---------- Улучшения ----------
 async def purchase_upgrade(uid: int, upgrade_id: str, conn: asyncpg.Connection = None) -> Tuple[bool, str, int]:
     async def _purchase(conn):
-        async with conn.transaction():
-            row = await conn.fetchrow("SELECT level FROM upgrades WHERE user_id=$1 AND upgrade_id=$2", uid, upgrade_id)
+        async with transaction(conn):
+            # Блокировка строки не даёт двум покупкам заплатить за один и тот же уровень
+            row = await conn.fetchrow("SELECT level FROM upgrades WHERE user_id=$1 AND upgrade_id=$2 FOR UPDATE", uid, upgrade_id)
             if not row:
                 return False, "Улучшение не найдено", 0
             level = row['level']
             price = int(UPGRADES[upgrade_id]['base_price'] * (UPGRADES[upgrade_id]['price_mult'] ** level))
-            gold = await conn.fetchval("SELECT gold FROM players WHERE user_id=$1", uid)
-            if gold < price:
-                logger.warning(f"User {uid} attempted to buy {upgrade_id} but insufficient gold: {gold} < {price}")
+            gold = await conn.fetchval(
+                "UPDATE players SET gold = gold - $1 WHERE user_id=$2 AND gold >= $1 RETURNING gold", price, uid
+            )
+            if gold is None:
+                logger.warning(f"User {uid} attempted to buy {upgrade_id} but has less than {price} gold")
                 return False, "❌ Недостаточно золота!", level
-            await conn.execute("UPDATE players SET gold = gold - $1 WHERE user_id=$2", price, uid)
             await conn.execute("UPDATE upgrades SET level = level + 1 WHERE user_id=$1 AND upgrade_id=$2", uid, upgrade_id)
         new_level = level + 1
         return True, f"✅ {UPGRADES[upgrade_id]['name']} улучшен до {new_level} уровня.", new_level
 
     if conn is None:
-        async with db_pool.acquire() as conn:
-            return await _purchase(conn)
+        async with acquire_conn() as conn:
+            result = await _purchase(conn)
     else:
-        return await _purchase(conn)
+        result = await _purchase(conn)
+    player_cache.invalidate(uid)
+    return result
+
+BUY_TOOL_SQL = """
+    WITH pay AS (
+        UPDATE players SET gold = gold - $3
+        WHERE user_id = $1 AND gold >= $3 AND level >= $4
+          AND NOT EXISTS (SELECT 1 FROM player_tools WHERE user_id = $1 AND tool_id = $2)
+        RETURNING user_id
+    )
+    INSERT INTO player_tools (user_id, tool_id, level, experience)
+    SELECT user_id, $2, 1, 0 FROM pay
+    RETURNING tool_id
+"""
+
+async def buy_tool(uid: int, tid: str, conn: asyncpg.Connection = None) -> Tuple[bool, str]:
+    """
+    Покупает инструмент одним оператором: золото, уровень и отсутствие
+    инструмента проверяются в БД, так что устаревший кэш не даст уйти в минус.
+    """
+    tool = TOOLS[tid]
+
+    async def _buy(conn):
+        if await conn.fetchval(BUY_TOOL_SQL, uid, tid, tool['price'], tool['required_level']):
+            return True, f"✅ Ты купил {tool['name']}!"
+        row = await conn.fetchrow("SELECT level, gold FROM players WHERE user_id = $1", uid)
+        if row is None or row['level'] < tool['required_level']:
+            return False, f"❌ Требуется уровень {tool['required_level']}"
+        if row['gold'] < tool['price']:
+            return False, "❌ Недостаточно золота!"
+        return False, "❌ Этот инструмент уже куплен"
+
+    if conn is None:
+        async with acquire_conn() as conn:
+            result = await _buy(conn)
+    else:
+        result = await _buy(conn)
+    player_cache.invalidate(uid)
+    return result
 
 # ---------- Задания ----------
 async def generate_daily_tasks(uid: int, conn: asyncpg.Connection = None):
     async def _gen(conn):
         today = datetime.date.today()
         await conn.execute("DELETE FROM daily_tasks WHERE user_id = $1 AND date = $2", uid, today)
-        templates = random.sample(DAILY_TASK_TEMPLATES, min(4, len(DAILY_TASK_TEMPLATES)))
-        for i, t in enumerate(templates):
-            goal = random.randint(*t['goal'])
-            desc = t['description'].format(goal)
-            await conn.execute(
-                "INSERT INTO daily_tasks (user_id, task_id, task_name, description, goal, reward_gold, reward_exp, date) VALUES ($1, $2, $3, $4, $5, $6, $7, $8)",
-                uid, i, t['name'], desc, goal, t['reward_gold'], t['reward_exp'], today
-            )
+        await conn.executemany(
+            "INSERT INTO daily_tasks (user_id, task_id, task_name, task_type, description, goal, reward_gold, reward_exp, date) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)",
+            [(uid, t['task_id'], t['task_name'], t['task_type'], t['description'], t['goal'],
+              t['reward_gold'], t['reward_exp'], today) for t in roll_tasks(DAILY_TASK_TEMPLATES)]
+        )
     if conn:
         await _gen(conn)
     else:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await _gen(conn)
 
 async def check_daily_reset(uid: int, conn: asyncpg.Connection = None) -> bool:
@@ -795,7 +2083,7 @@ async def check_daily_reset(uid: int, conn: asyncpg.Connection = None) -> bool:
         return False
 
     if conn is None:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             return await _check(conn)
     else:
         return await _check(conn)
@@ -810,60 +2098,24 @@ async def get_daily_tasks(uid: int, conn: asyncpg.Connection = None) -> list:
         return [list(row) for row in rows]
 
     if conn is None:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             return await _get(conn)
     else:
         return await _get(conn)
 
-async def update_daily_task_progress(uid: int, task_type: str, delta: int, conn: asyncpg.Connection = None):
-    async def _update(conn):
-        today = datetime.date.today()
-        await conn.execute(
-            "UPDATE daily_tasks SET progress = progress + $1 WHERE user_id = $2 AND date = $3 AND completed = FALSE AND task_name LIKE $4",
-            delta, uid, today, f'%{task_type}%'
-        )
-        rows = await conn.fetch(
-            "SELECT task_id, goal, reward_gold, reward_exp FROM daily_tasks WHERE user_id = $1 AND date = $2 AND completed = FALSE",
-            uid, today
-        )
-        for task_id, goal, rg, re in rows:
-            prog = await conn.fetchval(
-                "SELECT progress FROM daily_tasks WHERE user_id = $1 AND task_id = $2 AND date = $3",
-                uid, task_id, today
-            )
-            if prog >= goal:
-                await conn.execute(
-                    "UPDATE daily_tasks SET completed = TRUE WHERE user_id = $1 AND task_id = $2 AND date = $3",
-                    uid, task_id, today
-                )
-                await conn.execute(
-                    "UPDATE players SET gold = gold + $1, exp = exp + $2 WHERE user_id = $3",
-                    rg, re, uid
-                )
-                await level_up_if_needed(uid, conn)
-
-    if conn is None:
-        async with db_pool.acquire() as conn:
-            await _update(conn)
-    else:
-        await _update(conn)
-
 async def generate_weekly_tasks(uid: int, conn: asyncpg.Connection = None):
     async def _gen(conn):
         week = get_week_number()
         await conn.execute("DELETE FROM weekly_tasks WHERE user_id = $1 AND week = $2", uid, week)
-        templates = random.sample(WEEKLY_TASK_TEMPLATES, min(4, len(WEEKLY_TASK_TEMPLATES)))
-        for i, t in enumerate(templates):
-            goal = random.randint(*t['goal'])
-            desc = t['description'].format(goal)
-            await conn.execute(
-                "INSERT INTO weekly_tasks (user_id, task_id, task_name, description, goal, reward_gold, reward_exp, week) VALUES ($1, $2, $3, $4, $5, $6, $7, $8)",
-                uid, i, t['name'], desc, goal, t['reward_gold'], t['reward_exp'], week
-            )
+        await conn.executemany(
+            "INSERT INTO weekly_tasks (user_id, task_id, task_name, task_type, description, goal, reward_gold, reward_exp, week) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)",
+            [(uid, t['task_id'], t['task_name'], t['task_type'], t['description'], t['goal'],
+              t['reward_gold'], t['reward_exp'], week) for t in roll_tasks(WEEKLY_TASK_TEMPLATES)]
+        )
     if conn:
         await _gen(conn)
     else:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await _gen(conn)
 
 async def check_weekly_reset(uid: int, conn: asyncpg.Connection = None) -> bool:
@@ -877,7 +2129,7 @@ async def check_weekly_reset(uid: int, conn: asyncpg.Connection = None) -> bool:
         return False
 
     if conn is None:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             return await _check(conn)
     else:
         return await _check(conn)
@@ -892,96 +2144,129 @@ async def get_weekly_tasks(uid: int, conn: asyncpg.Connection = None) -> list:
         return [list(row) for row in rows]
 
     if conn is None:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             return await _get(conn)
     else:
         return await _get(conn)
 
-async def update_weekly_task_progress(uid: int, task_type: str, delta: int, conn: asyncpg.Connection = None):
-    async def _update(conn):
-        week = get_week_number()
-        await conn.execute(
-            "UPDATE weekly_tasks SET progress = progress + $1 WHERE user_id = $2 AND week = $3 AND completed = FALSE AND task_name LIKE $4",
-            delta, uid, week, f'%{task_type}%'
-        )
-        rows = await conn.fetch(
-            "SELECT task_id, goal, reward_gold, reward_exp FROM weekly_tasks WHERE user_id = $1 AND week = $2 AND completed = FALSE",
-            uid, week
+# Продвигает все незавершённые задания нужных типов (дневные и недельные)
+# и начисляет награды за выполненные — одним оператором.
+TASK_PROGRESS_SQL = queries.register('task_progress', """
+    WITH ev AS (
+        SELECT * FROM unnest($2::text[], $3::int[]) AS e(task_type, delta) WHERE delta > 0
+    ),
+    daily AS (
+        UPDATE daily_tasks t
+        SET progress = t.progress + ev.delta,
+            completed = t.progress + ev.delta >= t.goal
+        FROM ev
+        WHERE t.user_id = $1 AND t.date = $4 AND t.completed = FALSE AND t.task_type = ev.task_type
+        RETURNING t.completed, t.reward_gold, t.reward_exp
+    ),
+    weekly AS (
+        UPDATE weekly_tasks t
+        SET progress = t.progress + ev.delta,
+            completed = t.progress + ev.delta >= t.goal
+        FROM ev
+        WHERE t.user_id = $1 AND t.week = $5 AND t.completed = FALSE AND t.task_type = ev.task_type
+        RETURNING t.completed, t.reward_gold, t.reward_exp
+    ),
+    done AS (
+        SELECT COUNT(*) AS cnt,
+               COUNT(*) FILTER (WHERE kind = 'daily') AS daily_cnt,
+               COUNT(*) FILTER (WHERE kind = 'weekly') AS weekly_cnt,
+               COALESCE(SUM(reward_gold), 0)::int AS gold,
+               COALESCE(SUM(reward_exp), 0)::int AS exp
+        FROM (
+            SELECT 'daily' AS kind, * FROM daily
+            UNION ALL
+            SELECT 'weekly' AS kind, * FROM weekly
+        ) x
+        WHERE completed
+    ),
+    player AS (
+        UPDATE players p
+        SET gold = p.gold + done.gold,
+            level = p.level + (p.exp + done.exp) / $6,
+            exp = (p.exp + done.exp) % $6,
+            tasks_completed_daily = p.tasks_completed_daily + done.daily_cnt,
+            tasks_completed_weekly = p.tasks_completed_weekly + done.weekly_cnt
+        FROM done
+        WHERE p.user_id = $1 AND done.cnt > 0
+        RETURNING p.user_id
+    )
+    SELECT cnt FROM done
+""")
+
+async def advance_tasks(uid: int, events: Dict[str, int], conn: asyncpg.Connection = None) -> int:
+    """
+    Продвигает задания по событиям {тип задания: прирост},
+    например {'spent': 150}. Возвращает число выполненных заданий.
+    """
+    async def _advance(conn):
+        done = await queries.fetchval(
+            conn, 'task_progress', uid, list(events.keys()), list(events.values()),
+            datetime.date.today(), get_week_number(), EXP_PER_LEVEL
         )
-        for task_id, goal, rg, re in rows:
-            prog = await conn.fetchval(
-                "SELECT progress FROM weekly_tasks WHERE user_id = $1 AND task_id = $2 AND week = $3",
-                uid, task_id, week
-            )
-            if prog >= goal:
-                await conn.execute(
-                    "UPDATE weekly_tasks SET completed = TRUE WHERE user_id = $1 AND task_id = $2 AND week = $3",
-                    uid, task_id, week
-                )
-                await conn.execute(
-                    "UPDATE players SET gold = gold + $1, exp = exp + $2 WHERE user_id = $3",
-                    rg, re, uid
-                )
-                await level_up_if_needed(uid, conn)
+        if done:
+            after_commit(conn, functools.partial(leaderboards.add, 'tasks_completed', uid, done))
+        return done
 
     if conn is None:
-        async with db_pool.acquire() as conn:
-            await _update(conn)
+        async with acquire_conn() as conn:
+            done = await _advance(conn)
     else:
-        await _update(conn)
+        done = await _advance(conn)
+    if done:
+        player_cache.invalidate(uid)
+    return done
 
 # ---------- Инвентарь ----------
 async def get_inventory(uid: int, conn: asyncpg.Connection = None) -> dict:
     async def _get(conn):
-        rows = await conn.fetch("SELECT resource_id, amount FROM inventory WHERE user_id = $1", uid)
+        rows = await queries.fetch(conn, 'inventory_read', uid)
         return {row['resource_id']: row['amount'] for row in rows}
 
     if conn is None:
-        async with db_pool.acquire() as conn:
-            return await _get(conn)
+        state = await get_player_state(uid)
+        return state.inventory_dict() if state is not None else {}
     else:
         return await _get(conn)
 
-async def add_resource(uid: int, rid: str, amt: int = 1, conn: asyncpg.Connection = None) -> bool:
-    async def _add(conn):
-        current = await conn.fetchval("SELECT amount FROM inventory WHERE user_id=$1 AND resource_id=$2", uid, rid)
-        if current is None:
-            current = 0
-        new_amount = current + amt
-        if new_amount > MAX_RESOURCE_AMOUNT:
-            new_amount = MAX_RESOURCE_AMOUNT
-            if new_amount <= current:
-                return False
-        await conn.execute("""
-            INSERT INTO inventory (user_id, resource_id, amount)
-            VALUES ($1, $2, $3)
-            ON CONFLICT (user_id, resource_id) DO UPDATE
-            SET amount = $3
-        """, uid, rid, new_amount)
-        logger.debug(f"add_resource: user={uid}, res={rid}, added {amt}, new total={new_amount}")
-        return True
+async def apply_resource_deltas(uid: int, deltas: Dict[str, int],
+                                conn: asyncpg.Connection = None) -> Optional[Dict[str, int]]:
+    """
+    Применяет изменения ресурсов {ресурс: ±количество} одним оператором.
+    Начисления упираются в MAX_RESOURCE_AMOUNT, списания проходят только
+    если ни один остаток не уходит в минус (иначе не меняется ничего).
+    Возвращает новые остатки затронутых ресурсов или None, если списать не вышло.
+    """
+    deltas = {rid: amt for rid, amt in deltas.items() if amt}
+    if not deltas:
+        return {}
 
-    if conn is None:
-        async with db_pool.acquire() as conn:
-            async with conn.transaction():
-                return await _add(conn)
-    else:
-        return await _add(conn)
-
-async def remove_resource(uid: int, rid: str, amt: int = 1, conn: asyncpg.Connection = None) -> bool:
-    async def _remove(conn):
-        current = await conn.fetchval("SELECT amount FROM inventory WHERE user_id=$1 AND resource_id=$2", uid, rid)
-        if current is None or current < amt:
-            return False
-        await conn.execute("UPDATE inventory SET amount = amount - $1 WHERE user_id=$2 AND resource_id=$3", amt, uid, rid)
-        return True
+    async def _apply(conn):
+        rows = await queries.fetch(conn, 'resource_delta', uid, list(deltas), list(deltas.values()),
+                                   MAX_RESOURCE_AMOUNT)
+        if not rows:
+            return None
+        return {row['resource_id']: row['amount'] for row in rows}
 
     if conn is None:
-        async with db_pool.acquire() as conn:
-            async with conn.transaction():
-                return await _remove(conn)
+        async with acquire_conn() as conn:
+            result = await _apply(conn)
     else:
-        return await _remove(conn)
+        result = await _apply(conn)
+    if result is not None:
+        player_cache.invalidate(uid)
+        logger.debug(f"apply_resource_deltas: user={uid}, deltas={deltas}, new={result}")
+    return result
+
+async def add_resource(uid: int, rid: str, amt: int = 1, conn: asyncpg.Connection = None) -> bool:
+    return await apply_resource_deltas(uid, {rid: amt}, conn) is not None
+
+async def remove_resource(uid: int, rid: str, amt: int = 1, conn: asyncpg.Connection = None) -> bool:
+    return await apply_resource_deltas(uid, {rid: -amt}, conn) is not None
 
 # ---------- Инструменты ----------
 async def get_player_tools(uid: int, conn: asyncpg.Connection = None) -> dict:
@@ -990,8 +2275,8 @@ async def get_player_tools(uid: int, conn: asyncpg.Connection = None) -> dict:
         return {row['tool_id']: row['level'] for row in rows}
 
     if conn is None:
-        async with db_pool.acquire() as conn:
-            return await _get(conn)
+        state = await get_player_state(uid)
+        return dict(state.tools) if state is not None else {}
     else:
         return await _get(conn)
 
@@ -1000,10 +2285,11 @@ async def add_tool(uid: int, tid: str, conn: asyncpg.Connection = None):
         await conn.execute("INSERT INTO player_tools (user_id, tool_id, level, experience) VALUES ($1, $2, 1, 0) ON CONFLICT DO NOTHING", uid, tid)
 
     if conn is None:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await _add(conn)
     else:
         await _add(conn)
+    player_cache.invalidate(uid)
 
 async def has_tool(uid: int, tid: str, conn: asyncpg.Connection = None) -> bool:
     async def _has(conn):
@@ -1011,8 +2297,8 @@ async def has_tool(uid: int, tid: str, conn: asyncpg.Connection = None) -> bool:
         return val is not None
 
     if conn is None:
-        async with db_pool.acquire() as conn:
-            return await _has(conn)
+        state = await get_player_state(uid)
+        return state is not None and tid in state.tools
     else:
         return await _has(conn)
 
@@ -1022,8 +2308,8 @@ async def get_tool_level(uid: int, tid: str, conn: asyncpg.Connection = None) ->
         return level if level is not None else 0
 
     if conn is None:
-        async with db_pool.acquire() as conn:
-            return await _get(conn)
+        state = await get_player_state(uid)
+        return state.tools.get(tid, 0) if state is not None else 0
     else:
         return await _get(conn)
 
@@ -1039,29 +2325,29 @@ async def can_upgrade_tool(uid: int, tid: str, conn: asyncpg.Connection = None)
                 return False
         return True
 
-    if conn is None:
-        async with db_pool.acquire() as conn:
-            return await _can(conn)
-    else:
-        return await _can(conn)
+    return await _can(conn)
 
 async def upgrade_tool(uid: int, tid: str, conn: asyncpg.Connection = None) -> bool:
     async def _upgrade(conn):
-        if not await can_upgrade_tool(uid, tid, conn):
-            return False
-        level = await get_tool_level(uid, tid, conn)
-        cost = get_upgrade_cost(tid, level)
-        async with conn.transaction():
-            for res, need in cost.items():
-                await conn.execute("UPDATE inventory SET amount = amount - $1 WHERE user_id = $2 AND resource_id = $3", need, uid, res)
+        async with transaction(conn):
+            level = await conn.fetchval(
+                "SELECT level FROM player_tools WHERE user_id = $1 AND tool_id = $2 FOR UPDATE", uid, tid
+            )
+            if not level:
+                return False
+            cost = get_upgrade_cost(tid, level)
+            if await apply_resource_deltas(uid, {res: -need for res, need in cost.items()}, conn) is None:
+                return False
             await conn.execute("UPDATE player_tools SET level = level + 1 WHERE user_id = $1 AND tool_id = $2", uid, tid)
         return True
 
     if conn is None:
-        async with db_pool.acquire() as conn:
-            return await _upgrade(conn)
+        async with acquire_conn() as conn:
+            result = await _upgrade(conn)
     else:
-        return await _upgrade(conn)
+        result = await _upgrade(conn)
+    player_cache.invalidate(uid)
+    return result
 
 async def get_active_tool(uid: int, conn: asyncpg.Connection = None) -> str:
     async def _get(conn):
@@ -1069,8 +2355,8 @@ async def get_active_tool(uid: int, conn: asyncpg.Connection = None) -> str:
         return tool if tool else 'wooden_pickaxe'
 
     if conn is None:
-        async with db_pool.acquire() as conn:
-            return await _get(conn)
+        state = await get_player_state(uid)
+        return state.active_tool if state is not None else 'wooden_pickaxe'
     else:
         return await _get(conn)
 
@@ -1083,10 +2369,11 @@ async def set_active_tool(uid: int, tid: str, conn: asyncpg.Connection = None):
         await conn.execute("UPDATE players SET active_tool = $1 WHERE user_id = $2", tid, uid)
 
     if conn is None:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await _set(conn)
     else:
         await _set(conn)
+    player_cache.invalidate(uid)
 
 # ---------- Локации ----------
 async def get_player_current_location(uid: int, conn: asyncpg.Connection = None) -> str:
@@ -1095,8 +2382,8 @@ async def get_player_current_location(uid: int, conn: asyncpg.Connection = None)
         return loc if loc else 'coal_mine'
 
     if conn is None:
-        async with db_pool.acquire() as conn:
-            return await _get(conn)
+        state = await get_player_state(uid)
+        return state.current_location if state is not None else 'coal_mine'
     else:
         return await _get(conn)
 
@@ -1105,132 +2392,415 @@ async def set_player_location(uid: int, loc: str, conn: asyncpg.Connection = Non
         await conn.execute("UPDATE players SET current_location = $1 WHERE user_id = $2", loc, uid)
 
     if conn is None:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await _set(conn)
     else:
         await _set(conn)
+    player_cache.invalidate(uid)
 
 # ---------- Боссы ----------
+def boss_epoch(now: float = None) -> int:
+    """Номер текущей эпохи респауна боссов по настенным часам."""
+    if now is None:
+        now = time.time()
+    return int(now // (BOSS_RESPAWN_HOURS * 3600))
+
+def boss_state(row, boss_id: str, epoch: int) -> dict:
+    """Прогресс по боссу с учётом эпохи: строка из прошлой эпохи — босс с полным здоровьем."""
+    if row is None or row['epoch'] < epoch:
+        return {'current_health': BOSS_LOCATIONS[boss_id]['boss']['health'], 'defeated': False}
+    return {'current_health': row['current_health'], 'defeated': row['defeated']}
+
+# Удар по боссу одним оператором: строка создаётся при первом ударе и
+# лениво «респаунится», если осталась от прошлой эпохи. Для уже
+# побеждённого в этой эпохе босса ничего не меняется и строк не возвращается.
+BOSS_ATTACK_SQL = queries.register('boss_attack', """
+    INSERT INTO boss_progress AS bp (user_id, boss_id, current_health, defeated, epoch)
+    VALUES ($1, $2, GREATEST($3 - $4, 0), $3 - $4 <= 0, $5)
+    ON CONFLICT (user_id, boss_id) DO UPDATE
+    SET current_health = GREATEST(CASE WHEN bp.epoch < $5 THEN $3 ELSE bp.current_health END - $4, 0),
+        defeated = CASE WHEN bp.epoch < $5 THEN $3 ELSE bp.current_health END - $4 <= 0,
+        epoch = $5
+    WHERE bp.epoch < $5 OR (NOT bp.defeated AND bp.current_health > 0)
+    RETURNING bp.current_health, bp.defeated
+""")
+
 async def get_boss_progress(uid: int, boss_id: str, conn: asyncpg.Connection = None) -> dict:
     async def _get(conn):
-        row = await conn.fetchrow("SELECT current_health, defeated FROM boss_progress WHERE user_id=$1 AND boss_id=$2", uid, boss_id)
-        if not row:
-            health = BOSS_LOCATIONS[boss_id]['boss']['health']
-            await conn.execute("INSERT INTO boss_progress (user_id, boss_id, current_health) VALUES ($1, $2, $3)", uid, boss_id, health)
-            return {'current_health': health, 'defeated': False}
-        return dict(row)
+        row = await conn.fetchrow("SELECT current_health, defeated, epoch FROM boss_progress WHERE user_id=$1 AND boss_id=$2", uid, boss_id)
+        return boss_state(row, boss_id, boss_epoch())
 
     if conn is None:
-        async with db_pool.acquire() as conn:
-            return await _get(conn)
+        state = await get_player_state(uid)
+        return state.boss_progress(boss_id) if state is not None else boss_state(None, boss_id, boss_epoch())
     else:
         return await _get(conn)
 
+async def attack_boss(uid: int, boss_id: str, damage: int, conn: asyncpg.Connection):
+    """Наносит урон боссу. Возвращает (current_health, defeated) или None, если босс уже побеждён."""
+    max_hp = BOSS_LOCATIONS[boss_id]['boss']['health']
+    return await queries.fetchrow(conn, 'boss_attack', uid, boss_id, max_hp, damage, boss_epoch())
+
 async def update_boss_health(uid: int, boss_id: str, damage: int, conn: asyncpg.Connection = None) -> bool:
     async def _update(conn):
-        await conn.execute("SELECT current_health FROM boss_progress WHERE user_id=$1 AND boss_id=$2 FOR UPDATE", uid, boss_id)
-        await conn.execute("UPDATE boss_progress SET current_health = current_health - $1 WHERE user_id=$2 AND boss_id=$3 AND current_health > 0", damage, uid, boss_id)
-        row = await conn.fetchrow("SELECT current_health FROM boss_progress WHERE user_id=$1 AND boss_id=$2", uid, boss_id)
-        if row['current_health'] <= 0:
-            await conn.execute("UPDATE boss_progress SET defeated=TRUE, current_health=0 WHERE user_id=$1 AND boss_id=$2", uid, boss_id)
-            return True
-        return False
+        row = await attack_boss(uid, boss_id, damage, conn)
+        return row is not None and row['defeated']
 
     if conn is None:
-        async with db_pool.acquire() as conn:
-            async with conn.transaction():
-                return await _update(conn)
+        async with acquire_conn() as conn:
+            result = await _update(conn)
     else:
-        return await _update(conn)
+        result = await _update(conn)
+    player_cache.invalidate(uid)
+    return result
+
+# ---------- Исходящие сообщения ----------
+OUTBOX_ENQUEUE_SQL = queries.register('outbox_enqueue', """
+    INSERT INTO outbox (chat_id, kind, text, parse_mode) VALUES ($1, $2, $3, $4)
+""")
+
+# Забирает созревшие строки и продлевает их аренду: параллельные экземпляры
+# пропускают заблокированные строки, а после падения строки вернутся в очередь
+OUTBOX_CLAIM_SQL = queries.register('outbox_claim', """
+    WITH due AS (
+        SELECT id FROM outbox
+        WHERE next_attempt_at <= NOW()
+        ORDER BY next_attempt_at, id
+        LIMIT $1
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE outbox o
+    SET next_attempt_at = NOW() + make_interval(secs => $2)
+    FROM due
+    WHERE o.id = due.id
+    RETURNING o.id, o.chat_id, o.kind, o.text, o.parse_mode, o.attempts
+""")
+
+async def enqueue_message(chat_id: int, text: str, kind: str = 'text', parse_mode: str = None,
+                          conn: asyncpg.Connection = None):
+    """
+    Ставит сообщение в outbox. С переданным conn запись попадает в ту же
+    транзакцию, что и игровое изменение, и уйдёт только после её коммита.
+    """
+    if conn is None:
+        async with acquire_conn() as conn:
+            await queries.fetch(conn, 'outbox_enqueue', chat_id, kind, text, parse_mode)
+    else:
+        await queries.fetch(conn, 'outbox_enqueue', chat_id, kind, text, parse_mode)
 
-async def check_and_reset_bosses(conn: asyncpg.Connection):
-    row = await conn.fetchrow("SELECT last_boss_reset FROM global_state WHERE id = 1")
-    if not row:
-        await conn.execute("INSERT INTO global_state (id, last_boss_reset) VALUES (1, NOW())")
-        return
-    last_reset = row['last_boss_reset']
-    now = datetime.datetime.now()
-    if last_reset is None or (now - last_reset) > datetime.timedelta(hours=6):
-        for boss_id, bloc in BOSS_LOCATIONS.items():
-            max_hp = bloc['boss']['health']
-            await conn.execute("""
-                UPDATE boss_progress
-                SET current_health = $1, defeated = false
-                WHERE boss_id = $2
-            """, max_hp, boss_id)
-        await conn.execute("UPDATE global_state SET last_boss_reset = $1 WHERE id = 1", now)
-        logger.info(f"Bosses reset at {now}")
+def outbox_backoff(attempts: int) -> float:
+    delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+def coalesce_outbox(rows) -> Dict[int, List[dict]]:
+    """
+    Раскладывает строки outbox по чатам в порядке id. Уведомления о
+    достижениях одного чата склеиваются в одно сообщение (на месте первого),
+    пока оно укладывается в лимит длины Telegram.
+    """
+    chats: Dict[int, List[dict]] = {}
+    merged: Dict[int, dict] = {}  # chat_id -> открытое сообщение с достижениями
+    for row in sorted(rows, key=lambda r: r['id']):
+        chat_id = row['chat_id']
+        queue = chats.setdefault(chat_id, [])
+        if row['kind'] == 'achievement':
+            msg = merged.get(chat_id)
+            if (msg is not None and msg['parse_mode'] == row['parse_mode']
+                    and len(msg['text']) + 2 + len(row['text']) <= TELEGRAM_MAX_MESSAGE_LENGTH):
+                msg['ids'].append(row['id'])
+                msg['text'] += '\n\n' + row['text']
+                msg['attempts'] = max(msg['attempts'], row['attempts'])
+                continue
+        msg = {'ids': [row['id']], 'text': row['text'], 'parse_mode': row['parse_mode'],
+               'attempts': row['attempts']}
+        if row['kind'] == 'achievement':
+            merged[chat_id] = msg
+        queue.append(msg)
+    return chats
+
+class OutboxDispatcher:
+    """
+    Фоновая отправка сообщений из outbox. Строки забираются пачками,
+    раскладываются по чатам (см. coalesce_outbox) и отправляются по token
+    bucket на бота и на каждый чат; сообщения одного чата уходят строго по
+    очереди. Отправленные строки удаляются, неудачные откладываются с
+    экспоненциальной задержкой (на RetryAfter – ровно на указанное время).
+    Доставка «хотя бы раз»: если процесс упадёт между отправкой и удалением,
+    сообщение повторится после OUTBOX_LEASE_SECONDS.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float):
+        self.global_limit = RateLimiter(global_rate)
+        self.chat_limit = RateLimiter(chat_rate, chat_burst)
+        self.tick = 1 / global_rate
+        self.bot = None
+        self.counters = {'sent': 0, 'retried': 0, 'dropped': 0}
+        self._stop = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def _send(self, chat_id: int, msg: dict, done: List[int], retry: list):
+        try:
+            await self.bot.send_message(chat_id=chat_id, text=msg['text'], parse_mode=msg['parse_mode'])
+        except RetryAfter as e:
+            # Флуд-контроль Telegram: ждём сколько сказано, попытку не засчитываем
+            retry.append((msg['ids'], 0, float(e.retry_after)))
+            self.counters['retried'] += 1
+        except (Forbidden, BadRequest) as e:
+            # Бот заблокирован, чат не найден или текст не принят – повтор не поможет
+            logger.warning(f"Outbox message to {chat_id} dropped: {e}")
+            done.extend(msg['ids'])
+            self.counters['dropped'] += 1
+        except TelegramError as e:
+            attempts = msg['attempts'] + 1
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                logger.error(f"Outbox message to {chat_id} dropped after {attempts} attempts: {e}")
+                done.extend(msg['ids'])
+                self.counters['dropped'] += 1
+            else:
+                retry.append((msg['ids'], 1, outbox_backoff(attempts)))
+                self.counters['retried'] += 1
+        else:
+            done.extend(msg['ids'])
+            self.counters['sent'] += 1
+
+    async def _drain(self, chats: Dict[int, List[dict]], done: List[int], retry: list):
+        inflight: Dict[int, asyncio.Task] = {}
+        while chats or inflight:
+            for chat_id in list(chats):
+                if chat_id in inflight or not self.chat_limit.allow(chat_id):
+                    continue
+                if not self.global_limit.allow(0):
+                    self.chat_limit.give_back(chat_id)
+                    break
+                queue = chats[chat_id]
+                msg = queue.pop(0)
+                if not queue:
+                    del chats[chat_id]
+                inflight[chat_id] = asyncio.create_task(self._send(chat_id, msg, done, retry))
+            if inflight:
+                await asyncio.wait(inflight.values(), timeout=self.tick, return_when=asyncio.FIRST_COMPLETED)
+                for chat_id in [c for c, t in inflight.items() if t.done()]:
+                    del inflight[chat_id]
+            else:
+                await asyncio.sleep(self.tick)
+
+    async def dispatch(self) -> int:
+        """Отправляет одну пачку созревших сообщений. Возвращает размер пачки."""
+        async with acquire_conn() as conn:
+            rows = await queries.fetch(conn, 'outbox_claim', OUTBOX_BATCH_SIZE, float(OUTBOX_LEASE_SECONDS))
+        if not rows:
+            return 0
+        done: List[int] = []
+        retry: List[Tuple[List[int], int, float]] = []
+        await self._drain(coalesce_outbox(rows), done, retry)
+        async with acquire_conn() as conn:
+            async with transaction(conn):
+                if done:
+                    await conn.execute("DELETE FROM outbox WHERE id = ANY($1::bigint[])", done)
+                if retry:
+                    await conn.execute('''
+                        UPDATE outbox o
+                        SET attempts = o.attempts + r.inc,
+                            next_attempt_at = NOW() + make_interval(secs => r.delay)
+                        FROM unnest($1::bigint[], $2::int[], $3::float8[]) AS r(id, inc, delay)
+                        WHERE o.id = r.id
+                    ''',
+                        [i for ids, _, _ in retry for i in ids],
+                        [inc for ids, inc, _ in retry for _ in ids],
+                        [delay for ids, _, delay in retry for _ in ids])
+        return len(rows)
+
+    async def _run(self):
+        while not self._stop.is_set():
+            try:
+                claimed = await self.dispatch()
+            except Exception as e:
+                logger.error(f"Outbox dispatch failed: {e}", exc_info=True)
+                claimed = 0
+            if claimed < OUTBOX_BATCH_SIZE:
+                try:
+                    await asyncio.wait_for(self._stop.wait(), OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+    def start(self, bot):
+        self.bot = bot
+        if self._task is None:
+            self._stop.clear()
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self, timeout: float = 10.0):
+        """Дожидается текущей пачки (не дольше timeout) и останавливает диспетчер."""
+        if self._task is None:
+            return
+        self._stop.set()
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Outbox dispatcher stopped mid-batch; unsent rows will be retried after the lease")
+        self._task = None
+
+    def stats(self) -> dict:
+        return dict(self.counters)
+
+outbox = OutboxDispatcher(OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST)
 
 # ---------- Достижения ----------
 async def get_achievements_data(uid: int, conn: asyncpg.Connection = None) -> Tuple[set, int, int]:
     async def _get(conn):
         unlocked_rows = await conn.fetch("SELECT achievement_id FROM user_achievements WHERE user_id = $1", uid)
         unlocked = {row['achievement_id'] for row in unlocked_rows}
-        daily_completed = await conn.fetchval("SELECT COUNT(*) FROM daily_tasks WHERE user_id = $1 AND completed = TRUE", uid) or 0
-        weekly_completed = await conn.fetchval("SELECT COUNT(*) FROM weekly_tasks WHERE user_id = $1 AND completed = TRUE", uid) or 0
-        return unlocked, daily_completed, weekly_completed
+        row = await conn.fetchrow(
+            "SELECT tasks_completed_daily, tasks_completed_weekly FROM players WHERE user_id = $1", uid
+        )
+        if not row:
+            return unlocked, 0, 0
+        return unlocked, row['tasks_completed_daily'], row['tasks_completed_weekly']
 
     if conn is None:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             return await _get(conn)
     else:
         return await _get(conn)
 
-async def unlock_achievement(uid: int, ach_id: str, gold: int, exp: int, progress: int, max_progress: int, conn: asyncpg.Connection = None):
+ACHIEVEMENT_UNLOCK_SQL = queries.register('achievement_unlock', """
+    WITH src AS (
+        SELECT * FROM unnest($3::text[], $4::int[], $5::int[], $6::int[], $7::int[])
+            AS a(achievement_id, progress, max_progress, reward_gold, reward_exp)
+    ),
+    ins AS (
+        INSERT INTO user_achievements (user_id, achievement_id, unlocked_at, progress, max_progress)
+        SELECT $1, achievement_id, $2, progress, max_progress FROM src
+        ON CONFLICT DO NOTHING
+        RETURNING achievement_id
+    ),
+    rw AS (
+        SELECT COALESCE(SUM(src.reward_gold), 0)::int AS gold, COALESCE(SUM(src.reward_exp), 0)::int AS exp
+        FROM ins JOIN src USING (achievement_id)
+    )
+    UPDATE players p
+    SET gold = p.gold + rw.gold,
+        level = p.level + (p.exp + rw.exp) / $8,
+        exp = (p.exp + rw.exp) % $8
+    FROM rw
+    WHERE p.user_id = $1
+    RETURNING p.level, p.exp, p.gold,
+              (SELECT COALESCE(array_agg(achievement_id), '{}') FROM ins) AS inserted
+""")
+
+async def unlock_achievements(uid: int, unlocks: List[Tuple[Achievement, int, int]], conn: asyncpg.Connection = None):
+    """
+    Открывает несколько достижений одним запросом и начисляет награды
+    (с повышением уровня в закрытой форме). Награда выдаётся только за
+    действительно вставленные строки. Возвращает (level, exp, gold,
+    inserted – id реально открытых сейчас достижений) или None.
+    """
+    if not unlocks:
+        return None
     today = datetime.date.today()
+    args = (
+        uid, today,
+        [ach.id for ach, _, _ in unlocks],
+        [prog for _, prog, _ in unlocks],
+        [maxp for _, _, maxp in unlocks],
+        [ach.reward_gold for ach, _, _ in unlocks],
+        [ach.reward_exp for ach, _, _ in unlocks],
+        EXP_PER_LEVEL,
+    )
     async def _unlock(conn):
-        await conn.execute(
-            "INSERT INTO user_achievements (user_id, achievement_id, unlocked_at, progress, max_progress) VALUES ($1, $2, $3, $4, $5) ON CONFLICT DO NOTHING",
-            uid, ach_id, today, progress, max_progress
-        )
-        await conn.execute(
-            "UPDATE players SET gold = gold + $1, exp = exp + $2 WHERE user_id = $3",
-            gold, exp, uid
-        )
-        await level_up_if_needed(uid, conn)
+        row = await queries.fetchrow(conn, 'achievement_unlock', *args)
+        if row is not None and row['inserted']:
+            after_commit(conn, functools.partial(leaderboards.add, 'achievements', uid, len(row['inserted'])))
+        return row
 
     if conn is None:
-        async with db_pool.acquire() as conn:
-            async with conn.transaction():
-                await _unlock(conn)
+        async with acquire_conn() as conn:
+            row = await _unlock(conn)
     else:
-        await _unlock(conn)
+        row = await _unlock(conn)
+    player_cache.invalidate(uid)
+    return row
 
 def evaluate_achievement(ach: Achievement, uid: int, data: dict) -> tuple[bool, int, int]:
-    return ach.condition_func(uid, data)
+    value = ACHIEVEMENT_METRICS[ach.metric](data)
+    return value >= ach.threshold, value, ach.threshold
 
-async def check_achievements(uid: int, ctx: ContextTypes.DEFAULT_TYPE = None, conn: asyncpg.Connection = None):
-    stats = await get_player_stats(uid, conn)
-    inv = await get_inventory(uid, conn)
-    inv_total = sum(inv.values())
-    tools = await get_player_tools(uid, conn)
-    unlocked, daily_completed, weekly_completed = await get_achievements_data(uid, conn)
+def find_new_achievements(uid: int, data: dict, unlocked: int, metrics=None) -> List[Tuple[Achievement, int, int]]:
+    """
+    Возвращает [(достижение, прогресс, цель)] для выполненных, но ещё не
+    открытых достижений. unlocked — битовая маска открытых, metrics —
+    изменившиеся метрики (по умолчанию все).
+    """
+    new_ach = []
+    for metric in ACHIEVEMENT_INDEX.pending(unlocked, metrics):
+        value = ACHIEVEMENT_METRICS[metric](data)
+        crossed = ACHIEVEMENT_INDEX.crossed(metric, value, unlocked)
+        if crossed:
+            new_ach.extend((ach, value, ach.threshold) for ach in ACHIEVEMENT_INDEX.unpack(crossed))
+    return new_ach
+
+async def notify_achievements(uid: int, new_ach: List[Achievement], conn: asyncpg.Connection = None):
+    """Ставит уведомления в outbox; диспетчер склеит их в одно сообщение."""
+    for ach in new_ach:
+        txt = f"🏆 Достижение получено: {ach.name}\n{ach.description}"
+        if ach.reward_gold > 0 or ach.reward_exp > 0:
+            txt += f"\nНаграда: {ach.reward_gold}💰, {ach.reward_exp}✨"
+        await enqueue_message(uid, txt, kind='achievement', conn=conn)
+
+async def check_achievements(uid: int, ctx: ContextTypes.DEFAULT_TYPE = None, conn: asyncpg.Connection = None,
+                             metrics=None):
+    """
+    Проверяет достижения по изменившимся метрикам (по умолчанию — по всем).
+    С ctx уведомления о новых достижениях пишутся в outbox в той же
+    транзакции, что и сами достижения.
+    """
+    if conn is None:
+        state = await get_player_state(uid)
+        if state is None:
+            return 0
+        metrics = ACHIEVEMENT_INDEX.pending(state.achievements, metrics)
+        if not metrics:
+            return 0
+        unlocked = state.achievements
+        stats, inv, tools = state.stats(), state.inventory_dict(), dict(state.tools)
+        if 'tasks_completed' in metrics:
+            _, daily_completed, weekly_completed = await get_achievements_data(uid)
+        else:
+            daily_completed = weekly_completed = 0
+    else:
+        stats = await get_player_stats(uid, conn)
+        inv = await get_inventory(uid, conn)
+        tools = await get_player_tools(uid, conn)
+        unlocked_ids, daily_completed, weekly_completed = await get_achievements_data(uid, conn)
+        unlocked = ACHIEVEMENT_INDEX.mask(unlocked_ids)
 
     data = {
         'stats': stats,
-        'inv_total': inv_total,
+        'inv_total': sum(inv.values()),
         'inv': inv,
         'tools': tools,
         'daily_completed': daily_completed,
         'weekly_completed': weekly_completed
     }
 
-    new_ach = []
-    for ach in ACHIEVEMENTS:
-        if ach.id in unlocked:
-            continue
-        achieved, prog, maxp = evaluate_achievement(ach, uid, data)
-        if achieved:
-            await unlock_achievement(uid, ach.id, ach.reward_gold, ach.reward_exp, prog, maxp, conn)
-            new_ach.append(ach)
-
-    if ctx is not None:
-        for ach in new_ach:
-            txt = f"🏆 Достижение получено: {ach.name}\n{ach.description}"
-            if ach.reward_gold > 0 or ach.reward_exp > 0:
-                txt += f"\nНаграда: {ach.reward_gold}💰, {ach.reward_exp}✨"
-            await ctx.bot.send_message(chat_id=uid, text=txt)
-    return len(new_ach)
+    new_ach = find_new_achievements(uid, data, unlocked, metrics)
+    if not new_ach:
+        return 0
+
+    async def _unlock(conn):
+        async with transaction(conn):
+            row = await unlock_achievements(uid, new_ach, conn)
+            # Параллельная проверка могла открыть часть достижений раньше нас
+            inserted = set(row['inserted']) if row is not None else set()
+            if ctx is not None and inserted:
+                await notify_achievements(uid, [ach for ach, _, _ in new_ach if ach.id in inserted], conn)
+            return len(inserted)
+
+    if conn is None:
+        async with acquire_conn() as conn:
+            return await _unlock(conn)
+    else:
+        return await _unlock(conn)
 
 async def send_achievements(uid: int, ctx: ContextTypes.DEFAULT_TYPE):
     await get_player(uid, None)
@@ -1264,204 +2834,9 @@ async def send_achievements(uid: int, ctx: ContextTypes.DEFAULT_TYPE):
             if ach.reward_gold > 0 or ach.reward_exp > 0:
                 text += f"   🎁 Награда: {ach.reward_gold}💰, {ach.reward_exp}✨\n"
             text += "\n"
+    await release_request_connection()
     await ctx.bot.send_message(chat_id=uid, text=text, parse_mode='Markdown')
 
-# ==================== КРАФТ (РЕЦЕПТЫ) ====================
-
-CRAFT_RECIPES = {
-    # Категория: зелья
-    'speed_potion': {
-        'name': '⚗️ Зелье скорости',
-        'description': '➕50% к опыту на 30 минут',
-        'category': 'potions',
-        'resources': {'coal': 5, 'iron': 2, 'magic_essence': 1},
-        'result_item_id': 'speed_potion',
-        'result_type': 'consumable',
-        'effect': {'exp_multiplier': 1.5},
-        'duration': 1800  # в секундах
-    },
-    'luck_elixir': {
-        'name': '🍀 Эликсир удачи',
-        'description': '➕10% к шансу крита на 1 час',
-        'category': 'potions',
-        'resources': {'gold': 3, 'diamond': 2, 'dragon_scale': 1},
-        'result_item_id': 'luck_elixir',
-        'result_type': 'consumable',
-        'effect': {'crit_chance_bonus': 10},
-        'duration': 3600
-    },
-    # Категория: ключи
-    'goblin_key': {
-        'name': '🔑 Ключ от логова гоблинов',
-        'description': 'Позволяет сразиться с Королём гоблинов ещё раз',
-        'category': 'keys',
-        'resources': {'coal': 50, 'iron': 20, 'gold': 5},
-        'result_item_id': 'goblin_key',
-        'result_type': 'key',
-        'effect': {'boss_id': 'goblin_king'}
-    },
-    'dragon_key': {
-        'name': '🔑 Ключ от логова дракона',
-        'description': 'Позволяет сразиться с Огненным драконом ещё раз',
-        'category': 'keys',
-        'resources': {'diamond': 30, 'soul_shard': 10, 'dragon_scale': 3},
-        'result_item_id': 'dragon_key',
-        'result_type': 'key',
-        'effect': {'boss_id': 'dragon_lair'}
-    },
-    'lich_key': {
-        'name': '🔑 Ключ от цитадели лича',
-        'description': 'Позволяет сразиться с Архиличем ещё раз',
-        'category': 'keys',
-        'resources': {'mithril': 20, 'magic_essence': 15, 'dragon_scale': 5},
-        'result_item_id': 'lich_key',
-        'result_type': 'key',
-        'effect': {'boss_id': 'lich_castle'}
-    },
-    # Категория: модификаторы для инструментов (постоянные)
-    'sharp_teeth': {
-        'name': '⚔️ Острые зубья',
-        'description': '➕2 к силе активного инструмента (постоянно)',
-        'category': 'mods',
-        'resources': {'iron': 20, 'gold': 10, 'diamond': 5},
-        'result_item_id': 'sharp_teeth',
-        'result_type': 'permanent',
-        'effect': {'tool_power_bonus': 2}
-    },
-    'magic_rune': {
-        'name': '🔮 Магическая руна',
-        'description': '➕5% к шансу двойной добычи (постоянно)',
-        'category': 'mods',
-        'resources': {'mithril': 10, 'soul_shard': 3, 'dragon_scale': 2},
-        'result_item_id': 'magic_rune',
-        'result_type': 'permanent',
-        'effect': {'crit_chance_bonus_permanent': 5}
-    },
-    # Категория: конвертация
-    'gold_ore_craft': {
-        'name': '🪙 Синтез золотой руды',
-        'description': 'Преобразовать 10 угля + 5 железа в 1 золотую руду',
-        'category': 'conversion',
-        'resources': {'coal': 10, 'iron': 5},
-        'result_item_id': 'gold',
-        'result_type': 'resource',
-        'effect': {'resource_id': 'gold', 'amount': 1}
-    },
-    'diamond_craft': {
-        'name': '💎 Синтез алмаза',
-        'description': 'Преобразовать 20 золота + 10 железа в 1 алмаз',
-        'category': 'conversion',
-        'resources': {'gold': 20, 'iron': 10},
-        'result_item_id': 'diamond',
-        'result_type': 'resource',
-        'effect': {'resource_id': 'diamond', 'amount': 1}
-    },
-    'mithril_craft': {
-        'name': '🔮 Синтез мифрила',
-        'description': 'Преобразовать 30 алмазов + 15 золота в 1 мифрил',
-        'category': 'conversion',
-        'resources': {'diamond': 30, 'gold': 15},
-        'result_item_id': 'mithril',
-        'result_type': 'resource',
-        'effect': {'resource_id': 'mithril', 'amount': 1}
-    },
-}
-
-category_map = {
-    'potions': '⚗️ Зелья',
-    'keys': '🔑 Ключи',
-    'mods': '⚔️ Модификаторы',
-    'conversion': '🔄 Конвертация ресурсов'
-}
-
-# ---------- Предметы (крафт) ----------
-async def get_player_items(uid: int, conn: asyncpg.Connection = None) -> dict:
-    async def _get(conn):
-        rows = await conn.fetch("SELECT item_id, quantity FROM player_items WHERE user_id = $1", uid)
-        return {row['item_id']: row['quantity'] for row in rows}
-    if conn:
-        return await _get(conn)
-    else:
-        async with db_pool.acquire() as conn:
-            return await _get(conn)
-
-async def add_item(uid: int, item_id: str, quantity: int = 1, expires_at: datetime.datetime = None, conn: asyncpg.Connection = None):
-    async def _add(conn):
-        if expires_at:
-            await conn.execute("""
-                INSERT INTO player_items (user_id, item_id, quantity, expires_at)
-                VALUES ($1, $2, $3, $4)
-                ON CONFLICT (user_id, item_id) DO UPDATE
-                SET quantity = player_items.quantity + EXCLUDED.quantity
-            """, uid, item_id, quantity, expires_at)
-        else:
-            await conn.execute("""
-                INSERT INTO player_items (user_id, item_id, quantity)
-                VALUES ($1, $2, $3)
-                ON CONFLICT (user_id, item_id) DO UPDATE
-                SET quantity = player_items.quantity + EXCLUDED.quantity
-            """, uid, item_id, quantity)
-    if conn:
-        await _add(conn)
-    else:
-        async with db_pool.acquire() as conn:
-            async with conn.transaction():
-                await _add(conn)
-
-async def remove_item(uid: int, item_id: str, quantity: int = 1, conn: asyncpg.Connection = None) -> bool:
-    async def _remove(conn):
-        cur = await conn.fetchval("SELECT quantity FROM player_items WHERE user_id = $1 AND item_id = $2", uid, item_id)
-        if not cur or cur < quantity:
-            return False
-        new_qty = cur - quantity
-        if new_qty == 0:
-            await conn.execute("DELETE FROM player_items WHERE user_id = $1 AND item_id = $2", uid, item_id)
-        else:
-            await conn.execute("UPDATE player_items SET quantity = $1 WHERE user_id = $2 AND item_id = $3", new_qty, uid, item_id)
-        return True
-    if conn:
-        return await _remove(conn)
-    else:
-        async with db_pool.acquire() as conn:
-            async with conn.transaction():
-                return await _remove(conn)
-
-async def craft_item(uid: int, recipe_id: str, conn: asyncpg.Connection = None) -> Tuple[bool, str]:
-    recipe = CRAFT_RECIPES.get(recipe_id)
-    if not recipe:
-        return False, "Рецепт не найден"
-    
-    async def _craft(conn):
-        inv = await get_inventory(uid, conn)
-        for res, need in recipe['resources'].items():
-            if inv.get(res, 0) < need:
-                return False, f"Недостаточно {RESOURCES[res]['name']}"
-        
-        for res, need in recipe['resources'].items():
-            await remove_resource(uid, res, need, conn)
-        
-        result_type = recipe.get('result_type')
-        if result_type == 'resource':
-            await add_resource(uid, recipe['effect']['resource_id'], recipe['effect']['amount'], conn)
-            return True, f"✅ Создано: {recipe['effect']['amount']} {RESOURCES[recipe['effect']['resource_id']]['name']}"
-        elif result_type in ('consumable', 'key', 'permanent'):
-            if recipe.get('duration'):
-                expires_at = datetime.datetime.now() + datetime.timedelta(seconds=recipe['duration'])
-            else:
-                expires_at = None
-            await add_item(uid, recipe['result_item_id'], 1, expires_at, conn)
-            return True, f"✅ Создано: {recipe['name']}"
-        else:
-            return False, "Неизвестный тип результата"
-    
-    if conn:
-        async with conn.transaction():
-            return await _craft(conn)
-    else:
-        async with db_pool.acquire() as conn:
-            async with conn.transaction():
-                return await _craft(conn)
-
 # ==================== ЭФФЕКТЫ (БАФФЫ) ====================
 
 async def apply_effect(uid: int, effect_id: str, effect_data: dict, duration: int, conn: asyncpg.Connection = None):
@@ -1477,8 +2852,9 @@ async def apply_effect(uid: int, effect_id: str, effect_data: dict, duration: in
     if conn:
         await _apply(conn)
     else:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await _apply(conn)
+    player_cache.invalidate(uid)
 
 async def get_active_effects(uid: int, conn: asyncpg.Connection = None) -> dict:
     """Возвращает словарь активных эффектов игрока."""
@@ -1494,112 +2870,666 @@ async def get_active_effects(uid: int, conn: asyncpg.Connection = None) -> dict:
     if conn:
         return await _get(conn)
     else:
-        async with db_pool.acquire() as conn:
-            return await _get(conn)
+        state = await get_player_state(uid)
+        return state.active_effects() if state is not None else {}
 
 # ==================== ОБЩАЯ ЛОГИКА КЛИКА ====================
 
-async def process_click(uid: int, conn: asyncpg.Connection = None) -> dict:
+# Всё, что нужно клику, одним запросом
+CLICK_CONTEXT_SQL = queries.register('click_context', f"""
+    SELECT p.level, p.exp, p.gold, p.total_clicks, p.total_gold_earned, p.total_crits,
+           p.current_crit_streak, p.max_crit_streak, p.perm_tool_power_bonus, p.perm_crit_bonus,
+           p.current_location, p.active_tool,
+           COALESCE((SELECT json_object_agg(upgrade_id, level) FROM upgrades WHERE user_id = p.user_id), '{{}}') AS upgrades,
+           COALESCE((SELECT json_object_agg(tool_id, level) FROM player_tools WHERE user_id = p.user_id), '{{}}') AS tools,
+           {INVENTORY_ARRAY_SQL} AS inventory,
+           COALESCE((SELECT json_agg(effect_data) FROM active_effects WHERE user_id = p.user_id AND expires_at > NOW()), '[]') AS effects,
+           ARRAY(SELECT achievement_id FROM user_achievements WHERE user_id = p.user_id) AS unlocked,
+           p.tasks_completed_daily AS daily_completed,
+           p.tasks_completed_weekly AS weekly_completed
+    FROM players p
+    WHERE p.user_id = $1
+""")
+
+# Вся запись результата кликов одним оператором для любого числа игроков:
+# задания и награды за них, ресурсы с ограничением MAX_RESOURCE_AMOUNT,
+# уровень и серия критов.
+CLICK_COMMIT_SQL = queries.register('click_commit', f"""
+    WITH d AS (
+        SELECT * FROM unnest($1::bigint[], $2::int[], $3::int[], $4::int[], $5::int[],
+                             $6::bool[], $7::int[], $8::int[], $9::int[], $10::int[])
+            AS d(user_id, gold, exp, clicks, crits, all_crit, leading, trailing, longest, resources)
+    ),
+    daily AS (
+        UPDATE daily_tasks t
+        SET progress = t.progress + x.delta,
+            completed = t.progress + x.delta >= t.goal
+        FROM (
+            SELECT d.user_id, v.task_type, v.delta
+            FROM d CROSS JOIN LATERAL (VALUES ('clicks', d.clicks), ('gold_earned', d.gold),
+                                              ('crits', d.crits), ('resources', d.resources)) AS v(task_type, delta)
+        ) x
+        WHERE t.user_id = x.user_id AND t.date = $14 AND t.completed = FALSE
+          AND x.delta > 0 AND t.task_type = x.task_type
+        RETURNING t.user_id, t.completed, t.reward_gold, t.reward_exp
+    ),
+    weekly AS (
+        UPDATE weekly_tasks t
+        SET progress = t.progress + x.delta,
+            completed = t.progress + x.delta >= t.goal
+        FROM (
+            SELECT d.user_id, v.task_type, v.delta
+            FROM d CROSS JOIN LATERAL (VALUES ('clicks', d.clicks), ('gold_earned', d.gold),
+                                              ('crits', d.crits), ('resources', d.resources)) AS v(task_type, delta)
+        ) x
+        WHERE t.user_id = x.user_id AND t.week = $15 AND t.completed = FALSE
+          AND x.delta > 0 AND t.task_type = x.task_type
+        RETURNING t.user_id, t.completed, t.reward_gold, t.reward_exp
+    ),
+    rewards AS (
+        SELECT user_id,
+               SUM(reward_gold)::int AS gold,
+               SUM(reward_exp)::int AS exp,
+               COUNT(*) FILTER (WHERE kind = 'daily') AS daily_done,
+               COUNT(*) FILTER (WHERE kind = 'weekly') AS weekly_done
+        FROM (
+            SELECT 'daily' AS kind, * FROM daily
+            UNION ALL
+            SELECT 'weekly' AS kind, * FROM weekly
+        ) done
+        WHERE completed
+        GROUP BY user_id
+    ),
+    {CLICK_INVENTORY_CTE}
+    player AS (
+        UPDATE players p
+        SET {CLICK_INVENTORY_SET}gold = p.gold + d.gold + COALESCE(rw.gold, 0),
+            level = p.level + (p.exp + d.exp + COALESCE(rw.exp, 0)) / $17,
+            exp = (p.exp + d.exp + COALESCE(rw.exp, 0)) % $17,
+            total_clicks = p.total_clicks + d.clicks,
+            total_gold_earned = p.total_gold_earned + d.gold,
+            total_crits = p.total_crits + d.crits,
+            tasks_completed_daily = p.tasks_completed_daily + COALESCE(rw.daily_done, 0),
+            tasks_completed_weekly = p.tasks_completed_weekly + COALESCE(rw.weekly_done, 0),
+            current_crit_streak = CASE WHEN d.all_crit THEN p.current_crit_streak + d.clicks ELSE d.trailing END,
+            max_crit_streak = GREATEST(p.max_crit_streak,
+                                       CASE WHEN d.leading > 0 THEN p.current_crit_streak + d.leading ELSE 0 END,
+                                       d.longest)
+        FROM d LEFT JOIN rewards rw ON rw.user_id = d.user_id
+        WHERE p.user_id = d.user_id
+        RETURNING p.user_id, p.level, p.exp, p.gold, p.total_clicks, p.total_gold_earned, p.total_crits,
+                  p.current_crit_streak, p.max_crit_streak, p.perm_tool_power_bonus, p.perm_crit_bonus{CLICK_INVENTORY_RETURNING}
+    )
+    SELECT player.*,
+           COALESCE(rw.daily_done, 0) AS daily_done,
+           COALESCE(rw.weekly_done, 0) AS weekly_done,
+           {CLICK_INVENTORY_RESULT} AS inventory
+    FROM player LEFT JOIN rewards rw ON rw.user_id = player.user_id
+""")
+
+def effect_modifiers(effects) -> Tuple[float, int]:
+    """Сводит активные эффекты к (множитель опыта, бонус к шансу крита в %)."""
+    exp_multiplier = 1.0
+    crit_bonus = 0
+    for eff in effects:
+        if 'exp_multiplier' in eff:
+            exp_multiplier *= eff['exp_multiplier']
+        if 'crit_chance_bonus' in eff:
+            crit_bonus += eff['crit_chance_bonus']
+    return exp_multiplier, crit_bonus
+
+def get_effect_reward(stats: dict, exp_multiplier: float, crit_bonus: int) -> Tuple[int, int, bool]:
+    """Награда за удар с учётом эффектов из effect_modifiers: (золото, опыт, крит)."""
+    gold, exp, is_crit = get_click_reward(stats)
+    exp = int(exp * exp_multiplier)
+    if crit_bonus:
+        extra_crit = random.random() < crit_bonus / 100
+        if extra_crit and not is_crit:
+            is_crit = True
+            gold *= 2
+            exp *= 2
+    return gold, exp, is_crit
+
+async def load_click_context(uid: int, conn: asyncpg.Connection) -> Optional[dict]:
+    """Загружает одним запросом всё состояние игрока, нужное для клика."""
+    row = await queries.fetchrow(conn, 'click_context', uid)
+    if not row:
+        return None
+    ups = json.loads(row['upgrades'])
+    tools = json.loads(row['tools'])
+    effects = [json.loads(e) if isinstance(e, str) else e for e in json.loads(row['effects'])]
+    exp_multiplier, crit_bonus = effect_modifiers(effects)
+    stats = build_stats(row, ups)
+    active_tool = row['active_tool'] or 'wooden_pickaxe'
+    tool_level = tools.get(active_tool, 0)
+    tool_power = get_tool_power(uid, active_tool, tool_level) + (stats['perm_tool_power_bonus'] or 0)
+    return {
+        'stats': stats,
+        'inv': dict(zip(RESOURCE_IDS, row['inventory'])),
+        'tools': tools,
+        'location': row['current_location'] or 'coal_mine',
+        'active_tool': active_tool,
+        'tool_power': tool_power,
+        'exp_multiplier': exp_multiplier,
+        'crit_bonus': crit_bonus,
+        'achievements': ACHIEVEMENT_INDEX.mask(row['unlocked']),
+        'daily_completed': row['daily_completed'],
+        'weekly_completed': row['weekly_completed'],
+    }
+
+def roll_click(ctx: dict) -> Tuple[int, int, bool, Optional[str], int]:
+    """Разыгрывает один клик. Возвращает (золото, опыт, крит, ресурс, количество)."""
+    loc = LOCATIONS.get(ctx['location'], LOCATIONS['coal_mine'])
+
+    # Добыча ресурса
+    rnd = random.random()
+    cum = 0
+    found = None
+    amt = 0
+    for r in loc['resources']:
+        cum += r['prob']
+        if rnd < cum:
+            found = r['res_id']
+            amt = random.randint(r['min'], r['max'])
+            break
+
+    # Базовая награда и эффекты
+    gold, exp, is_crit = get_effect_reward(ctx['stats'], ctx['exp_multiplier'], ctx['crit_bonus'])
+
+    # Модификатор от инструмента (с учётом постоянного бонуса)
+    if found and ctx['tool_power'] > 0:
+        multiplier = 1 + (ctx['tool_power'] - 1) * 0.2
+        amt = max(1, int(amt * multiplier))
+
+    return gold, exp, is_crit, found, amt
+
+def build_click_outcome(rolls) -> dict:
     """
-    Выполняет логику одного клика в транзакции.
-    Возвращает словарь с результатами.
+    Сводит последовательность кликов в итог для CLICK_COMMIT_SQL.
+    Серия критов описывается в закрытой форме: длина ведущей и хвостовой
+    серии, самая длинная серия внутри и признак «все клики — криты».
     """
-    async def _execute(conn):
-        # ----- НАЧАЛО НОВОГО КОДА (ЭФФЕКТЫ) -----
-        # Получаем активные эффекты
-        effects = await get_active_effects(uid, conn)
-        exp_multiplier = 1.0
-        crit_bonus = 0
-        for eff in effects.values():
-            if 'exp_multiplier' in eff:
-                exp_multiplier *= eff['exp_multiplier']
-            if 'crit_chance_bonus' in eff:
-                crit_bonus += eff['crit_chance_bonus']
-        # ----- КОНЕЦ НОВОГО КОДА -----
-
-        # Получаем текущую локацию
-        loc_id = await get_player_current_location(uid, conn)
-        loc = LOCATIONS.get(loc_id, LOCATIONS['coal_mine'])
-
-        # Добыча ресурса
-        rnd = random.random()
-        cum = 0
-        found = None
-        amt = 0
-        for r in loc['resources']:
-            cum += r['prob']
-            if rnd < cum:
-                found = r['res_id']
-                amt = random.randint(r['min'], r['max'])
-                break
-
-        # Базовая награда
-        stats = await get_player_stats(uid, conn)
-        gold, exp, is_crit = get_click_reward(stats)
-
-        # ----- ПРИМЕНЯЕМ ЭФФЕКТЫ К НАГРАДЕ -----
-        exp = int(exp * exp_multiplier)
-        if crit_bonus:
-            extra_crit = random.random() < crit_bonus / 100
-            if extra_crit and not is_crit:
-                is_crit = True
-                gold *= 2
-                exp *= 2
-
-        # Модификатор от инструмента
-        if found:
-            active_tool = await get_active_tool(uid, conn)
-            tool_level = await get_tool_level(uid, active_tool, conn)
-            # Учитываем постоянный бонус от модификаторов
-            tool_power = get_tool_power(uid, active_tool, tool_level) + stats.get('perm_tool_power_bonus', 0)
-            if tool_power > 0:
-                multiplier = 1 + (tool_power - 1) * 0.2
-                amt = int(amt * multiplier)
-                amt = max(1, amt)
-
-        # Обновляем игрока
-        await conn.execute("""
-            UPDATE players
-            SET gold = gold + $1,
-                exp = exp + $2,
-                total_clicks = total_clicks + 1,
-                total_gold_earned = total_gold_earned + $3,
-                total_crits = total_crits + $4,
-                current_crit_streak = CASE WHEN $5 THEN current_crit_streak + 1 ELSE 0 END,
-                max_crit_streak = GREATEST(max_crit_streak,
-                                           CASE WHEN $5 THEN current_crit_streak + 1 ELSE max_crit_streak END)
-            WHERE user_id = $6
-        """, gold, exp, gold, 1 if is_crit else 0, is_crit, uid)
-
-        # Добавляем ресурс, если найден
-        if found:
-            await add_resource(uid, found, amt, conn)
-
-        # Обновляем задания
-        await update_daily_task_progress(uid, 'Труженик', 1, conn)
-        await update_daily_task_progress(uid, 'Золотоискатель', gold, conn)
+    outcome = {'clicks': 0, 'gold': 0, 'exp': 0, 'crits': 0,
+               'leading_crits': 0, 'trailing_crits': 0, 'longest_crits': 0,
+               'resources': {}}
+    run = 0
+    leading = True
+    for gold, exp, is_crit, found, amt in rolls:
+        outcome['clicks'] += 1
+        outcome['gold'] += gold
+        outcome['exp'] += exp
         if is_crit:
-            await update_daily_task_progress(uid, 'Везунчик', 1, conn)
+            outcome['crits'] += 1
+            run += 1
+            if leading:
+                outcome['leading_crits'] = run
+            outcome['longest_crits'] = max(outcome['longest_crits'], run)
+        else:
+            run = 0
+            leading = False
         if found:
-            await update_daily_task_progress(uid, 'Рудокоп', amt, conn)
-            await update_daily_task_progress(uid, 'Горняк', amt, conn)
+            outcome['resources'][found] = outcome['resources'].get(found, 0) + amt
+    outcome['trailing_crits'] = run
+    return outcome
+
+def crit_runs(crits) -> Tuple[int, int, int]:
+    """Возвращает (ведущую, хвостовую, самую длинную) серию критов в булевом массиве."""
+    n = len(crits)
+    if crits.all():
+        return n, n, n
+    if not crits.any():
+        return 0, 0, 0
+    misses = np.flatnonzero(~crits)
+    # Границы серий — промахи; длины серий — промежутки между соседними промахами
+    gaps = np.diff(np.concatenate(([-1], misses, [n]))) - 1
+    return int(misses[0]), int(n - 1 - misses[-1]), int(gaps.max())
+
+def roll_clicks_vectorized(ctx: dict, count: int) -> dict:
+    """
+    Разыгрывает count кликов массивами numpy.
+    Распределение совпадает с roll_click: те же броски золота/опыта, крита,
+    дополнительного крита от эффектов и добычи ресурса, только за один проход.
+    """
+    stats = ctx['stats']
+    cpl = stats['upgrades']['click_power']
+    ccl = stats['upgrades']['crit_chance'] + stats.get('perm_crit_bonus', 0)
+
+    gold = click_rng.integers(BASE_CLICK_REWARD[0], BASE_CLICK_REWARD[1] + 1, count) + cpl * 2
+    exp = click_rng.integers(BASE_EXP_REWARD[0], BASE_EXP_REWARD[1] + 1, count)
+    crits = click_rng.random(count) < (ccl * 2) / 100.0
+    gold = np.where(crits, gold * 2, gold)
+    exp = np.where(crits, exp * 2, exp)
+    exp = (exp * ctx['exp_multiplier']).astype(np.int64)
+    if ctx['crit_bonus']:
+        extra = ~crits & (click_rng.random(count) < ctx['crit_bonus'] / 100)
+        gold = np.where(extra, gold * 2, gold)
+        exp = np.where(extra, exp * 2, exp)
+        crits |= extra
+
+    # Добыча: индекс ресурса по накопленной вероятности, len(resources) — ничего не найдено
+    resources = {}
+    loc = LOCATIONS.get(ctx['location'], LOCATIONS['coal_mine'])['resources']
+    if loc:
+        cum = np.cumsum([r['prob'] for r in loc])
+        picks = np.searchsorted(cum, click_rng.random(count), side='right')
+        mins = np.array([r['min'] for r in loc] + [0])
+        maxs = np.array([r['max'] for r in loc] + [0])
+        amounts = click_rng.integers(mins[picks], maxs[picks] + 1)
+        if ctx['tool_power'] > 0:
+            multiplier = 1 + (ctx['tool_power'] - 1) * 0.2
+            amounts = np.maximum(1, (amounts * multiplier).astype(np.int64))
+        totals = np.bincount(picks, weights=amounts, minlength=len(loc) + 1)
+        for r, total in zip(loc, totals[:len(loc)]):
+            if total:
+                resources[r['res_id']] = int(total)
+
+    leading, trailing, longest = crit_runs(crits)
+    return {
+        'clicks': count,
+        'gold': int(gold.sum()),
+        'exp': int(exp.sum()),
+        'crits': int(crits.sum()),
+        'leading_crits': leading,
+        'trailing_crits': trailing,
+        'longest_crits': longest,
+        'resources': resources,
+    }
 
-        await update_weekly_task_progress(uid, 'Шахтёр', 1, conn)
-        await update_weekly_task_progress(uid, 'Золотая лихорадка', gold, conn)
-        if is_crit:
-            await update_weekly_task_progress(uid, 'Критический удар', 1, conn)
-        if found:
-            await update_weekly_task_progress(uid, 'Коллекционер', amt, conn)
+def roll_clicks(ctx: dict, count: int) -> dict:
+    """Разыгрывает count кликов подряд и возвращает их итог."""
+    if np is not None and count >= CLICK_VECTOR_MIN:
+        return roll_clicks_vectorized(ctx, count)
+    return build_click_outcome(roll_click(ctx) for _ in range(count))
+
+def click_batch_result(outcome: dict, stats: dict, inv: dict) -> dict:
+    return {
+        'clicks': outcome['clicks'],
+        'gold': outcome['gold'],
+        'exp': outcome['exp'],
+        'crits': outcome['crits'],
+        'longest_crit_streak': outcome['longest_crits'],
+        'resources': outcome['resources'],
+        'new_gold': stats['gold'],
+        'new_exp': stats['exp'],
+        'new_level': stats['level'],
+        'inventory': inv
+    }
 
-        # Проверка достижений
-        await check_achievements(uid, conn=conn)
+def merge_click_outcomes(a: dict, b: dict) -> dict:
+    """Склеивает два итога кликов, идущих подряд (сначала a, затем b)."""
+    a_all = a['crits'] == a['clicks']
+    b_all = b['crits'] == b['clicks']
+    resources = dict(a['resources'])
+    for rid, amt in b['resources'].items():
+        resources[rid] = resources.get(rid, 0) + amt
+    return {
+        'clicks': a['clicks'] + b['clicks'],
+        'gold': a['gold'] + b['gold'],
+        'exp': a['exp'] + b['exp'],
+        'crits': a['crits'] + b['crits'],
+        'leading_crits': a['clicks'] + b['leading_crits'] if a_all else a['leading_crits'],
+        'trailing_crits': a['trailing_crits'] + b['clicks'] if b_all else b['trailing_crits'],
+        'longest_crits': max(a['longest_crits'], b['longest_crits'], a['trailing_crits'] + b['leading_crits']),
+        'resources': resources,
+    }
 
-        # Повышаем уровень, если нужно
-        await level_up_if_needed(uid, conn)
+async def commit_click_outcomes(outcomes: Dict[int, dict], conn: asyncpg.Connection) -> Dict[int, Any]:
+    """
+    Записывает итоги кликов нескольких игроков одним оператором.
+    Возвращает {user_id: строка с новым состоянием игрока}.
+    """
+    uids = list(outcomes.keys())
+    items = [outcomes[uid] for uid in uids]
+    inv_uids, inv_rids, inv_amts = [], [], []
+    for uid, o in zip(uids, items):
+        for rid, amt in o['resources'].items():
+            inv_uids.append(uid)
+            inv_rids.append(rid)
+            inv_amts.append(amt)
+    rows = await queries.fetch(
+        conn, 'click_commit',
+        uids,
+        [o['gold'] for o in items],
+        [o['exp'] for o in items],
+        [o['clicks'] for o in items],
+        [o['crits'] for o in items],
+        [o['crits'] == o['clicks'] for o in items],
+        [o['leading_crits'] for o in items],
+        [o['trailing_crits'] for o in items],
+        [o['longest_crits'] for o in items],
+        [sum(o['resources'].values()) for o in items],
+        inv_uids, inv_rids, inv_amts,
+        datetime.date.today(), get_week_number(),
+        MAX_RESOURCE_AMOUNT, EXP_PER_LEVEL
+    )
+    return {row['user_id']: row for row in rows}
+
+def mark_achievements(ctx: dict, mask: int):
+    ctx['achievements'] |= mask
+
+async def apply_committed_click(uid: int, ctx: dict, row, conn: asyncpg.Connection) -> Tuple[dict, dict]:
+    """
+    Проверяет достижения по загруженному состоянию и строке, которую вернул
+    CLICK_COMMIT_SQL. Возвращает (новая статистика, новый инвентарь).
+    """
+    stats = build_stats(row, ctx['stats']['upgrades'])
+    inv = dict(ctx['inv'])
+    if row['inventory']:
+        inv.update(json.loads(row['inventory']))
+
+    data = {
+        'stats': stats,
+        'inv_total': sum(inv.values()),
+        'inv': inv,
+        'tools': ctx['tools'],
+        'daily_completed': ctx['daily_completed'] + row['daily_done'],
+        'weekly_completed': ctx['weekly_completed'] + row['weekly_done']
+    }
+    new_ach = find_new_achievements(uid, data, ctx['achievements'], CLICK_METRICS)
+    if new_ach:
+        updated = await unlock_achievements(uid, new_ach, conn)
+        # Контекст ClickAccumulator переживает откат пачки: отмечаем открытые
+        # достижения только после фиксации, иначе они не откроются уже никогда
+        mask = ACHIEVEMENT_INDEX.mask(ach.id for ach, _, _ in new_ach)
+        after_commit(conn, functools.partial(mark_achievements, ctx, mask))
+        if updated:
+            stats.update(level=updated['level'], exp=updated['exp'], gold=updated['gold'],
+                         total_exp=(updated['level'] - 1) * EXP_PER_LEVEL + updated['exp'])
+    # Рейтинги – после фиксации: пачка ClickAccumulator при сбое откатывается и пишется заново
+    after_commit(conn, functools.partial(leaderboards.update_player, uid, stats, inv))
+    after_commit(conn, functools.partial(leaderboards.add, 'tasks_completed', uid,
+                                         row['daily_done'] + row['weekly_done']))
+    return stats, inv
+
+async def settle_click_outcome(uid: int, ctx: dict, outcome: dict, conn: asyncpg.Connection) -> Tuple[dict, dict]:
+    """Записывает итог кликов одного игрока и проверяет достижения."""
+    rows = await commit_click_outcomes({uid: outcome}, conn)
+    return await apply_committed_click(uid, ctx, rows[uid], conn)
+
+def apply_outcome_to_context(ctx: dict, outcome: dict):
+    """Применяет итог кликов к загруженному состоянию так же, как это делает CLICK_COMMIT_SQL."""
+    stats = ctx['stats']
+    total = stats['exp'] + outcome['exp']
+    stats['level'] += total // EXP_PER_LEVEL
+    stats['exp'] = total % EXP_PER_LEVEL
+    stats['total_exp'] = (stats['level'] - 1) * EXP_PER_LEVEL + stats['exp']
+    stats['gold'] += outcome['gold']
+    stats['clicks'] += outcome['clicks']
+    stats['total_gold'] += outcome['gold']
+    stats['total_crits'] += outcome['crits']
+    prev_streak = stats['current_crit_streak']
+    if outcome['crits'] == outcome['clicks']:
+        stats['current_crit_streak'] = prev_streak + outcome['clicks']
+    else:
+        stats['current_crit_streak'] = outcome['trailing_crits']
+    stats['max_crit_streak'] = max(
+        stats['max_crit_streak'],
+        prev_streak + outcome['leading_crits'] if outcome['leading_crits'] else 0,
+        outcome['longest_crits']
+    )
+    inv = ctx['inv']
+    for rid, amt in outcome['resources'].items():
+        inv[rid] = min(inv.get(rid, 0) + amt, MAX_RESOURCE_AMOUNT)
+
+class ClickAccumulator:
+    """
+    Write-behind буфер кликов (режим CLICK_WRITE_MODE='buffered').
+    Клик сразу применяется к контексту игрока в памяти, а накопленные
+    дельты пишутся в БД одним CLICK_COMMIT_SQL на всех игроков каждые
+    CLICK_FLUSH_INTERVAL_MS или после CLICK_FLUSH_MAX_CLICKS кликов.
+    Любая инвалидация player_cache (покупка, продажа, крафт и т.п.) помечает
+    контекст устаревшим: следующий клик или сброс перечитывает его из БД и
+    накладывает сверху ещё не записанные клики.
+    Дельты, которые не удаётся записать, не отбрасываются: они повторяются
+    на каждом сбросе, а после CLICK_FLUSH_MAX_RETRIES неудач подряд новые
+    клики игрока идут мимо буфера прямой записью (accepts), пока его
+    дельты не запишутся. Теряются они только при остановке процесса.
+    После close() буфер кликов не принимает: они пишутся напрямую.
+    """
 
-        # Получаем свежие данные для ответа
-        new_stats = await get_player_stats(uid, conn)
-        new_inv = await get_inventory(uid, conn)
+    def __init__(self, interval_ms: int, max_clicks: int):
+        self.interval = interval_ms / 1000
+        self.max_clicks = max_clicks
+        self.states: Dict[int, dict] = {}    # user_id -> контекст клика
+        self.pending: Dict[int, dict] = {}   # user_id -> ещё не записанный итог
+        self.pending_clicks = 0
+        self.stale: set = set()              # контексты, изменённые в обход буфера
+        self.failures: Dict[int, int] = {}   # user_id -> неудачных сбросов подряд
+        self.batch_failures = 0
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._flushes: set = set()           # сбросы, запущенные по max_clicks
+        self.closed = False
+
+    def mark_stale(self, uid: int):
+        if uid in self.states:
+            self.stale.add(uid)
+
+    async def _load(self, uid: int) -> dict:
+        # Под замком сброса в БД нет наполовину записанной пачки, поэтому
+        # свежее состояние плюс pending[uid] – это ровно текущее состояние игрока
+        async with self._flush_lock:
+            ctx = self.states.get(uid)
+            if ctx is not None and uid not in self.stale:
+                return ctx  # пока мы ждали замок, состояние загрузил параллельный клик
+            self.stale.discard(uid)
+            async with acquire_conn() as conn:
+                ctx = await load_click_context(uid, conn)
+                if ctx is None:
+                    await get_player(uid, None, conn)
+                    ctx = await load_click_context(uid, conn)
+            pending = self.pending.get(uid)
+            if pending:
+                apply_outcome_to_context(ctx, pending)
+            self.states[uid] = ctx
+            return ctx
+
+    async def _context(self, uid: int) -> dict:
+        ctx = self.states.get(uid)
+        if ctx is None or uid in self.stale:
+            ctx = await self._load(uid)
+        return ctx
+
+    def _add(self, uid: int, ctx: dict, outcome: dict):
+        apply_outcome_to_context(ctx, outcome)
+        prev = self.pending.get(uid)
+        self.pending[uid] = merge_click_outcomes(prev, outcome) if prev else outcome
+        self.pending_clicks += outcome['clicks']
+        if self.pending_clicks >= self.max_clicks and not self._flush_lock.locked():
+            task = asyncio.create_task(self.flush())
+            self._flushes.add(task)
+            task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task: asyncio.Task):
+        self._flushes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Click flush task failed", exc_info=task.exception())
+
+    async def click_batch(self, uid: int, count: int) -> dict:
+        ctx = await self._context(uid)
+        outcome = roll_clicks(ctx, count)
+        self._add(uid, ctx, outcome)
+        return click_batch_result(outcome, ctx['stats'], ctx['inv'])
+
+    async def click(self, uid: int) -> dict:
+        ctx = await self._context(uid)
+        gold, exp, is_crit, found, amt = roll_click(ctx)
+        self._add(uid, ctx, build_click_outcome([(gold, exp, is_crit, found, amt)]))
+
+        return {
+            'gold': gold,
+            'exp': exp,
+            'is_crit': is_crit,
+            'found_resource': found,
+            'amount': amt,
+            'new_gold': ctx['stats']['gold'],
+            'new_exp': ctx['stats']['exp'],
+            'inventory': dict(ctx['inv'])
+        }
+
+    async def _refresh_stale(self, batch: Dict[int, dict], conn: asyncpg.Connection):
+        """Перечитывает (до записи пачки) контексты, устаревшие из-за других изменений."""
+        for uid in [u for u in batch if u in self.stale]:
+            self.stale.discard(uid)
+            ctx = await load_click_context(uid, conn)
+            apply_outcome_to_context(ctx, batch[uid])
+            pending = self.pending.get(uid)  # клики, пришедшие во время сброса
+            if pending:
+                apply_outcome_to_context(ctx, pending)
+            self.states[uid] = ctx
+
+    async def _commit(self, batch: Dict[int, dict]):
+        async with acquire_conn() as conn:
+            async with transaction(conn):
+                await self._refresh_stale(batch, conn)
+                rows = await commit_click_outcomes(batch, conn)
+                for uid, row in rows.items():
+                    await apply_committed_click(uid, self.states[uid], row, conn)
+
+    def _requeue(self, uid: int, outcome: dict):
+        # Возвращаем дельты в буфер перед теми, что пришли во время сброса
+        cur = self.pending.get(uid)
+        self.pending[uid] = merge_click_outcomes(outcome, cur) if cur else outcome
+        if self.accepts(uid):
+            # Застрявшие дельты не должны запускать сброс на каждом чужом клике
+            self.pending_clicks += outcome['clicks']
+
+    def accepts(self, uid: int) -> bool:
+        """False после close() и пока дельты игрока раз за разом не записываются: клики идут мимо буфера."""
+        return not self.closed and self.failures.get(uid, 0) < CLICK_FLUSH_MAX_RETRIES
+
+    async def _commit_each(self, batch: Dict[int, dict]) -> List[int]:
+        """
+        Пишет игроков по одному, чтобы один сбойный не блокировал остальных.
+        Незаписанные дельты возвращаются в буфер. Возвращает записанных игроков.
+        """
+        done = []
+        for uid, outcome in batch.items():
+            try:
+                await self._commit({uid: outcome})
+            except Exception as e:
+                failures = self.failures[uid] = self.failures.get(uid, 0) + 1
+                self._requeue(uid, outcome)
+                if failures == CLICK_FLUSH_MAX_RETRIES:
+                    logger.error(f"Clicks of {uid} failed to flush {failures} times, "
+                                 f"writing new clicks directly: {e}")
+                continue
+            if self.failures.pop(uid, 0) >= CLICK_FLUSH_MAX_RETRIES:
+                logger.info(f"Clicks of {uid} flushed, buffering resumed")
+            done.append(uid)
+        return done
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, {}
+            self.pending_clicks = 0
+            # Игроки, на которых сброс уже падал, пишутся отдельно от остальных
+            suspects = {uid: batch.pop(uid) for uid in [u for u in batch if u in self.failures]}
+            done = await self._commit_each(suspects)
+            try:
+                if batch:
+                    await self._commit(batch)
+                done.extend(batch)
+                self.batch_failures = 0
+            except Exception as e:
+                logger.error(f"Click flush failed for {len(batch)} players: {e}", exc_info=True)
+                self.batch_failures += 1
+                if self.batch_failures < CLICK_FLUSH_MAX_RETRIES:
+                    for uid, o in batch.items():
+                        self._requeue(uid, o)
+                else:
+                    # Пачка раз за разом не проходит – ищем виноватого поштучно
+                    self.batch_failures = 0
+                    done.extend(await self._commit_each(batch))
+            # Следующий клик перечитает состояние вместе с наградами за задания
+            for uid in done:
+                if uid not in self.pending:
+                    self.states.pop(uid, None)
+                    self.stale.discard(uid)
+                    player_cache.invalidate(uid)
+            if done:
+                logger.debug(f"Flushed clicks of {len(done)} players")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        self.closed = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.gather(*self._flushes, return_exceptions=True)
+        await self.flush()
+        for uid, outcome in self.pending.items():
+            logger.error(f"Lost {outcome['clicks']} unflushed clicks of {uid} on shutdown")
+
+async def process_click_batch(uid: int, count: int, conn: asyncpg.Connection = None) -> dict:
+    """
+    Разрешает пачку из count кликов одной транзакцией (два запроса к БД
+    независимо от размера пачки). Возвращает суммарный итог и новое состояние.
+    """
+    if click_accumulator is not None and conn is None and click_accumulator.accepts(uid):
+        return await click_accumulator.click_batch(uid, count)
+
+    async def _execute(conn):
+        ctx = await load_click_context(uid, conn)
+        if ctx is None:
+            await get_player(uid, None, conn)
+            ctx = await load_click_context(uid, conn)
+        outcome = roll_clicks(ctx, count)
+        new_stats, new_inv = await settle_click_outcome(uid, ctx, outcome, conn)
+        return click_batch_result(outcome, new_stats, new_inv), new_stats
+
+    if conn is None:
+        async with acquire_conn() as conn:
+            async with transaction(conn):
+                result, new_stats = await _execute(conn)
+        player_cache.update(uid, new_stats, result['inventory'])
+        return result
+    else:
+        result, _ = await _execute(conn)
+        player_cache.invalidate(uid)
+        return result
+
+click_accumulator: Optional[ClickAccumulator] = (
+    ClickAccumulator(CLICK_FLUSH_INTERVAL_MS, CLICK_FLUSH_MAX_CLICKS)
+    if CLICK_WRITE_MODE == 'buffered' else None
+)
+if click_accumulator is not None:
+    player_cache.on_invalidate.append(click_accumulator.mark_stale)
+
+async def process_click(uid: int, conn: asyncpg.Connection = None) -> dict:
+    """
+    Выполняет логику одного клика в транзакции.
+    Состояние читается одним запросом, результат пишется одним
+    оператором с RETURNING. Возвращает словарь с результатами.
+    В режиме 'buffered' клик уходит в click_accumulator (кроме игроков,
+    чьи накопленные клики не удаётся записать).
+    """
+    if click_accumulator is not None and conn is None and click_accumulator.accepts(uid):
+        return await click_accumulator.click(uid)
+
+    async def _execute(conn):
+        ctx = await load_click_context(uid, conn)
+        if ctx is None:
+            await get_player(uid, None, conn)
+            ctx = await load_click_context(uid, conn)
+
+        gold, exp, is_crit, found, amt = roll_click(ctx)
+        outcome = build_click_outcome([(gold, exp, is_crit, found, amt)])
+        new_stats, new_inv = await settle_click_outcome(uid, ctx, outcome, conn)
 
         return {
             'gold': gold,
@@ -1610,14 +3540,19 @@ async def process_click(uid: int, conn: asyncpg.Connection = None) -> dict:
             'new_gold': new_stats['gold'],
             'new_exp': new_stats['exp'],
             'inventory': new_inv
-        }
+        }, new_stats
 
     if conn is None:
-        async with db_pool.acquire() as conn:
-            async with conn.transaction():
-                return await _execute(conn)
+        async with acquire_conn() as conn:
+            async with transaction(conn):
+                result, new_stats = await _execute(conn)
+        # Транзакция зафиксирована – обновляем кэш вместо повторного чтения
+        player_cache.update(uid, new_stats, result['inventory'])
+        return result
     else:
-        return await _execute(conn)
+        result, _ = await _execute(conn)
+        player_cache.invalidate(uid)
+        return result
 
 # ==================== КРАФТ (РЕЦЕПТЫ) ====================
 
@@ -1735,8 +3670,8 @@ async def get_player_items(uid: int, conn: asyncpg.Connection = None) -> dict:
     if conn:
         return await _get(conn)
     else:
-        async with db_pool.acquire() as conn:
-            return await _get(conn)
+        state = await get_player_state(uid)
+        return dict(state.items) if state is not None else {}
 
 async def add_item(uid: int, item_id: str, quantity: int = 1, expires_at: datetime.datetime = None, conn: asyncpg.Connection = None):
     async def _add(conn):
@@ -1757,27 +3692,30 @@ async def add_item(uid: int, item_id: str, quantity: int = 1, expires_at: dateti
     if conn:
         await _add(conn)
     else:
-        async with db_pool.acquire() as conn:
-            async with conn.transaction():
+        async with acquire_conn() as conn:
+            async with transaction(conn):
                 await _add(conn)
+    player_cache.invalidate(uid)
 
 async def remove_item(uid: int, item_id: str, quantity: int = 1, conn: asyncpg.Connection = None) -> bool:
     async def _remove(conn):
-        cur = await conn.fetchval("SELECT quantity FROM player_items WHERE user_id = $1 AND item_id = $2", uid, item_id)
-        if not cur or cur < quantity:
+        new_qty = await conn.fetchval(
+            "UPDATE player_items SET quantity = quantity - $3 WHERE user_id = $1 AND item_id = $2 AND quantity >= $3 RETURNING quantity",
+            uid, item_id, quantity
+        )
+        if new_qty is None:
             return False
-        new_qty = cur - quantity
         if new_qty == 0:
-            await conn.execute("DELETE FROM player_items WHERE user_id = $1 AND item_id = $2", uid, item_id)
-        else:
-            await conn.execute("UPDATE player_items SET quantity = $1 WHERE user_id = $2 AND item_id = $3", new_qty, uid, item_id)
+            await conn.execute("DELETE FROM player_items WHERE user_id = $1 AND item_id = $2 AND quantity = 0", uid, item_id)
         return True
     if conn:
-        return await _remove(conn)
+        result = await _remove(conn)
     else:
-        async with db_pool.acquire() as conn:
-            async with conn.transaction():
-                return await _remove(conn)
+        async with acquire_conn() as conn:
+            async with transaction(conn):
+                result = await _remove(conn)
+    player_cache.invalidate(uid)
+    return result
 
 async def craft_item(uid: int, recipe_id: str, conn: asyncpg.Connection = None) -> Tuple[bool, str]:
     recipe = CRAFT_RECIPES.get(recipe_id)
@@ -1785,17 +3723,19 @@ async def craft_item(uid: int, recipe_id: str, conn: asyncpg.Connection = None)
         return False, "Рецепт не найден"
     
     async def _craft(conn):
-        inv = await get_inventory(uid, conn)
-        for res, need in recipe['resources'].items():
-            if inv.get(res, 0) < need:
-                return False, f"Недостаточно {RESOURCES[res]['name']}"
-        
-        for res, need in recipe['resources'].items():
-            await remove_resource(uid, res, need, conn)
-        
         result_type = recipe.get('result_type')
+        deltas = {res: -need for res, need in recipe['resources'].items()}
+        if result_type == 'resource':
+            rid = recipe['effect']['resource_id']
+            deltas[rid] = deltas.get(rid, 0) + recipe['effect']['amount']
+        if await apply_resource_deltas(uid, deltas, conn) is None:
+            inv = await get_inventory(uid, conn)
+            for res, need in recipe['resources'].items():
+                if inv.get(res, 0) < need:
+                    return False, f"Недостаточно {RESOURCES[res]['name']}"
+            return False, "Недостаточно ресурсов"
+        
         if result_type == 'resource':
-            await add_resource(uid, recipe['effect']['resource_id'], recipe['effect']['amount'], conn)
             return True, f"✅ Создано: {recipe['effect']['amount']} {RESOURCES[recipe['effect']['resource_id']]['name']}"
         elif result_type in ('consumable', 'key', 'permanent'):
             if recipe.get('duration'):
@@ -1808,12 +3748,17 @@ async def craft_item(uid: int, recipe_id: str, conn: asyncpg.Connection = None)
             return False, "Неизвестный тип результата"
     
     if conn:
-        async with conn.transaction():
-            return await _craft(conn)
+        async with transaction(conn):
+            result = await _craft(conn)
+        player_cache.invalidate(uid)
     else:
-        async with db_pool.acquire() as conn:
-            async with conn.transaction():
-                return await _craft(conn)
+        async with acquire_conn() as conn:
+            async with transaction(conn):
+                result = await _craft(conn)
+        player_cache.invalidate(uid)
+        if result[0]:
+            await refresh_leaderboards(uid)
+    return result
 
 # ==================== ФУНКЦИИ ОТОБРАЖЕНИЯ (КРАФТ) ====================
 
@@ -1869,12 +3814,16 @@ async def show_craft_my_items(update_or_query, ctx):
 
 async def craft_do(update_or_query, ctx, recipe_id):
     uid = update_or_query.from_user.id
-    success, msg = await craft_item(uid, recipe_id)
+    async with acquire_conn() as conn:
+        async with transaction(conn):
+            success, msg = await craft_item(uid, recipe_id, conn)
+            if success:
+                await enqueue_message(uid, msg, conn=conn)
     if success:
-        await update_or_query.answer("✅ Предмет создан!", show_alert=False)
-        await ctx.bot.send_message(chat_id=uid, text=msg)
+        await refresh_leaderboards(uid)
+        await answer_query(update_or_query, "✅ Предмет создан!", show_alert=False)
     else:
-        await update_or_query.answer(msg, show_alert=True)
+        await answer_query(update_or_query, msg, show_alert=True)
     # Возвращаемся в категорию
     recipe = CRAFT_RECIPES.get(recipe_id)
     if recipe:
@@ -1882,49 +3831,195 @@ async def craft_do(update_or_query, ctx, recipe_id):
     else:
         await show_craft_menu(update_or_query, ctx)
 
-# ==================== ОБНОВЛЁННОЕ ГЛАВНОЕ МЕНЮ ====================
+# ==================== ПРЕДСОБРАННЫЕ ЭКРАНЫ ====================
+
+BACK_TO_MENU_ROW = [InlineKeyboardButton("🔙 Назад", callback_data='back_to_menu')]
+RESOURCE_EMOJI = {'coal': "🪨", 'iron': "⚙️", 'gold': "🟡", 'diamond': "💎"}  # остальные – 🔮
+
+MAIN_MENU_TEXT = ("🪨 **Шахтёрская глубина**\n\nПривет, шахтёр! Твой путь к богатству начинается здесь.\n\n🏁 **Что делать?**\n• Нажимай «⛏ Добыть» – каждый клик приносит золото и ресурсы.\n• Выполняй «📋 Задания» – получай бонусы.\n• Соревнуйся в «🏆 Лидеры» – стань лучшим!\n• Создавай предметы в «🔨 Крафт».\n\nОстальные команды доступны в меню (кнопка слева внизу).")
+MAIN_MENU_ROWS = [
+    [InlineKeyboardButton("⛏ Добыть", callback_data='mine'),
+     InlineKeyboardButton("📋 Задания", callback_data='tasks'),
+     InlineKeyboardButton("🏆 Лидеры", callback_data='leaderboard_menu')],
+    [InlineKeyboardButton("🔨 Крафт", callback_data='craft_menu')],
+]
+views.add_static('main_menu', MAIN_MENU_TEXT, MAIN_MENU_ROWS)
+views.add_static('main_menu_arena', MAIN_MENU_TEXT, MAIN_MENU_ROWS + [
+    [InlineKeyboardButton("⚔️ Босс-арена (3D)", web_app=WebAppInfo(url="https://vladislavbropiton.github.io/telegram-clicker-bot/"))]
+])
+
+views.add_static('shop_menu',
+    "🛒 **Магазин**\n\nЗдесь ты можешь улучшить своего шахтёра. Выбери категорию:\n\n⚡ Улучшения – прокачка навыков\n🧰 Инструменты – покупка и улучшение кирок",
+    [[InlineKeyboardButton("⚡ Улучшения", callback_data='shop_category_upgrades'),
+      InlineKeyboardButton("🧰 Инструменты", callback_data='shop_category_tools')],
+     BACK_TO_MENU_ROW])
+
+views.add_static('leaderboard_menu',
+    "🏆 **Таблица лидеров**\n\nВыбери категорию для просмотра топ-10 игроков:",
+    [[InlineKeyboardButton("📊 По уровню", callback_data='leaderboard_level')],
+     [InlineKeyboardButton("💰 По золоту", callback_data='leaderboard_gold')],
+     [InlineKeyboardButton("🏆 По достижениям", callback_data='leaderboard_achievements')],
+     [InlineKeyboardButton("📅 По заданиям", callback_data='leaderboard_tasks_completed')],
+     [InlineKeyboardButton("🔨 По инструментам", callback_data='leaderboard_tools')],
+     [InlineKeyboardButton("📦 По ресурсам", callback_data='leaderboard_resources_menu')],
+     BACK_TO_MENU_ROW])
+
+views.add_static('leaderboard_resources_menu',
+    "📦 **Лидеры по ресурсам**\n\nВыбери конкретный ресурс или общее количество:",
+    [[InlineKeyboardButton("🪨 По углю", callback_data='leaderboard_coal')],
+     [InlineKeyboardButton("⚙️ По железу", callback_data='leaderboard_iron')],
+     [InlineKeyboardButton("🟡 По золотой руде", callback_data='leaderboard_gold_ore')],
+     [InlineKeyboardButton("💎 По алмазам", callback_data='leaderboard_diamond')],
+     [InlineKeyboardButton("🔮 По мифрилу", callback_data='leaderboard_mithril')],
+     [InlineKeyboardButton("📦 По общему количеству", callback_data='leaderboard_total_resources')],
+     [InlineKeyboardButton("🔙 К категориям", callback_data='leaderboard_menu')]])
+
+FAQ_CATEGORIES = {
+    "🪨 **Основное**": [
+        "🪨 Как добывать ресурсы?",
+        "🧰 Зачем нужны инструменты?",
+        "⚡ Как увеличить доход за клик?"
+    ],
+    "🗺 **Локации**": [
+        "🗺 Как открыть новые локации?",
+        "🗺 Какие локации существуют и что там добывают?"
+    ],
+    "📋 **Задания**": [
+        "📋 Что такое ежедневные и еженедельные задания?"
+    ],
+    "💰 **Экономика**": [
+        "💰 Как продать ресурсы?",
+        "🏆 Что такое достижения?"
+    ],
+    "🔄 **Инструменты**": [
+        "🔄 Как сменить активный инструмент?"
+    ],
+    "🔨 **Крафт**": [
+        "🔨 Что такое крафт?"
+    ]
+}
+
+def build_faq_text() -> str:
+    faq_dict = {item["question"]: item["answer"] for item in FAQ}
+    text = "📚 **Часто задаваемые вопросы**\n\n"
+    for category, questions in FAQ_CATEGORIES.items():
+        text += f"{category}\n" + "─" * 25 + "\n\n"
+        for q in questions:
+            if q in faq_dict:
+                q_esc = escape_markdown(q, version=1)
+                a_esc = escape_markdown(faq_dict[q], version=1)
+                text += f"❓ **{q_esc}**\n{a_esc}\n\n"
+        text += "\n"
+    return text
+
+def build_faq_locations_text() -> str:
+    text = "🗺 **Локации**\n\n"
+    text += "**Обычные локации:**\n\n"
+    for loc_id, loc in LOCATIONS.items():
+        emoji = "🪨" if 'coal' in loc_id else "⚙️" if 'iron' in loc_id else "🟡" if 'gold' in loc_id else "💎" if 'diamond' in loc_id else "🔮"
+        name = loc['name']
+        req_level = loc['min_level']
+        req_tool = loc.get('min_tool_level', 0)
+        tool_text = f", инструмент {req_tool} ур." if req_tool > 0 else ""
+        text += f"{emoji} **{name}**\n"
+        text += f"   Требуется: уровень {req_level}{tool_text}\n"
+        text += f"   {loc['description']}\n"
+        res_list = []
+        for res in loc['resources']:
+            res_name = RESOURCES[res['res_id']]['name']
+            prob = int(res['prob'] * 100)
+            amount = f"{res['min']}-{res['max']}" if res['min'] != res['max'] else str(res['min'])
+            res_list.append(f"{res_name} {prob}% ({amount} шт.)")
+        text += "   Ресурсы: " + ", ".join(res_list) + "\n\n"
+    return text
+
+def build_faq_boss_locations_text() -> str:
+    text = "⚔️ **Босс-локации** ⚔️\n\n"
+    for bid, bloc in BOSS_LOCATIONS.items():
+        boss = bloc['boss']
+        if 'goblin' in bid:
+            emoji = "👑"
+        elif 'dragon' in bid:
+            emoji = "🐉"
+        else:
+            emoji = "💀"
+        text += f"{emoji} **{bloc['name']}**\n"
+        text += f"   Требуется: уровень {bloc['min_level']}, инструмент {bloc['min_tool_level']} ур.\n"
+        text += f"   {bloc['description']}\n"
+        text += f"   Босс: {boss['name']} | Здоровье: {boss['health']}\n"
+        rewards = []
+        if boss['reward_gold']:
+            rewards.append(f"{boss['reward_gold']}💰")
+        if boss['exp_reward']:
+            rewards.append(f"{boss['exp_reward']}✨")
+        for res, (minr, maxr) in boss['reward_resources'].items():
+            res_name = RESOURCES.get(res, {}).get('name', res)
+            amount = f"{minr}-{maxr}" if minr != maxr else str(minr)
+            rewards.append(f"{res_name} {amount} шт.")
+        text += f"   Награда: {', '.join(rewards)}\n\n"
+    return text
+
+views.add_static('faq', build_faq_text(),
+    [[InlineKeyboardButton("🗺 Локации", callback_data='faq_locations')]])
+views.add_static('faq_locations', build_faq_locations_text(),
+    [[InlineKeyboardButton("⚔️ Босс-локации", callback_data='faq_boss_locations')],
+     [InlineKeyboardButton("🔙 Назад", callback_data='back_to_faq')]])
+views.add_static('faq_boss_locations', build_faq_boss_locations_text(),
+    [[InlineKeyboardButton("🔙 Назад к локациям", callback_data='faq_locations')]])
+
+# Инвентарь и рынок: state – количества ресурсов по порядку RESOURCE_IDS
+RESOURCE_LINE_PREFIX = [
+    f"{RESOURCE_EMOJI.get(rid, '🔮')} {escape_markdown(RESOURCES[rid]['name'], version=1)}: **"
+    for rid in RESOURCE_IDS
+]
+INVENTORY_FOOTER = "\n─────────────────────────\nПродать ресурсы можно на рынке (/market)."
+MARKET_LINE_SUFFIX = [f"** шт. | 💰 Цена: {RESOURCES[rid]['base_price']} за шт.\n" for rid in RESOURCE_IDS]
+MARKET_SELL_ROWS = [
+    [InlineKeyboardButton(f"Продать 1 {escape_markdown(RESOURCES[rid]['name'], version=1)}", callback_data=f'sell_confirm_{rid}_1'),
+     InlineKeyboardButton("Продать всё", callback_data=f'sell_confirm_{rid}_all')]
+    for rid in RESOURCE_IDS
+]
+
+def inventory_state(inv: Dict[str, int]) -> tuple:
+    return tuple(inv.get(rid, 0) for rid in RESOURCE_IDS)
 
-async def show_main_menu(update_or_query, ctx):
-    uid = update_or_query.from_user.id if not isinstance(update_or_query, Update) else update_or_query.effective_user.id
-    stats = await get_player_stats(uid)
-    kb = [
-        [InlineKeyboardButton("⛏ Добыть", callback_data='mine'),
-         InlineKeyboardButton("📋 Задания", callback_data='tasks'),
-         InlineKeyboardButton("🏆 Лидеры", callback_data='leaderboard_menu')]
-    ]
-    kb.append([InlineKeyboardButton("🔨 Крафт", callback_data='craft_menu')])
-    if stats['level'] >= 5:
-        kb.append([InlineKeyboardButton("⚔️ Босс-арена (3D)", web_app=WebAppInfo(url="https://vladislavbropiton.github.io/telegram-clicker-bot/"))])
-    rm = InlineKeyboardMarkup(kb)
-    txt = ("🪨 **Шахтёрская глубина**\n\nПривет, шахтёр! Твой путь к богатству начинается здесь.\n\n🏁 **Что делать?**\n• Нажимай «⛏ Добыть» – каждый клик приносит золото и ресурсы.\n• Выполняй «📋 Задания» – получай бонусы.\n• Соревнуйся в «🏆 Лидеры» – стань лучшим!\n• Создавай предметы в «🔨 Крафт».\n\nОстальные команды доступны в меню (кнопка слева внизу).")
-    await reply_or_edit(update_or_query, txt, reply_markup=rm, parse_mode='Markdown')
+@views.add('inventory')
+def build_inventory(amounts: tuple):
+    if any(amounts):
+        txt = "🎒 **Инвентарь**\n\nВот что ты накопал:\n\n" + "".join(
+            f"{prefix}{amt}** шт.\n" for prefix, amt in zip(RESOURCE_LINE_PREFIX, amounts))
+    else:
+        txt = "🎒 **Инвентарь**\n\nТвой инвентарь пока пуст. Иди добывай!\n\n"
+    return txt + INVENTORY_FOOTER, [BACK_TO_MENU_ROW]
+
+@views.add('market')
+def build_market(amounts: tuple):
+    txt = "💰 **Рынок ресурсов**\n\nТвои запасы и текущие цены:\n\n" + "".join(
+        f"{prefix}{amt}{suffix}" for prefix, amt, suffix in zip(RESOURCE_LINE_PREFIX, amounts, MARKET_LINE_SUFFIX))
+    txt += "\n─────────────────────────\nВыбери, что и сколько продать."
+    kb = [row for row, amt in zip(MARKET_SELL_ROWS, amounts) if amt > 0]
+    kb.append(BACK_TO_MENU_ROW)
+    return txt, kb
 
 # ==================== ФУНКЦИИ ОТОБРАЖЕНИЯ ====================
 
 async def show_main_menu(update_or_query, ctx):
     uid = update_or_query.from_user.id if not isinstance(update_or_query, Update) else update_or_query.effective_user.id
     stats = await get_player_stats(uid)
-    kb = [
-        [InlineKeyboardButton("⛏ Добыть", callback_data='mine'),
-         InlineKeyboardButton("📋 Задания", callback_data='tasks'),
-         InlineKeyboardButton("🏆 Лидеры", callback_data='leaderboard_menu')]
-    ]
-    kb.append([InlineKeyboardButton("🔨 Крафт", callback_data='craft_menu')])
-    if stats['level'] >= 5:
-        kb.append([InlineKeyboardButton("⚔️ Босс-арена (3D)", web_app=WebAppInfo(url="https://vladislavbropiton.github.io/telegram-clicker-bot/"))])
-    rm = InlineKeyboardMarkup(kb)
-    txt = ("🪨 **Шахтёрская глубина**\n\nПривет, шахтёр! Твой путь к богатству начинается здесь.\n\n🏁 **Что делать?**\n• Нажимай «⛏ Добыть» – каждый клик приносит золото и ресурсы.\n• Выполняй «📋 Задания» – получай бонусы.\n• Соревнуйся в «🏆 Лидеры» – стань лучшим!\n• Создавай предметы в «🔨 Крафт».\n\nОстальные команды доступны в меню (кнопка слева внизу).")
-    await reply_or_edit(update_or_query, txt, reply_markup=rm, parse_mode='Markdown')
+    await views.show(update_or_query, 'main_menu_arena' if stats['level'] >= 5 else 'main_menu')
 
 async def show_main_menu_from_query(query, ctx=None):
     await show_main_menu(query, ctx)
 
 async def show_locations(update_or_query, ctx):
     uid = update_or_query.from_user.id if not isinstance(update_or_query, Update) else update_or_query.effective_user.id
-    cur = await get_player_current_location(uid)
-    stats = await get_player_stats(uid)
-    lvl = stats['level']
-    tool_level = await get_active_tool_level(uid)
+    # Один снимок на весь экран: локация, уровень, инструмент и прогресс по боссам
+    state = await get_player_state(uid)
+    if state is None:
+        return
+    cur = state.current_location
+    lvl = state.level
+    tool_level = state.tools.get(state.active_tool, 0)
     sl = sorted(LOCATIONS.items(), key=lambda x: x[1]['min_level'])
     
     txt = "🗺 **Обычные локации**\n\n"
@@ -1969,7 +4064,7 @@ async def show_locations(update_or_query, ctx):
         level_ok = lvl >= bloc['min_level']
         tool_ok = tool_level >= bloc['min_tool_level']
         if level_ok and tool_ok:
-            prog = await get_boss_progress(uid, bid)
+            prog = state.boss_progress(bid)
             status = "✅" if prog['defeated'] else "⚔️"
             txt += f"{status} **{bloc['name']}**\n   {bloc['description']}\n"
             if not prog['defeated']:
@@ -1984,11 +4079,7 @@ async def show_locations(update_or_query, ctx):
     await reply_or_edit(update_or_query, txt, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(kb))
 
 async def show_shop_menu(update_or_query, ctx):
-    kb = [[InlineKeyboardButton("⚡ Улучшения", callback_data='shop_category_upgrades'),
-            InlineKeyboardButton("🧰 Инструменты", callback_data='shop_category_tools')],
-           [InlineKeyboardButton("🔙 Назад", callback_data='back_to_menu')]]
-    txt = "🛒 **Магазин**\n\nЗдесь ты можешь улучшить своего шахтёра. Выбери категорию:\n\n⚡ Улучшения – прокачка навыков\n🧰 Инструменты – покупка и улучшение кирок"
-    await reply_or_edit(update_or_query, txt, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(kb))
+    await views.show(update_or_query, 'shop_menu')
 
 async def show_shop_upgrades(update_or_query, ctx):
     uid = update_or_query.from_user.id if not isinstance(update_or_query, Update) else update_or_query.effective_user.id
@@ -2008,13 +4099,16 @@ async def show_shop_upgrades(update_or_query, ctx):
 
 async def show_shop_tools(update_or_query, ctx):
     uid = update_or_query.from_user.id if not isinstance(update_or_query, Update) else update_or_query.effective_user.id
-    stats = await get_player_stats(uid)
-    gold = stats['gold']
-    active = await get_active_tool(uid)
+    state = await get_player_state(uid)
+    if state is None:
+        return
+    gold = state.gold
+    active = state.active_tool
+    inv = state.inventory_dict()
     txt = f"🧰 **Инструменты**\n💰 Твой баланс: {gold} золота\n\n"
     kb = []
     for tid, tool in TOOLS.items():
-        level = await get_tool_level(uid, tid)
+        level = state.tools.get(tid, 0)
         tool_name = escape_markdown(tool['name'], version=1)
         if level == 0 and tool['price'] > 0:
             txt += f"─────────────────────────\n🔒 **{tool_name}** – {tool['price']}💰 (треб.ур.{tool['required_level']})\n   {tool['description']}\n\n"
@@ -2027,8 +4121,8 @@ async def show_shop_tools(update_or_query, ctx):
             row = []
             if not is_active:
                 row.append(InlineKeyboardButton("🔨 Сделать активным", callback_data=f'activate_tool_{tid}'))
-            if await can_upgrade_tool(uid, tid):
-                cost = get_upgrade_cost(tid, level)
+            cost = get_upgrade_cost(tid, level)
+            if all(inv.get(res, 0) >= need for res, need in cost.items()):
                 cost_parts = [f"{escape_markdown(RESOURCES[res]['name'], version=1)} {amt}" for res, amt in cost.items()]
                 cost_str = ", ".join(cost_parts)
                 row.append(InlineKeyboardButton(f"⬆️ Улучшить ({cost_str})", callback_data=f'upgrade_tool_{tid}'))
@@ -2098,8 +4192,8 @@ async def show_profile(update_or_query, ctx):
            f"• Всего добыто золота: **{stats['total_gold']}**💰\n• Критические удары: **{stats['total_crits']}**\n"
            f"• Макс. серия критов: **{stats['max_crit_streak']}**\n\n⚡ **Улучшения**\n"
            f"• Сила клика: ур.**{stats['upgrades']['click_power']}**\n• Шанс крита: ур.**{stats['upgrades']['crit_chance']}**\n")
-    async with db_pool.acquire() as conn:
-        recent = await conn.fetch("SELECT achievement_id, unlocked_at FROM user_achievements WHERE user_id = $1 ORDER BY unlocked_at DESC LIMIT 5", uid)
+    state = await get_player_state(uid)
+    recent = state.recent_achievements if state is not None else []
     if recent:
         txt += f"\n🏅 **Последние достижения**\n"
         for aid, dt in recent:
@@ -2128,273 +4222,95 @@ async def profile_achievements_handler(query, ctx):
 async def show_inventory(update_or_query, ctx):
     uid = update_or_query.from_user.id if not isinstance(update_or_query, Update) else update_or_query.effective_user.id
     inv = await get_inventory(uid)
-    txt = "🎒 **Инвентарь**\n\nВот что ты накопал:\n\n"
-    has = False
-    for rid, info in RESOURCES.items():
-        amt = inv.get(rid, 0)
-        emoji = "🪨" if rid == 'coal' else "⚙️" if rid == 'iron' else "🟡" if rid == 'gold' else "💎" if rid == 'diamond' else "🔮"
-        name = escape_markdown(info['name'], version=1)
-        txt += f"{emoji} {name}: **{amt}** шт.\n"
-        if amt > 0:
-            has = True
-    if not has:
-        txt = "🎒 **Инвентарь**\n\nТвой инвентарь пока пуст. Иди добывай!\n\n"
-    txt += "\n─────────────────────────\nПродать ресурсы можно на рынке (/market)."
-    kb = [[InlineKeyboardButton("🔙 Назад", callback_data='back_to_menu')]]
-    await reply_or_edit(update_or_query, txt, reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
+    await views.show(update_or_query, 'inventory', inventory_state(inv))
 
 async def show_market(update_or_query, ctx):
     uid = update_or_query.from_user.id if not isinstance(update_or_query, Update) else update_or_query.effective_user.id
     inv = await get_inventory(uid)
-    txt = "💰 **Рынок ресурсов**\n\nТвои запасы и текущие цены:\n\n"
-    kb = []
-    for rid, info in RESOURCES.items():
-        amt = inv.get(rid, 0)
-        price = info['base_price']
-        emoji = "🪨" if rid == 'coal' else "⚙️" if rid == 'iron' else "🟡" if rid == 'gold' else "💎" if rid == 'diamond' else "🔮"
-        name = escape_markdown(info['name'], version=1)
-        txt += f"{emoji} {name}: **{amt}** шт. | 💰 Цена: {price} за шт.\n"
-        if amt > 0:
-            kb.append([InlineKeyboardButton(f"Продать 1 {name}", callback_data=f'sell_confirm_{rid}_1'),
-                       InlineKeyboardButton(f"Продать всё", callback_data=f'sell_confirm_{rid}_all')])
-    txt += "\n─────────────────────────\nВыбери, что и сколько продать."
-    kb.append([InlineKeyboardButton("🔙 Назад", callback_data='back_to_menu')])
-    await reply_or_edit(update_or_query, txt, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(kb))
+    await views.show(update_or_query, 'market', inventory_state(inv))
 
 async def show_leaderboard_menu(update_or_query, ctx):
-    kb = [
-        [InlineKeyboardButton("📊 По уровню", callback_data='leaderboard_level')],
-        [InlineKeyboardButton("💰 По золоту", callback_data='leaderboard_gold')],
-        [InlineKeyboardButton("🏆 По достижениям", callback_data='leaderboard_achievements')],
-        [InlineKeyboardButton("📅 По заданиям", callback_data='leaderboard_tasks_completed')],
-        [InlineKeyboardButton("🔨 По инструментам", callback_data='leaderboard_tools')],
-        [InlineKeyboardButton("📦 По ресурсам", callback_data='leaderboard_resources_menu')],
-        [InlineKeyboardButton("🔙 Назад", callback_data='back_to_menu')]
-    ]
-    txt = ("🏆 **Таблица лидеров**\n\nВыбери категорию для просмотра топ-10 игроков:")
-    await reply_or_edit(update_or_query, txt, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(kb))
+    await views.show(update_or_query, 'leaderboard_menu')
 
 async def show_leaderboard_resources_menu(update_or_query, ctx):
-    kb = [
-        [InlineKeyboardButton("🪨 По углю", callback_data='leaderboard_coal')],
-        [InlineKeyboardButton("⚙️ По железу", callback_data='leaderboard_iron')],
-        [InlineKeyboardButton("🟡 По золотой руде", callback_data='leaderboard_gold_ore')],
-        [InlineKeyboardButton("💎 По алмазам", callback_data='leaderboard_diamond')],
-        [InlineKeyboardButton("🔮 По мифрилу", callback_data='leaderboard_mithril')],
-        [InlineKeyboardButton("📦 По общему количеству", callback_data='leaderboard_total_resources')],
-        [InlineKeyboardButton("🔙 К категориям", callback_data='leaderboard_menu')]
-    ]
-    txt = ("📦 **Лидеры по ресурсам**\n\nВыбери конкретный ресурс или общее количество:")
-    await reply_or_edit(update_or_query, txt, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(kb))
-
-async def show_leaderboard_level(update_or_query, ctx):
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch("SELECT username, level, exp FROM players ORDER BY level DESC, exp DESC LIMIT 10")
-    txt = "📊 **Топ по уровню**\n\n"
-    if not rows:
-        txt += "Пока нет данных."
-    else:
-        for i, row in enumerate(rows, 1):
-            name = escape_markdown(row['username'] or 'Аноним', version=1)
-            total_exp = (row['level'] - 1) * EXP_PER_LEVEL + row['exp']
-            txt += f"{i}. {name} — уровень {row['level']} (общий опыт {total_exp})\n"
-    kb = [[InlineKeyboardButton("🔙 К категориям", callback_data='leaderboard_menu')]]
-    await reply_or_edit(update_or_query, txt, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(kb))
-
-async def show_leaderboard_gold(update_or_query, ctx):
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch("SELECT username, gold FROM players ORDER BY gold DESC LIMIT 10")
-    txt = "💰 **Топ по золоту**\n\n"
-    if not rows:
-        txt += "Пока нет данных."
-    else:
-        for i, row in enumerate(rows, 1):
-            name = escape_markdown(row['username'] or 'Аноним', version=1)
-            txt += f"{i}. {name} — {row['gold']}💰\n"
-    kb = [[InlineKeyboardButton("🔙 К категориям", callback_data='leaderboard_menu')]]
-    await reply_or_edit(update_or_query, txt, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(kb))
-
-async def show_leaderboard_achievements(update_or_query, ctx):
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch("SELECT p.username, COUNT(ua.achievement_id) as cnt FROM players p LEFT JOIN user_achievements ua ON p.user_id = ua.user_id GROUP BY p.user_id ORDER BY cnt DESC LIMIT 10")
-    txt = "🏆 **Топ по достижениям**\n\n"
-    if not rows:
-        txt += "Пока нет данных."
-    else:
-        for i, row in enumerate(rows, 1):
-            name = escape_markdown(row['username'] or 'Аноним', version=1)
-            txt += f"{i}. {name} — {row['cnt']} достижений\n"
-    kb = [[InlineKeyboardButton("🔙 К категориям", callback_data='leaderboard_menu')]]
-    await reply_or_edit(update_or_query, txt, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(kb))
-
-async def show_leaderboard_tasks_completed(update_or_query, ctx):
-    async with db_pool.acquire() as conn:
-        daily = dict(await conn.fetch("SELECT user_id, COUNT(*) as cnt FROM daily_tasks WHERE completed = TRUE GROUP BY user_id"))
-        weekly = dict(await conn.fetch("SELECT user_id, COUNT(*) as cnt FROM weekly_tasks WHERE completed = TRUE GROUP BY user_id"))
-        all_users = set(daily.keys()) | set(weekly.keys())
-        totals = []
-        for uid in all_users:
-            total = daily.get(uid, 0) + weekly.get(uid, 0)
-            name = await conn.fetchval("SELECT username FROM players WHERE user_id = $1", uid)
-            if name:
-                totals.append((name, total))
-    totals.sort(key=lambda x: x[1], reverse=True)
-    top = totals[:10]
-    txt = "📅 **Топ по выполненным заданиям**\n\n"
-    if not top:
+    await views.show(update_or_query, 'leaderboard_resources_menu')
+
+LEADERBOARD_PAGE_SIZE = 10
+LEADERBOARD_RADIUS = 5
+
+LEADERBOARD_VIEWS = {
+    'level': ("📊 **Топ по уровню**", lambda s: f"уровень {s // EXP_PER_LEVEL + 1} (общий опыт {s})"),
+    'gold': ("💰 **Топ по золоту**", lambda s: f"{s}💰"),
+    'achievements': ("🏆 **Топ по достижениям**", lambda s: f"{s} достижений"),
+    'tasks_completed': ("📅 **Топ по выполненным заданиям**", lambda s: f"{s} заданий"),
+    'tools': ("🔨 **Топ по уровню инструментов**", lambda s: f"суммарный уровень {s}"),
+    'total_resources': ("📦 **Топ по общему количеству ресурсов**", lambda s: f"{s} шт."),
+}
+LEADERBOARD_RESOURCE_NAMES = {'coal': 'Уголь', 'iron': 'Железо', 'gold': 'Золотая руда', 'diamond': 'Алмазы', 'mithril': 'Мифрил'}
+for _rid in RESOURCE_IDS:
+    _rname = escape_markdown(LEADERBOARD_RESOURCE_NAMES.get(_rid, RESOURCES[_rid]['name']), version=1)
+    LEADERBOARD_VIEWS[f'res_{_rid}'] = (f"🏆 **Топ по {_rname}**", lambda s: f"{s} шт.")
+
+def leaderboard_lines(entries, fmt, uid: int) -> str:
+    txt = ""
+    for rank, entry_uid, name, score in entries:
+        name = escape_markdown(name or 'Аноним', version=1)
+        marker = "👉 " if entry_uid == uid else ""
+        txt += f"{marker}{rank + 1}. {name} — {fmt(score)}\n"
+    return txt
+
+async def show_leaderboard(update_or_query, category: str, after: Optional[Tuple[int, int]] = None):
+    """Страница рейтинга (keyset-курсор after) и окно «рядом со мной»."""
+    uid = update_or_query.from_user.id if not isinstance(update_or_query, Update) else update_or_query.effective_user.id
+    title, fmt = LEADERBOARD_VIEWS[category]
+    entries = leaderboards.page(category, after, LEADERBOARD_PAGE_SIZE)
+    txt = f"{title}\n\n"
+    if not entries:
         txt += "Пока нет данных."
     else:
-        for i, (name, cnt) in enumerate(top, 1):
-            name = escape_markdown(name or 'Аноним', version=1)
-            txt += f"{i}. {name} — {cnt} заданий\n"
-    kb = [[InlineKeyboardButton("🔙 К категориям", callback_data='leaderboard_menu')]]
-    await reply_or_edit(update_or_query, txt, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(kb))
+        txt += leaderboard_lines(entries, fmt, uid)
 
-async def show_leaderboard_tools(update_or_query, ctx):
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch("SELECT p.username, SUM(pt.level) as total FROM players p LEFT JOIN player_tools pt ON p.user_id = pt.user_id GROUP BY p.user_id ORDER BY total DESC LIMIT 10")
-    txt = "🔨 **Топ по уровню инструментов**\n\n"
-    if not rows:
-        txt += "Пока нет данных."
-    else:
-        for i, row in enumerate(rows, 1):
-            name = escape_markdown(row['username'] or 'Аноним', version=1)
-            txt += f"{i}. {name} — суммарный уровень {row['total']}\n"
-    kb = [[InlineKeyboardButton("🔙 К категориям", callback_data='leaderboard_menu')]]
-    await reply_or_edit(update_or_query, txt, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(kb))
+    me = leaderboards.rank(category, uid)
+    if me is not None:
+        rank, score = me
+        txt += f"\n📍 Твоё место: **{rank + 1}** — {fmt(score)}\n"
+        shown = {entry_uid for _, entry_uid, _, _ in entries}
+        if uid not in shown:
+            txt += "\n" + leaderboard_lines(leaderboards.around(category, uid, LEADERBOARD_RADIUS), fmt, uid)
 
-async def show_leaderboard_resource(update_or_query, ctx, rid, rname):
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch("SELECT p.username, i.amount FROM inventory i JOIN players p ON i.user_id = p.user_id WHERE i.resource_id = $1 ORDER BY i.amount DESC LIMIT 10", rid)
-    rname_esc = escape_markdown(rname, version=1)
-    txt = f"🏆 **Топ по {rname_esc}**\n\n"
-    if not rows:
-        txt += "Пока нет данных."
-    else:
-        for i, row in enumerate(rows, 1):
-            name = escape_markdown(row['username'] or 'Аноним', version=1)
-            txt += f"{i}. {name} — {row['amount']} шт.\n"
-    kb = [[InlineKeyboardButton("🔙 К категориям", callback_data='leaderboard_menu')]]
+    kb = []
+    if len(entries) == LEADERBOARD_PAGE_SIZE:
+        _, last_uid, _, last_score = entries[-1]
+        kb.append([InlineKeyboardButton("▶️ Дальше", callback_data=f'lbpage_{category}_{last_score}_{last_uid}')])
+    kb.append([InlineKeyboardButton("🔙 К категориям", callback_data='leaderboard_menu')])
     await reply_or_edit(update_or_query, txt, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(kb))
 
-async def show_leaderboard_coal(update_or_query, ctx): await show_leaderboard_resource(update_or_query, ctx, 'coal', 'Уголь')
-async def show_leaderboard_iron(update_or_query, ctx): await show_leaderboard_resource(update_or_query, ctx, 'iron', 'Железо')
-async def show_leaderboard_gold_ore(update_or_query, ctx): await show_leaderboard_resource(update_or_query, ctx, 'gold', 'Золотая руда')
-async def show_leaderboard_diamond(update_or_query, ctx): await show_leaderboard_resource(update_or_query, ctx, 'diamond', 'Алмазы')
-async def show_leaderboard_mithril(update_or_query, ctx): await show_leaderboard_resource(update_or_query, ctx, 'mithril', 'Мифрил')
-async def show_leaderboard_total_resources(update_or_query, ctx):
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch("SELECT p.username, SUM(i.amount) as total FROM players p LEFT JOIN inventory i ON p.user_id = i.user_id GROUP BY p.user_id ORDER BY total DESC LIMIT 10")
-    txt = "📦 **Топ по общему количеству ресурсов**\n\n"
-    if not rows:
-        txt += "Пока нет данных."
-    else:
-        for i, row in enumerate(rows, 1):
-            name = escape_markdown(row['username'] or 'Аноним', version=1)
-            txt += f"{i}. {name} — {row['total']} шт.\n"
-    kb = [[InlineKeyboardButton("🔙 К категориям", callback_data='leaderboard_menu')]]
-    await reply_or_edit(update_or_query, txt, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(kb))
+async def show_leaderboard_page(update_or_query, ctx):
+    category, score, uid = update_or_query.data.replace('lbpage_', '').rsplit('_', 2)
+    if category not in LEADERBOARD_VIEWS:
+        return
+    await show_leaderboard(update_or_query, category, (int(score), int(uid)))
+
+async def show_leaderboard_level(update_or_query, ctx): await show_leaderboard(update_or_query, 'level')
+async def show_leaderboard_gold(update_or_query, ctx): await show_leaderboard(update_or_query, 'gold')
+async def show_leaderboard_achievements(update_or_query, ctx): await show_leaderboard(update_or_query, 'achievements')
+async def show_leaderboard_tasks_completed(update_or_query, ctx): await show_leaderboard(update_or_query, 'tasks_completed')
+async def show_leaderboard_tools(update_or_query, ctx): await show_leaderboard(update_or_query, 'tools')
+async def show_leaderboard_coal(update_or_query, ctx): await show_leaderboard(update_or_query, 'res_coal')
+async def show_leaderboard_iron(update_or_query, ctx): await show_leaderboard(update_or_query, 'res_iron')
+async def show_leaderboard_gold_ore(update_or_query, ctx): await show_leaderboard(update_or_query, 'res_gold')
+async def show_leaderboard_diamond(update_or_query, ctx): await show_leaderboard(update_or_query, 'res_diamond')
+async def show_leaderboard_mithril(update_or_query, ctx): await show_leaderboard(update_or_query, 'res_mithril')
+async def show_leaderboard_total_resources(update_or_query, ctx): await show_leaderboard(update_or_query, 'total_resources')
 
 async def show_faq_locations(update_or_query, ctx):
-    uid = update_or_query.from_user.id if not isinstance(update_or_query, Update) else update_or_query.effective_user.id
-    stats = await get_player_stats(uid)
-    lvl = stats['level']
-    
-    text = "🗺 **Локации**\n\n"
-    text += "**Обычные локации:**\n\n"
-    
-    for loc_id, loc in LOCATIONS.items():
-        emoji = "🪨" if 'coal' in loc_id else "⚙️" if 'iron' in loc_id else "🟡" if 'gold' in loc_id else "💎" if 'diamond' in loc_id else "🔮"
-        name = loc['name']
-        req_level = loc['min_level']
-        req_tool = loc.get('min_tool_level', 0)
-        tool_text = f", инструмент {req_tool} ур." if req_tool > 0 else ""
-        text += f"{emoji} **{name}**\n"
-        text += f"   Требуется: уровень {req_level}{tool_text}\n"
-        text += f"   {loc['description']}\n"
-        res_list = []
-        for res in loc['resources']:
-            res_name = RESOURCES[res['res_id']]['name']
-            prob = int(res['prob'] * 100)
-            amount = f"{res['min']}-{res['max']}" if res['min'] != res['max'] else str(res['min'])
-            res_list.append(f"{res_name} {prob}% ({amount} шт.)")
-        text += "   Ресурсы: " + ", ".join(res_list) + "\n\n"
-    
-    kb = [
-        [InlineKeyboardButton("⚔️ Босс-локации", callback_data='faq_boss_locations')],
-        [InlineKeyboardButton("🔙 Назад", callback_data='back_to_faq')]
-    ]
-    await reply_or_edit(update_or_query, text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(kb))
+    await views.show(update_or_query, 'faq_locations')
 
 async def show_faq_boss_locations(update_or_query, ctx):
-    text = "⚔️ **Босс-локации** ⚔️\n\n"
-    for bid, bloc in BOSS_LOCATIONS.items():
-        boss = bloc['boss']
-        if 'goblin' in bid:
-            emoji = "👑"
-        elif 'dragon' in bid:
-            emoji = "🐉"
-        else:
-            emoji = "💀"
-        
-        text += f"{emoji} **{bloc['name']}**\n"
-        text += f"   Требуется: уровень {bloc['min_level']}, инструмент {bloc['min_tool_level']} ур.\n"
-        text += f"   {bloc['description']}\n"
-        text += f"   Босс: {boss['name']} | Здоровье: {boss['health']}\n"
-        rewards = []
-        if boss['reward_gold']:
-            rewards.append(f"{boss['reward_gold']}💰")
-        if boss['exp_reward']:
-            rewards.append(f"{boss['exp_reward']}✨")
-        for res, (minr, maxr) in boss['reward_resources'].items():
-            res_name = RESOURCES.get(res, {}).get('name', res)
-            amount = f"{minr}-{maxr}" if minr != maxr else str(minr)
-            rewards.append(f"{res_name} {amount} шт.")
-        text += f"   Награда: {', '.join(rewards)}\n\n"
-    
-    kb = [[InlineKeyboardButton("🔙 Назад к локациям", callback_data='faq_locations')]]
-    await reply_or_edit(update_or_query, text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(kb))
+    await views.show(update_or_query, 'faq_boss_locations')
 
 async def back_to_faq(update_or_query, ctx):
-    uid = update_or_query.from_user.id if not isinstance(update_or_query, Update) else update_or_query.effective_user.id
-    stats = await get_player_stats(uid)
-    lvl = stats['level']
-    faq_dict = {item["question"]: item["answer"] for item in FAQ}
-    categories = {
-        "🪨 **Основное**": [
-            "🪨 Как добывать ресурсы?",
-            "🧰 Зачем нужны инструменты?",
-            "⚡ Как увеличить доход за клик?"
-        ],
-        "🗺 **Локации**": [
-            "🗺 Как открыть новые локации?",
-            "🗺 Какие локации существуют и что там добывают?"
-        ],
-        "📋 **Задания**": [
-            "📋 Что такое ежедневные и еженедельные задания?"
-        ],
-        "💰 **Экономика**": [
-            "💰 Как продать ресурсы?",
-            "🏆 Что такое достижения?"
-        ],
-        "🔄 **Инструменты**": [
-            "🔄 Как сменить активный инструмент?"
-        ],
-        "🔨 **Крафт**": [
-            "🔨 Что такое крафт?"
-        ]
-    }
-    text = "📚 **Часто задаваемые вопросы**\n\n"
-    for category, questions in categories.items():
-        text += f"{category}\n" + "─" * 25 + "\n\n"
-        for q in questions:
-            if q in faq_dict:
-                q_esc = escape_markdown(q, version=1)
-                a_esc = escape_markdown(faq_dict[q], version=1)
-                text += f"❓ **{q_esc}**\n{a_esc}\n\n"
-        text += "\n"
-    kb = [[InlineKeyboardButton("🗺 Локации", callback_data='faq_locations')]]
-    await reply_or_edit(update_or_query, text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(kb))
+    await views.show(update_or_query, 'faq')
 
 # ==================== ДЕЙСТВИЯ ====================
 
@@ -2405,10 +4321,10 @@ async def mine_action(update_or_query, ctx):
     res_txt = f"\nТы нашёл: {RESOURCES[result['found_resource']]['name']} x{result['amount']}!" if result['found_resource'] else ""
     txt = f"Ты добыл: {result['gold']} золота {ct}{res_txt}\nПолучено опыта: {result['exp']}"
     if isinstance(update_or_query, Update):
-        await update_or_query.message.reply_text(txt)
+        await send_text(update_or_query, txt)
         await show_main_menu(update_or_query, ctx)
     else:
-        await update_or_query.message.reply_text(txt)
+        await send_text(update_or_query, txt)
         await show_main_menu_from_query(update_or_query)
 
 async def process_buy(update_or_query, ctx):
@@ -2418,48 +4334,48 @@ async def process_buy(update_or_query, ctx):
         uid = update_or_query.from_user.id
         tool = TOOLS.get(tid)
         if not tool:
-            await update_or_query.answer("Ошибка!", show_alert=True)
+            await answer_query(update_or_query, "Ошибка!", show_alert=True)
             return
-        stats = await get_player_stats(uid)
-        if stats['level'] < tool['required_level']:
-            await update_or_query.answer(f"❌ Требуется уровень {tool['required_level']}", show_alert=True)
+        async with acquire_conn() as conn:
+            async with transaction(conn):
+                success, message = await buy_tool(uid, tid, conn)
+                if success:
+                    await enqueue_message(uid, message, conn=conn)
+        if not success:
+            await answer_query(update_or_query, message, show_alert=True)
             return
-        if stats['gold'] < tool['price']:
-            await update_or_query.answer("❌ Недостаточно золота!", show_alert=True)
-            return
-        async with db_pool.acquire() as conn:
-            async with conn.transaction():
-                await conn.execute("UPDATE players SET gold = gold - $1 WHERE user_id = $2", tool['price'], uid)
-                await conn.execute("INSERT INTO player_tools (user_id, tool_id, level, experience) VALUES ($1, $2, 1, 0) ON CONFLICT DO NOTHING", uid, tid)
-        await ctx.bot.send_message(chat_id=uid, text=f"✅ Ты купил {tool['name']}!")
+        await refresh_leaderboards(uid)
         await show_shop_tools(update_or_query, ctx)
         return
 
     up_id = data.replace('buy_', '')
     uid = update_or_query.from_user.id
-    success, message, new_level = await purchase_upgrade(uid, up_id)
+    async with acquire_conn() as conn:
+        async with transaction(conn):
+            success, message, new_level = await purchase_upgrade(uid, up_id, conn)
+            if success:
+                await enqueue_message(uid, message, conn=conn)
     if success:
-        await ctx.bot.send_message(chat_id=uid, text=message)
         price = int(UPGRADES[up_id]['base_price'] * (UPGRADES[up_id]['price_mult'] ** (new_level-1)))
-        await update_daily_task_progress(uid, 'Покупатель', price)
-        await update_weekly_task_progress(uid, 'Магнат', price)
-        await check_achievements(uid, ctx)
+        await advance_tasks(uid, {'spent': price})
+        await check_achievements(uid, ctx, metrics=('tasks_completed', 'level'))
+        await refresh_leaderboards(uid)
     else:
-        await update_or_query.answer(message, show_alert=True)
+        await answer_query(update_or_query, message, show_alert=True)
     await show_shop_upgrades(update_or_query, ctx)
 
 async def activate_tool(update_or_query, ctx):
     tid = update_or_query.data.replace('activate_tool_', '')
     uid = update_or_query.from_user.id
     await set_active_tool(uid, tid)
-    await update_or_query.answer(f"✅ {TOOLS[tid]['name']} теперь активна!")
+    await answer_query(update_or_query, f"✅ {TOOLS[tid]['name']} теперь активна!")
     await show_shop_tools(update_or_query, ctx)
 
 async def upgrade_tool_handler(update_or_query, ctx):
     tid = update_or_query.data.replace('upgrade_tool_', '')
     uid = update_or_query.from_user.id
     if not await can_upgrade_tool(uid, tid):
-        await update_or_query.answer("❌ Недостаточно ресурсов!", show_alert=True)
+        await answer_query(update_or_query, "❌ Недостаточно ресурсов!", show_alert=True)
         await show_shop_tools(update_or_query, ctx)
         return
     level = await get_tool_level(uid, tid)
@@ -2472,26 +4388,28 @@ async def upgrade_tool_handler(update_or_query, ctx):
                         parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(kb))
 
 async def confirm_upgrade(update_or_query, ctx):
+    # Ресурсы проверяет сам upgrade_tool в БД, а не закэшированное состояние
     tid = update_or_query.data.replace('confirm_upgrade_', '')
     uid = update_or_query.from_user.id
-    if not await can_upgrade_tool(uid, tid):
-        await update_or_query.answer("❌ Недостаточно ресурсов!", show_alert=True)
-        await show_shop_tools(update_or_query, ctx)
-        return
-    if await upgrade_tool(uid, tid):
-        new_level = await get_tool_level(uid, tid)
-        await update_or_query.answer("✅ Уровень повышен!")
-        await ctx.bot.send_message(chat_id=uid, text=f"🔨 {TOOLS[tid]['name']} улучшена до уровня {new_level}!")
-        await check_achievements(uid, ctx)
+    async with acquire_conn() as conn:
+        async with transaction(conn):
+            upgraded = await upgrade_tool(uid, tid, conn)
+            if upgraded:
+                new_level = await get_tool_level(uid, tid, conn)
+                await enqueue_message(uid, f"🔨 {TOOLS[tid]['name']} улучшена до уровня {new_level}!", conn=conn)
+    if upgraded:
+        await answer_query(update_or_query, "✅ Уровень повышен!")
+        await check_achievements(uid, ctx, metrics=TOOL_METRICS)
+        await refresh_leaderboards(uid)
     else:
-        await update_or_query.answer("❌ Ошибка при улучшении", show_alert=True)
+        await answer_query(update_or_query, "❌ Недостаточно ресурсов!", show_alert=True)
     await show_shop_tools(update_or_query, ctx)
 
 async def show_sell_confirmation(update_or_query, ctx):
     data = update_or_query.data
     parts = data.split('_')
     if len(parts) < 4:
-        await update_or_query.answer("Неверные данные", show_alert=True)
+        await answer_query(update_or_query, "Неверные данные", show_alert=True)
         return
     rid = parts[2]
     sell_type = parts[3]
@@ -2499,7 +4417,7 @@ async def show_sell_confirmation(update_or_query, ctx):
     inv = await get_inventory(uid)
     avail = inv.get(rid, 0)
     if avail == 0:
-        await update_or_query.answer("❌ У вас нет этого ресурса!", show_alert=True)
+        await answer_query(update_or_query, "❌ У вас нет этого ресурса!", show_alert=True)
         await show_market(update_or_query, ctx)
         return
     qty = avail if sell_type == 'all' else 1
@@ -2522,30 +4440,32 @@ async def process_sell_execute(update_or_query, ctx):
     data = update_or_query.data
     parts = data.split('_')
     if len(parts) < 4:
-        await update_or_query.answer("Неверные данные", show_alert=True)
+        await answer_query(update_or_query, "Неверные данные", show_alert=True)
         return
     rid = parts[2]
     sell_type = parts[3]
     uid = update_or_query.from_user.id
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():
-            avail = await conn.fetchval("SELECT amount FROM inventory WHERE user_id = $1 AND resource_id = $2", uid, rid)
+    error = None
+    async with acquire_conn() as conn:
+        async with transaction(conn):
+            avail = await queries.fetchval(conn, 'inventory_amount', uid, rid)
             if avail is None or avail == 0:
-                await update_or_query.answer("❌ Ресурс закончился!", show_alert=True)
-                await show_market(update_or_query, ctx)
-                return
-            qty = avail if sell_type == 'all' else 1
-            if qty > avail:
-                await update_or_query.answer("❌ Количество изменилось. Попробуйте снова.", show_alert=True)
-                await show_market(update_or_query, ctx)
-                return
-            price = RESOURCES[rid]['base_price']
-            total = qty * price
-            await conn.execute("UPDATE inventory SET amount = amount - $1 WHERE user_id = $2 AND resource_id = $3", qty, uid, rid)
-            await conn.execute("UPDATE players SET gold = gold + $1 WHERE user_id = $2", total, uid)
-    await update_daily_task_progress(uid, 'Продавец', total)
-    await update_weekly_task_progress(uid, 'Торговец', total)
-    await update_or_query.answer(f"✅ Продано {qty} {RESOURCES[rid]['name']} за {total}💰", show_alert=False)
+                error = "❌ Ресурс закончился!"
+            else:
+                qty = avail if sell_type == 'all' else 1
+                total = qty * RESOURCES[rid]['base_price']
+                if await apply_resource_deltas(uid, {rid: -qty}, conn) is None:
+                    error = "❌ Количество изменилось. Попробуйте снова."
+                else:
+                    await conn.execute("UPDATE players SET gold = gold + $1 WHERE user_id = $2", total, uid)
+    if error is not None:
+        await answer_query(update_or_query, error, show_alert=True)
+        await show_market(update_or_query, ctx)
+        return
+    player_cache.invalidate(uid)
+    await advance_tasks(uid, {'sold': total})
+    await refresh_leaderboards(uid)
+    await answer_query(update_or_query, f"✅ Продано {qty} {RESOURCES[rid]['name']} за {total}💰", show_alert=False)
     await show_market(update_or_query, ctx)
 
 async def goto_location(update_or_query, ctx):
@@ -2553,19 +4473,19 @@ async def goto_location(update_or_query, ctx):
     uid = update_or_query.from_user.id
     loc = LOCATIONS.get(lid)
     if not loc:
-        await update_or_query.answer("Локация не найдена", show_alert=True)
+        await answer_query(update_or_query, "Локация не найдена", show_alert=True)
         return
     stats = await get_player_stats(uid)
     if stats['level'] < loc['min_level']:
-        await update_or_query.answer(f"❌ Требуется уровень {loc['min_level']}", show_alert=True)
+        await answer_query(update_or_query, f"❌ Требуется уровень {loc['min_level']}", show_alert=True)
         return
     if loc.get('min_tool_level', 0) > 0:
         tool_level = await get_active_tool_level(uid)
         if tool_level < loc['min_tool_level']:
-            await update_or_query.answer(f"❌ Требуется инструмент {loc['min_tool_level']} уровня", show_alert=True)
+            await answer_query(update_or_query, f"❌ Требуется инструмент {loc['min_tool_level']} уровня", show_alert=True)
             return
     await set_player_location(uid, lid)
-    await update_or_query.answer(f"✅ Ты переместился в {loc['name']}")
+    await answer_query(update_or_query, f"✅ Ты переместился в {loc['name']}")
     await show_locations(update_or_query, ctx)
 
 async def fight_boss(update_or_query, ctx):
@@ -2574,21 +4494,21 @@ async def fight_boss(update_or_query, ctx):
     bid = q.data.replace('fight_boss_', '')
     bloc = BOSS_LOCATIONS.get(bid)
     if not bloc:
-        await q.answer("Босс не найден", show_alert=True)
+        await answer_query(q, "Босс не найден", show_alert=True)
         return
     
     stats = await get_player_stats(uid)
     if stats['level'] < bloc['min_level']:
-        await q.answer(f"❌ Требуется уровень {bloc['min_level']}", show_alert=True)
+        await answer_query(q, f"❌ Требуется уровень {bloc['min_level']}", show_alert=True)
         return
     tool_level = await get_active_tool_level(uid)
     if tool_level < bloc['min_tool_level']:
-        await q.answer(f"❌ Требуется инструмент {bloc['min_tool_level']} уровня", show_alert=True)
+        await answer_query(q, f"❌ Требуется инструмент {bloc['min_tool_level']} уровня", show_alert=True)
         return
     
     progress = await get_boss_progress(uid, bid)
     if progress['defeated']:
-        await q.answer("Босс уже побеждён!", show_alert=True)
+        await answer_query(q, "Босс уже побеждён!", show_alert=True)
         return
     
     gold, exp, is_crit = get_click_reward(stats)
@@ -2603,18 +4523,25 @@ async def fight_boss(update_or_query, ctx):
     
     if defeated:
         boss = bloc['boss']
-        await update_player(uid, gold=stats['gold'] + boss['reward_gold'], exp=stats['exp'] + boss['exp_reward'])
-        for res, (minr, maxr) in boss['reward_resources'].items():
-            amt = random.randint(minr, maxr)
-            await add_resource(uid, res, amt)
-        await q.message.reply_text(
+        async with acquire_conn() as conn:
+            async with transaction(conn):
+                await conn.execute(
+                    "UPDATE players SET gold = gold + $1, exp = exp + $2 WHERE user_id = $3",
+                    boss['reward_gold'], boss['exp_reward'], uid
+                )
+                await level_up_if_needed(uid, conn)
+                loot = {res: random.randint(minr, maxr) for res, (minr, maxr) in boss['reward_resources'].items()}
+                await apply_resource_deltas(uid, loot, conn)
+        player_cache.invalidate(uid)
+        await refresh_leaderboards(uid)
+        await send_text(q,
             f"⚔️ Ты нанёс {damage} урона{crit_text} и ПОБЕДИЛ {boss['name']}!\n"
             f"Награда: {boss['reward_gold']}💰, {boss['exp_reward']}✨ и ресурсы!"
         )
         await check_achievements(uid, ctx)
     else:
         new_progress = await get_boss_progress(uid, bid)
-        await q.message.reply_text(
+        await send_text(q,
             f"⚔️ Ты нанёс {damage} урона{crit_text} боссу {bloc['boss']['name']}. "
             f"Осталось здоровья: {new_progress['current_health']}/{bloc['boss']['health']}"
         )
@@ -2669,45 +4596,7 @@ async def cmd_leaderboard(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     await show_leaderboard_menu(update, ctx)
 
 async def cmd_faq(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    uid = update.effective_user.id
-    stats = await get_player_stats(uid)
-    lvl = stats['level']
-    faq_dict = {item["question"]: item["answer"] for item in FAQ}
-    categories = {
-        "🪨 **Основное**": [
-            "🪨 Как добывать ресурсы?",
-            "🧰 Зачем нужны инструменты?",
-            "⚡ Как увеличить доход за клик?"
-        ],
-        "🗺 **Локации**": [
-            "🗺 Как открыть новые локации?",
-            "🗺 Какие локации существуют и что там добывают?"
-        ],
-        "📋 **Задания**": [
-            "📋 Что такое ежедневные и еженедельные задания?"
-        ],
-        "💰 **Экономика**": [
-            "💰 Как продать ресурсы?",
-            "🏆 Что такое достижения?"
-        ],
-        "🔄 **Инструменты**": [
-            "🔄 Как сменить активный инструмент?"
-        ],
-        "🔨 **Крафт**": [
-            "🔨 Что такое крафт?"
-        ]
-    }
-    text = "📚 **Часто задаваемые вопросы**\n\n"
-    for category, questions in categories.items():
-        text += f"{category}\n" + "─" * 25 + "\n\n"
-        for q in questions:
-            if q in faq_dict:
-                q_esc = escape_markdown(q, version=1)
-                a_esc = escape_markdown(faq_dict[q], version=1)
-                text += f"❓ **{q_esc}**\n{a_esc}\n\n"
-        text += "\n"
-    kb = [[InlineKeyboardButton("🗺 Локации", callback_data='faq_locations')]]
-    await update.message.reply_text(text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(kb))
+    await views.show(update, 'faq')
 
 async def cmd_achievements(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
@@ -2759,6 +4648,7 @@ SIMPLE_CALLBACK_HANDLERS = {
     'craft_my_items': show_craft_my_items,
 }
 
+@request_scoped
 async def button_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     data = q.data
@@ -2766,7 +4656,7 @@ async def button_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
     if data in SIMPLE_CALLBACK_HANDLERS:
         await SIMPLE_CALLBACK_HANDLERS[data](q, ctx)
-        await q.answer()
+        await answer_query(q)
         return
 
     if data.startswith('craft_category_'):
@@ -2791,18 +4681,109 @@ async def button_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await goto_location(q, ctx)
     elif data.startswith('fight_boss_'):
         await fight_boss(q, ctx)
+    elif data.startswith('lbpage_'):
+        await show_leaderboard_page(q, ctx)
     else:
-        await q.answer()
+        await answer_query(q)
         return
 
-    await q.answer()
+    await answer_query(q)
 
 # ==================== API ДЛЯ MINI APP ====================
 
+class FastJSONResponse(JSONResponse):
+    """JSONResponse, кодирующий через orjson (в несколько раз быстрее stdlib json)."""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+# Класс ответа для всех эндпоинтов API
+APIResponse = FastJSONResponse if orjson is not None else JSONResponse
+
+def parse_accept_encoding(header: str) -> Dict[str, float]:
+    """'gzip;q=0.5, br' -> {'gzip': 0.5, 'br': 1.0}. Неразборчивый q считается нулём."""
+    result = {}
+    for part in header.split(','):
+        token, *params = part.split(';')
+        token = token.strip().lower()
+        if not token:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value.strip())
+                except ValueError:
+                    q = 0.0
+        result[token] = q
+    return result
+
+def choose_encoding(header: str) -> Optional[str]:
+    """Кодировка с наибольшим q > 0 (при равенстве – brotli); '*' покрывает неназванные."""
+    accepted = parse_accept_encoding(header)
+    default = accepted.get('*', 0.0)
+    best, best_q = None, 0.0
+    for encoding in (('br', 'gzip') if brotli is not None else ('gzip',)):
+        q = accepted.get(encoding, default)
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+class CompressionMiddleware:
+    """
+    Сжимает ответы не меньше minimum_size байт: brotli, если клиент его
+    принимает и модуль установлен, иначе gzip. Ответы API отдаются одним
+    телом, поэтому тело буферизуется целиком; потоковые ответы не трогаются.
+    """
+
+    def __init__(self, app, minimum_size: int = COMPRESS_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Request(scope).headers.get('accept-encoding', ''))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+
+        async def send_compressed(message):
+            nonlocal start
+            if message['type'] == 'http.response.start':
+                start = message
+                return
+            if start is None or message.get('more_body') or start is False:
+                # Потоковый ответ или уже отправленный заголовок – без сжатия
+                if start:
+                    await send(start)
+                    start = False
+                await send(message)
+                return
+            body = message.get('body', b'')
+            headers = MutableHeaders(raw=start['headers'])
+            if len(body) >= self.minimum_size and 'content-encoding' not in headers:
+                body = brotli.compress(body, quality=4) if encoding == 'br' else gzip.compress(body, compresslevel=6)
+                headers['Content-Encoding'] = encoding
+                headers['Content-Length'] = str(len(body))
+                headers.add_vary_header('Accept-Encoding')
+            await send(start)
+            start = False
+            await send({'type': 'http.response.body', 'body': body})
+
+        await self.app(scope, receive, send_compressed)
+
+# Ключ проверки подписи Web App зависит только от токена – считаем один раз
+WEBAPP_SECRET_KEY = hmac.new(b"WebAppData", TOKEN.encode(), hashlib.sha256).digest()
+
 def verify_telegram_data(bot_token: str, init_data: str) -> dict | None:
     """
     Проверяет подпись данных, полученных от Telegram Web App.
-    Возвращает объект user при успехе, иначе None.
+    Возвращает объект user (с полем auth_date) при успехе, иначе None.
     """
     try:
         data = dict(parse_qsl(init_data))
@@ -2814,7 +4795,10 @@ def verify_telegram_data(bot_token: str, init_data: str) -> dict | None:
         items = sorted(data.items())
         data_check_string = '\n'.join(f"{k}={v}" for k, v in items)
 
-        secret_key = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+        if bot_token == TOKEN:
+            secret_key = WEBAPP_SECRET_KEY
+        else:
+            secret_key = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
         computed_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
 
         if not hmac.compare_digest(computed_hash, received_hash):
@@ -2827,76 +4811,131 @@ def verify_telegram_data(bot_token: str, init_data: str) -> dict | None:
             return None
 
         user = json.loads(user_str)
+        user['auth_date'] = int(data.get('auth_date', 0))
         return user
     except Exception as e:
         logger.error(f"Verification error: {e}")
         return None
 
+class InitDataCache:
+    """
+    LRU проверенных initData. Ключ – sha256 строки initData (сама строка
+    длинная и содержит подпись), запись живёт до auth_date + INIT_DATA_MAX_AGE.
+    Отрицательные результаты не кэшируются.
+    """
+
+    def __init__(self, maxsize: int, max_age: int):
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self._entries: "OrderedDict[bytes, Tuple[dict, float]]" = OrderedDict()
+
+    def verify(self, init_data: str) -> Optional[dict]:
+        key = hashlib.sha256(init_data.encode()).digest()
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            user, expires_at = entry
+            if now < expires_at:
+                self._entries.move_to_end(key)
+                return user
+            del self._entries[key]
+            return None
+
+        user = verify_telegram_data(TOKEN, init_data)
+        if user is None:
+            return None
+        expires_at = user['auth_date'] + self.max_age
+        if now >= expires_at:
+            logger.warning(f"Expired init data for user {user.get('id')}")
+            return None
+        self._entries[key] = (user, expires_at)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return user
+
+init_data_cache = InitDataCache(INIT_DATA_CACHE_SIZE, INIT_DATA_MAX_AGE)
+
+class TelegramAuthMiddleware:
+    """
+    ASGI-middleware для /api/*: проверяет X-Telegram-Init-Data (через
+    init_data_cache) и кладёт пользователя в request.state.user.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] == 'OPTIONS' or not scope['path'].startswith('/api/'):
+            await self.app(scope, receive, send)
+            return
+        init_data = Request(scope).headers.get('x-telegram-init-data')
+        if not init_data:
+            await APIResponse({'error': 'Missing init data'}, status_code=401)(scope, receive, send)
+            return
+        user = init_data_cache.verify(init_data)
+        if not user:
+            await APIResponse({'error': 'Invalid init data'}, status_code=403)(scope, receive, send)
+            return
+        scope.setdefault('state', {})['user'] = user
+        await self.app(scope, receive, send)
+
+class RequestConnectionMiddleware:
+    """ASGI-middleware: каждый запрос к /api/* выполняется в request_connection()."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith('/api/'):
+            await self.app(scope, receive, send)
+            return
+        async with request_connection():
+            await self.app(scope, receive, send)
+
 def rate_limit(max_requests: int, window: float = 1.0):
     """
     Декоратор для ограничения частоты запросов.
     max_requests – максимальное количество запросов в окне window (секунд).
     """
     def decorator(func):
+        limiter = RateLimiter(max_requests / window, max_requests)
+        rate_limiters[func.__name__] = limiter
+
         async def wrapper(request):
-            # Извлекаем пользователя из initData
-            init_data = request.headers.get('x-telegram-init-data')
-            if not init_data:
-                return JSONResponse({'error': 'Missing init data'}, status_code=401)
-            user = verify_telegram_data(TOKEN, init_data)
-            if not user:
-                return JSONResponse({'error': 'Invalid init data'}, status_code=403)
-            uid = user['id']
-
-            now = time.time()
-            # Получаем историю для этого пользователя
-            history = request_history[uid]
-            # Оставляем только запросы, попавшие в окно
-            # Используем срез, чтобы не создавать новый список
-            history[:] = [t for t in history if now - t < window]
-
-            if len(history) >= max_requests:
-                return JSONResponse({
+            # Пользователь уже проверен TelegramAuthMiddleware
+            user = request.state.user
+
+            if not limiter.allow(user['id']):
+                return APIResponse({
                     'error': 'Too many requests. Please slow down.'
                 }, status_code=429)
 
-            # Добавляем текущий запрос
-            history.append(now)
-            # Ограничиваем размер истории (чтобы она не росла бесконечно)
-            if len(history) > max_requests * 2:
-                history[:] = history[-max_requests:]
-
             return await func(request)
         return wrapper
     return decorator
 
-async def api_user(request):
-    init_data = request.headers.get('x-telegram-init-data')
-    if not init_data:
-        return JSONResponse({'error': 'Missing init data'}, status_code=401)
+def rate_limit_stats() -> dict:
+    return {name: {'users': len(limiter.buckets), 'bytes': limiter.memory_usage()}
+            for name, limiter in rate_limiters.items()}
 
-    user = verify_telegram_data(TOKEN, init_data)
-    if not user:
-        return JSONResponse({'error': 'Invalid init data'}, status_code=403)
+async def api_user(request):
+    user = request.state.user
 
     uid = user['id']
-    async with db_pool.acquire() as conn:
-        await check_and_reset_bosses(conn)
-        stats = await get_player_stats(uid, conn)
-        inv = await get_inventory(uid, conn)
-        current_location = await get_player_current_location(uid, conn)
-        active_tool_id = await get_active_tool(uid, conn)
-        active_tool_name = TOOLS.get(active_tool_id, {}).get('name', active_tool_id)
-
-        boss_progress = {}
-        rows = await conn.fetch("SELECT boss_id, current_health, defeated FROM boss_progress WHERE user_id = $1", uid)
-        for row in rows:
-            boss_progress[row['boss_id']] = {
-                'current_health': row['current_health'],
-                'defeated': row['defeated']
-            }
-
-    return JSONResponse({
+    state = await get_player_state(uid)
+    if state is None:
+        return APIResponse({'error': 'Player not found'}, status_code=404)
+    stats = state.stats()
+    inv = state.inventory_dict()
+    current_location = state.current_location
+    active_tool_name = TOOLS.get(state.active_tool, {}).get('name', state.active_tool)
+    async with acquire_conn() as conn:
+        rows = await conn.fetch("SELECT boss_id, current_health, defeated, epoch FROM boss_progress WHERE user_id = $1", uid)
+    epoch = boss_epoch()
+    boss_progress = {row['boss_id']: boss_state(row, row['boss_id'], epoch)
+                     for row in rows if row['boss_id'] in BOSS_LOCATIONS}
+
+    return APIResponse({
         'id': uid,
         'level': stats['level'],
         'exp': stats['exp'],
@@ -2910,101 +4949,46 @@ async def api_user(request):
 
 @rate_limit(BOSS_ATTACK_LIMIT)
 async def api_boss_attack(request):
-    init_data = request.headers.get('x-telegram-init-data')
-    if not init_data:
-        return JSONResponse({'error': 'Missing init data'}, status_code=401)
-
-    user = verify_telegram_data(TOKEN, init_data)
-    if not user:
-        return JSONResponse({'error': 'Invalid init data'}, status_code=403)
+    user = request.state.user
 
     uid = user['id']
 
     body = await request.json()
     boss_id = body.get('boss_id')
     if not boss_id or boss_id not in BOSS_LOCATIONS:
-        return JSONResponse({'error': 'Invalid boss_id'}, status_code=400)
+        return APIResponse({'error': 'Invalid boss_id'}, status_code=400)
 
     bloc = BOSS_LOCATIONS[boss_id]
 
-    async with db_pool.acquire() as conn:
-        await check_and_reset_bosses(conn)
-        async with conn.transaction():
+    async with acquire_conn() as conn:
+        async with transaction(conn):
             stats = await get_player_stats(uid, conn)
             if stats['level'] < bloc['min_level']:
-                return JSONResponse({'error': 'Level too low'}, status_code=403)
+                return APIResponse({'error': 'Level too low'}, status_code=403)
             tool_level = await get_active_tool_level(uid, conn)
             if tool_level < bloc['min_tool_level']:
-                return JSONResponse({'error': 'Tool level too low'}, status_code=403)
-
-            prog_row = await conn.fetchrow(
-                "SELECT current_health, defeated FROM boss_progress WHERE user_id = $1 AND boss_id = $2 FOR UPDATE",
-                uid, boss_id
-            )
-            if not prog_row:
-                await conn.execute(
-                    "INSERT INTO boss_progress (user_id, boss_id, current_health) VALUES ($1, $2, $3)",
-                    uid, boss_id, bloc['boss']['health']
-                )
-                current_health = bloc['boss']['health']
-                defeated = False
-            else:
-                current_health = prog_row['current_health']
-                defeated = prog_row['defeated']
+                return APIResponse({'error': 'Tool level too low'}, status_code=403)
 
-            if defeated:
-                return JSONResponse({'error': 'Boss already defeated'}, status_code=400)
-            if current_health <= 0:
-                return JSONResponse({'error': 'Boss already dead'}, status_code=400)
+            progress = await get_boss_progress(uid, boss_id, conn)
+            if progress['defeated']:
+                return APIResponse({'error': 'Boss already defeated'}, status_code=400)
 
-            # ----- НАЧАЛО НОВОГО КОДА (ЭФФЕКТЫ) -----
             effects = await get_active_effects(uid, conn)
-            exp_multiplier = 1.0
-            crit_bonus = 0
-            for eff in effects.values():
-                if 'exp_multiplier' in eff:
-                    exp_multiplier *= eff['exp_multiplier']
-                if 'crit_chance_bonus' in eff:
-                    crit_bonus += eff['crit_chance_bonus']
-            # ----- КОНЕЦ НОВОГО КОДА -----
-
-            gold_damage, exp, is_crit = get_click_reward(stats)
-            # Применяем эффекты
-            exp = int(exp * exp_multiplier)
-            if crit_bonus:
-                extra_crit = random.random() < crit_bonus / 100
-                if extra_crit and not is_crit:
-                    is_crit = True
-                    gold_damage *= 2
-                    exp *= 2
+            exp_multiplier, crit_bonus = effect_modifiers(effects.values())
+            gold_damage, exp, is_crit = get_effect_reward(stats, exp_multiplier, crit_bonus)
 
             damage = gold_damage
             if is_crit:
                 damage *= 2
 
-            update_result = await conn.execute("""
-                UPDATE boss_progress
-                SET current_health = current_health - $1
-                WHERE user_id = $2 AND boss_id = $3 AND current_health > 0
-            """, damage, uid, boss_id)
-
-            if update_result == "UPDATE 0":
-                return JSONResponse({'error': 'Boss already defeated by another attack'}, status_code=409)
-
-            new_health_row = await conn.fetchrow(
-                "SELECT current_health FROM boss_progress WHERE user_id = $1 AND boss_id = $2",
-                uid, boss_id
-            )
-            new_health = new_health_row['current_health']
-            defeated_now = new_health <= 0
+            attack = await attack_boss(uid, boss_id, damage, conn)
+            if attack is None:
+                return APIResponse({'error': 'Boss already defeated by another attack'}, status_code=409)
+            new_health = attack['current_health']
+            defeated_now = attack['defeated']
 
             loot_items = []
             if defeated_now:
-                await conn.execute(
-                    "UPDATE boss_progress SET defeated = TRUE WHERE user_id = $1 AND boss_id = $2",
-                    uid, boss_id
-                )
-
                 boss = bloc['boss']
                 gold_reward = boss['reward_gold']
                 exp_reward = boss['exp_reward']
@@ -3018,16 +5002,19 @@ async def api_boss_attack(request):
                 )
                 await level_up_if_needed(uid, conn)
 
-                for res, (min_amt, max_amt) in boss['reward_resources'].items():
-                    amt = random.randint(min_amt, max_amt)
-                    await add_resource(uid, res, amt, conn)
+                loot = {res: random.randint(min_amt, max_amt)
+                        for res, (min_amt, max_amt) in boss['reward_resources'].items()}
+                await apply_resource_deltas(uid, loot, conn)
+                for res, amt in loot.items():
                     res_name = RESOURCES.get(res, {}).get('name', res)
                     loot_items.append(f"{res_name} x{amt}")
 
             new_stats = await get_player_stats(uid, conn)
             new_inv = await get_inventory(uid, conn)
+    player_cache.invalidate(uid)
+    leaderboards.update_player(uid, new_stats, new_inv)
 
-    return JSONResponse({
+    return APIResponse({
         'damage': damage,
         'is_crit': is_crit,
         'defeated': defeated_now,
@@ -3040,20 +5027,13 @@ async def api_boss_attack(request):
     })
 
 async def api_boss_info(request):
-    init_data = request.headers.get('x-telegram-init-data')
-    if not init_data:
-        return JSONResponse({'error': 'Missing init data'}, status_code=401)
-    user = verify_telegram_data(TOKEN, init_data)
-    if not user:
-        return JSONResponse({'error': 'Invalid init data'}, status_code=403)
+    user = request.state.user
     uid = user['id']
     boss_id = request.path_params.get('boss_id')
     if not boss_id or boss_id not in BOSS_LOCATIONS:
-        return JSONResponse({'error': 'Invalid boss_id'}, status_code=400)
-    async with db_pool.acquire() as conn:
-        await check_and_reset_bosses(conn)
-        prog = await get_boss_progress(uid, boss_id, conn)
-    return JSONResponse({
+        return APIResponse({'error': 'Invalid boss_id'}, status_code=400)
+    prog = await get_boss_progress(uid, boss_id)
+    return APIResponse({
         'current_health': prog['current_health'],
         'defeated': prog['defeated'],
         'max_health': BOSS_LOCATIONS[boss_id]['boss']['health']
@@ -3061,42 +5041,168 @@ async def api_boss_info(request):
 
 @rate_limit(CLICK_LIMIT)
 async def api_click(request):
-    init_data = request.headers.get('x-telegram-init-data')
-    if not init_data:
-        return JSONResponse({'error': 'Missing init data'}, status_code=401)
-
-    user = verify_telegram_data(TOKEN, init_data)
-    if not user:
-        return JSONResponse({'error': 'Invalid init data'}, status_code=403)
+    user = request.state.user
 
     uid = user['id']
     result = await process_click(uid)
-    return JSONResponse(result)
+    return APIResponse(result)
+
+@rate_limit(CLICK_BATCH_LIMIT)
+async def api_click_batch(request):
+    user = request.state.user
+
+    uid = user['id']
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None
+    if not isinstance(body, dict):
+        return APIResponse({'error': 'Invalid batch'}, status_code=400)
+    try:
+        count = int(body.get('count', 0))
+    except (TypeError, ValueError):
+        return APIResponse({'error': 'Invalid batch'}, status_code=400)
+    if count <= 0:
+        return APIResponse({'error': 'Invalid batch'}, status_code=400)
+
+    # Больше, чем накопилось токенов кликов, засчитать нельзя
+    allowed = click_tokens.take(uid, count)
+    if allowed < count:
+        logger.warning(f"User {uid} sent {count} clicks, accepted {allowed}")
+    if allowed == 0:
+        return APIResponse({'error': 'Too many requests. Please slow down.'}, status_code=429)
+
+    result = await process_click_batch(uid, allowed)
+    result['accepted'] = allowed
+    return APIResponse(result)
+
+async def api_leaderboard(request):
+    user = request.state.user
+
+    uid = user['id']
+    category = request.path_params['category']
+    if category not in LEADERBOARD_VIEWS:
+        return APIResponse({'error': 'Unknown category'}, status_code=404)
+
+    # Курсор keyset-пагинации: "очки:user_id" последней записи предыдущей страницы
+    after = None
+    cursor = request.query_params.get('after')
+    try:
+        limit = min(max(int(request.query_params.get('limit', LEADERBOARD_PAGE_SIZE)), 1), 100)
+        if cursor:
+            score, cursor_uid = cursor.split(':')
+            after = (int(score), int(cursor_uid))
+    except ValueError:
+        return APIResponse({'error': 'Invalid cursor'}, status_code=400)
+
+    def pack(entries):
+        return [{'rank': rank + 1, 'name': name or 'Аноним', 'score': score, 'me': entry_uid == uid}
+                for rank, entry_uid, name, score in entries]
+
+    entries = leaderboards.page(category, after, limit)
+    me = leaderboards.rank(category, uid)
+    next_cursor = None
+    if len(entries) == limit:
+        _, last_uid, _, last_score = entries[-1]
+        next_cursor = f"{last_score}:{last_uid}"
+    return APIResponse({
+        'category': category,
+        'entries': pack(entries),
+        'next': next_cursor,
+        'me': {'rank': me[0] + 1, 'score': me[1]} if me else None,
+        'around': pack(leaderboards.around(category, uid, LEADERBOARD_RADIUS)),
+    })
 
 # ==================== ЗАПУСК ====================
 
-async def run_bot():
-    logger.info("Starting bot polling...")
-    app_bot = Application.builder().token(TOKEN).build()
-    app_bot.add_handler(CommandHandler("start", start))
-    app_bot.add_handler(CommandHandler("mine", cmd_mine))
-    app_bot.add_handler(CommandHandler("locations", cmd_locations))
-    app_bot.add_handler(CommandHandler("shop", cmd_shop))
-    app_bot.add_handler(CommandHandler("tasks", cmd_tasks))
-    app_bot.add_handler(CommandHandler("profile", cmd_profile))
-    app_bot.add_handler(CommandHandler("inventory", cmd_inventory))
-    app_bot.add_handler(CommandHandler("market", cmd_market))
-    app_bot.add_handler(CommandHandler("leaderboard", cmd_leaderboard))
-    app_bot.add_handler(CommandHandler("faq", cmd_faq))
-    app_bot.add_handler(CommandHandler("achievements", cmd_achievements))
-    app_bot.add_handler(CommandHandler("help", cmd_help))
+UPDATE_DROPPED_TEXT = "⏳ Подождите, предыдущие действия ещё выполняются"
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обновления разных пользователей обрабатываются параллельно, одного
+    пользователя – строго по очереди (двойное нажатие «Добыть» не гоняется
+    само с собой). Семафор базового класса ограничивает число принятых
+    обновлений (max_concurrent_updates), свой – число выполняемых: ожидающие
+    своей очереди обновления пользователя слот выполнения не занимают.
+    Если у пользователя уже max_per_user обновлений в работе и в очереди,
+    новые отбрасываются и не держат слот базового семафора; на отброшенное
+    нажатие кнопки сразу отвечается «подождите», чтобы не висел индикатор.
+    """
+
+    def __init__(self, max_running: int, max_pending: int, max_per_user: int = BOT_USER_PENDING_UPDATES):
+        super().__init__(max(max_running, max_pending))
+        self.max_per_user = max_per_user
+        self.dropped = 0
+        self._running = asyncio.Semaphore(max_running)
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._queued: Dict[int, int] = {}
+
+    async def do_process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self._running:
+                await coroutine
+            return
+        uid = user.id
+        if self._queued.get(uid, 0) >= self.max_per_user:
+            coroutine.close()
+            self.dropped += 1
+            logger.warning(f"Dropped update from user {uid}: {self.max_per_user} already queued")
+            if update.callback_query is not None:
+                try:
+                    await update.callback_query.answer(UPDATE_DROPPED_TEXT)
+                except TelegramError as e:
+                    logger.warning(f"Failed to answer dropped callback of {uid}: {e}")
+            return
+        lock = self._locks.get(uid)
+        if lock is None:
+            lock = self._locks[uid] = asyncio.Lock()
+        self._queued[uid] = self._queued.get(uid, 0) + 1
+        try:
+            async with lock:
+                async with self._running:
+                    await coroutine
+        finally:
+            self._queued[uid] -= 1
+            if not self._queued[uid]:
+                del self._queued[uid]
+                del self._locks[uid]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def build_bot_application() -> Application:
+    app_bot = (Application.builder()
+               .token(TOKEN)
+               .concurrent_updates(PerUserUpdateProcessor(BOT_CONCURRENT_UPDATES, BOT_PENDING_UPDATES))
+               .build())
+    app_bot.add_handler(CommandHandler("start", request_scoped(start)))
+    app_bot.add_handler(CommandHandler("mine", request_scoped(cmd_mine)))
+    app_bot.add_handler(CommandHandler("locations", request_scoped(cmd_locations)))
+    app_bot.add_handler(CommandHandler("shop", request_scoped(cmd_shop)))
+    app_bot.add_handler(CommandHandler("tasks", request_scoped(cmd_tasks)))
+    app_bot.add_handler(CommandHandler("profile", request_scoped(cmd_profile)))
+    app_bot.add_handler(CommandHandler("inventory", request_scoped(cmd_inventory)))
+    app_bot.add_handler(CommandHandler("market", request_scoped(cmd_market)))
+    app_bot.add_handler(CommandHandler("leaderboard", request_scoped(cmd_leaderboard)))
+    app_bot.add_handler(CommandHandler("faq", request_scoped(cmd_faq)))
+    app_bot.add_handler(CommandHandler("achievements", request_scoped(cmd_achievements)))
+    app_bot.add_handler(CommandHandler("help", request_scoped(cmd_help)))
     app_bot.add_handler(CallbackQueryHandler(button_handler))
-    app_bot.add_handler(CommandHandler("myid", cmd_myid))
+    app_bot.add_handler(CommandHandler("myid", request_scoped(cmd_myid)))
+    return app_bot
 
+async def run_bot():
+    logger.info("Starting bot polling...")
+    app_bot = build_bot_application()
     try:
         await app_bot.bot.delete_webhook(drop_pending_updates=True)
         await app_bot.initialize()
         await app_bot.start()
+        outbox.start(app_bot.bot)
         await app_bot.updater.start_polling()
         logger.info("Bot polling started successfully")
         while True:
@@ -3104,58 +5210,122 @@ async def run_bot():
     except Exception as e:
         logger.error(f"Error in bot polling: {e}", exc_info=True)
     finally:
-        await app_bot.stop()
+        if app_bot.updater.running:
+            await app_bot.updater.stop()
+        if app_bot.running:
+            await app_bot.stop()
+        await app_bot.shutdown()
+
+# Задача run_bot в режиме polling
+bot_task: Optional[asyncio.Task] = None
+
+async def stop_polling_bot():
+    """Останавливает run_bot, чтобы после этого не приходили новые обновления."""
+    global bot_task
+    if bot_task is not None:
+        bot_task.cancel()
+        try:
+            await bot_task
+        except asyncio.CancelledError:
+            pass
+        bot_task = None
+
+# Приложение бота в режиме webhook (в режиме polling живёт внутри run_bot)
+bot_app: Optional[Application] = None
+
+async def start_webhook_bot():
+    """Запускает обработку update_queue и регистрирует webhook в Telegram."""
+    global bot_app
+    bot_app = build_bot_application()
+    await bot_app.initialize()
+    await bot_app.start()
+    await bot_app.bot.set_webhook(
+        url=f"{WEBHOOK_URL}/telegram/webhook/{WEBHOOK_SECRET}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+    )
+    outbox.start(bot_app.bot)
+    logger.info("Bot webhook registered")
+
+async def stop_webhook_bot():
+    # Webhook не снимаем: его продолжают обслуживать другие экземпляры
+    if bot_app is not None:
+        await bot_app.stop()
+        await bot_app.shutdown()
+
+async def telegram_webhook(request):
+    """
+    Принимает обновление от Telegram и кладёт его в update_queue; обработка
+    идёт в фоне, поэтому ответ уходит сразу.
+    """
+    header = request.headers.get('x-telegram-bot-api-secret-token', '')
+    if (bot_app is None
+            or not hmac.compare_digest(request.path_params['secret'], WEBHOOK_SECRET)
+            or not hmac.compare_digest(header, WEBHOOK_SECRET)):
+        return Response(status_code=403)
+    # Битое обновление подтверждаем 200: иначе Telegram будет слать его повторно
+    try:
+        update = Update.de_json(await request.json(), bot_app.bot)
+    except Exception as e:
+        logger.warning(f"Malformed Telegram update: {e!r}")
+        return Response(status_code=200)
+    if update is None:
+        logger.warning("Empty Telegram update ignored")
+        return Response(status_code=200)
+    bot_app.update_queue.put_nowait(update)
+    return Response(status_code=200)
 
 async def healthcheck(request):
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await conn.fetchval("SELECT 1")
-        return JSONResponse({"status": "alive", "db": "ok"})
+        return APIResponse({
+            "status": "alive", "db": "ok",
+            "rate_limits": rate_limit_stats(),
+            "pool": pool_stats(),
+            "queries": queries.report(),
+            "outbox": outbox.stats(),
+            "views": views.stats(),
+        })
     except Exception as e:
         logger.error(f"Healthcheck DB error: {e}")
-        return JSONResponse({"status": "alive", "db": "error"}, status_code=500)
+        return APIResponse({"status": "alive", "db": "error"}, status_code=500)
+
+# Неизменная часть списка рецептов для /api/craft/recipes
+CRAFT_RECIPES_PUBLIC = [{**recipe, 'id': rid} for rid, recipe in CRAFT_RECIPES.items()]
 
 async def api_craft_recipes(request):
-    init_data = request.headers.get('x-telegram-init-data')
-    if not init_data:
-        return JSONResponse({'error': 'Missing init data'}, status_code=401)
-    user = verify_telegram_data(TOKEN, init_data)
-    if not user:
-        return JSONResponse({'error': 'Invalid init data'}, status_code=403)
+    user = request.state.user
 
     uid = user['id']
-    async with db_pool.acquire() as conn:
-        inv = await get_inventory(uid, conn)
+    inv = await get_inventory(uid)
     recipes = []
-    for rid, recipe in CRAFT_RECIPES.items():
-        recipe_copy = recipe.copy()
-        recipe_copy['id'] = rid
-        recipe_copy['can_craft'] = all(inv.get(res, 0) >= need for res, need in recipe['resources'].items())
-        recipe_copy['resources_available'] = {res: inv.get(res, 0) for res in recipe['resources']}
-        recipes.append(recipe_copy)
-    return JSONResponse({'recipes': recipes})
+    for recipe in CRAFT_RECIPES_PUBLIC:
+        available = {res: inv.get(res, 0) for res in recipe['resources']}
+        recipes.append({
+            **recipe,
+            'can_craft': all(available[res] >= need for res, need in recipe['resources'].items()),
+            'resources_available': available,
+        })
+    return APIResponse({'recipes': recipes})
 
+@rate_limit(CRAFT_LIMIT)
 async def api_craft(request):
-    init_data = request.headers.get('x-telegram-init-data')
-    if not init_data:
-        return JSONResponse({'error': 'Missing init data'}, status_code=401)
-    user = verify_telegram_data(TOKEN, init_data)
-    if not user:
-        return JSONResponse({'error': 'Invalid init data'}, status_code=403)
+    user = request.state.user
 
     uid = user['id']
     body = await request.json()
     recipe_id = body.get('recipe_id')
     if not recipe_id or recipe_id not in CRAFT_RECIPES:
-        return JSONResponse({'error': 'Invalid recipe_id'}, status_code=400)
+        return APIResponse({'error': 'Invalid recipe_id'}, status_code=400)
 
     success, message = await craft_item(uid, recipe_id)
     if success:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             new_inv = await get_inventory(uid, conn)
             new_items = await get_player_items(uid, conn)
             new_stats = await get_player_stats(uid, conn)
-        return JSONResponse({
+        return APIResponse({
             'success': True,
             'message': message,
             'inventory': new_inv,
@@ -3164,18 +5334,13 @@ async def api_craft(request):
             'exp': new_stats['exp']
         })
     else:
-        return JSONResponse({'success': False, 'message': message}, status_code=400)
+        return APIResponse({'success': False, 'message': message}, status_code=400)
 
 async def api_items(request):
-    init_data = request.headers.get('x-telegram-init-data')
-    if not init_data:
-        return JSONResponse({'error': 'Missing init data'}, status_code=401)
-    user = verify_telegram_data(TOKEN, init_data)
-    if not user:
-        return JSONResponse({'error': 'Invalid init data'}, status_code=403)
+    user = request.state.user
 
     uid = user['id']
-    async with db_pool.acquire() as conn:
+    async with acquire_conn() as conn:
         items_dict = await get_player_items(uid, conn)
         items_list = []
         for item_id, qty in items_dict.items():
@@ -3194,15 +5359,11 @@ async def api_items(request):
             else:
                 # Если предмет не из рецептов (например, legacy)
                 items_list.append({'id': item_id, 'quantity': qty, 'name': item_id})
-    return JSONResponse({'items': items_list})
+    return APIResponse({'items': items_list})
 
+@rate_limit(USE_ITEM_LIMIT)
 async def api_use_item(request):
-    init_data = request.headers.get('x-telegram-init-data')
-    if not init_data:
-        return JSONResponse({'error': 'Missing init data'}, status_code=401)
-    user = verify_telegram_data(TOKEN, init_data)
-    if not user:
-        return JSONResponse({'error': 'Invalid init data'}, status_code=403)
+    user = request.state.user
 
     uid = user['id']
     body = await request.json()
@@ -3210,20 +5371,20 @@ async def api_use_item(request):
     quantity = body.get('quantity', 1)
 
     if not item_id:
-        return JSONResponse({'error': 'Missing item_id'}, status_code=400)
+        return APIResponse({'error': 'Missing item_id'}, status_code=400)
 
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():
+    async with acquire_conn() as conn:
+        async with transaction(conn):
             cur_qty = await conn.fetchval(
-                "SELECT quantity FROM player_items WHERE user_id = $1 AND item_id = $2",
+                "SELECT quantity FROM player_items WHERE user_id = $1 AND item_id = $2 FOR UPDATE",
                 uid, item_id
             )
             if not cur_qty or cur_qty < quantity:
-                return JSONResponse({'error': 'Not enough items'}, status_code=400)
+                return APIResponse({'error': 'Not enough items'}, status_code=400)
 
             recipe = next((r for r in CRAFT_RECIPES.values() if r['result_item_id'] == item_id), None)
             if not recipe:
-                return JSONResponse({'error': 'Unknown item'}, status_code=400)
+                return APIResponse({'error': 'Unknown item'}, status_code=400)
 
             result_type = recipe.get('result_type')
             effect = recipe.get('effect', {})
@@ -3235,12 +5396,12 @@ async def api_use_item(request):
                     max_hp = BOSS_LOCATIONS[boss_id]['boss']['health']
                     await conn.execute("""
                         UPDATE boss_progress
-                        SET defeated = FALSE, current_health = $1
+                        SET defeated = FALSE, current_health = $1, epoch = $4
                         WHERE user_id = $2 AND boss_id = $3
-                    """, max_hp, uid, boss_id)
+                    """, max_hp, uid, boss_id, boss_epoch())
                     message = f"🔑 Ключ использован, босс {BOSS_LOCATIONS[boss_id]['name']} снова доступен!"
                 else:
-                    return JSONResponse({'error': 'Invalid key effect'}, status_code=400)
+                    return APIResponse({'error': 'Invalid key effect'}, status_code=400)
 
             elif result_type == 'consumable':
                 duration = recipe.get('duration', 0)
@@ -3266,7 +5427,7 @@ async def api_use_item(request):
                 message = f"⚔️ Модификатор {recipe['name']} применён постоянно."
 
             else:
-                return JSONResponse({'error': 'Item type not usable'}, status_code=400)
+                return APIResponse({'error': 'Item type not usable'}, status_code=400)
 
             # Удаляем использованный предмет
             new_qty = cur_qty - quantity
@@ -3280,18 +5441,40 @@ async def api_use_item(request):
                     "UPDATE player_items SET quantity = $1 WHERE user_id = $2 AND item_id = $3",
                     new_qty, uid, item_id
                 )
+    player_cache.invalidate(uid)
 
-    return JSONResponse({'success': True, 'message': message})
+    return APIResponse({'success': True, 'message': message})
 
 async def startup_event():
     logger.info("Starting up...")
-    global db_pool
-    db_pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=10)
+    global db_pool, bot_task
+    db_pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        init=queries.prepare_all,
+    )
     await init_db()
-    asyncio.create_task(run_bot())
+    await warm_pool()
+    async with acquire_conn() as conn:
+        await leaderboards.rebuild(conn)
+    if click_accumulator is not None:
+        click_accumulator.start()
+    if BOT_MODE == 'webhook':
+        await start_webhook_bot()
+    else:
+        bot_task = asyncio.create_task(run_bot())
 
 async def shutdown_event():
     logger.info("Shutting down...")
+    await outbox.close()  # дописывает текущую пачку, пока бот ещё работает
+    # Новые обновления (а с ними и клики) перестают приходить до сброса кликов
+    await stop_polling_bot()
+    await stop_webhook_bot()
+    if click_accumulator is not None:
+        await click_accumulator.close()
     if db_pool:
         await db_pool.close()
 
@@ -3305,15 +5488,22 @@ app = Starlette(
 app.router.routes.extend([
     Route('/api/user', api_user, methods=['GET']),
     Route('/api/click', api_click, methods=['POST']),          # добавлено
+    Route('/api/click/batch', api_click_batch, methods=['POST']),
     Route('/api/boss/attack', api_boss_attack, methods=['POST']), # добавлено
     Route('/api/boss/{boss_id}', api_boss_info, methods=['GET']),
     Route('/api/craft/recipes', api_craft_recipes, methods=['GET']),
     Route('/api/craft', api_craft, methods=['POST']),
     Route('/api/items', api_items, methods=['GET']),
     Route('/api/items/use', api_use_item, methods=['POST']),
+    Route('/api/leaderboard/{category}', api_leaderboard, methods=['GET']),
 ])
+if BOT_MODE == 'webhook':
+    app.router.routes.append(Route('/telegram/webhook/{secret}', telegram_webhook, methods=['POST']))
 
 # Добавляем CORS middleware
+app.add_middleware(RequestConnectionMiddleware)
+app.add_middleware(TelegramAuthMiddleware)
+app.add_middleware(CompressionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # Временно разрешаем все домены (для теста)
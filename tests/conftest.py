@@ -0,0 +1,57 @@
+import asyncio
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_deps  # noqa: E402
+
+fake_deps.install()
+
+os.environ.setdefault('BOT_TOKEN', 'test-token')
+os.environ.setdefault('DATABASE_URL', 'postgresql://localhost/test')
+
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+
+
+@pytest.fixture
+def pg(monkeypatch):
+    """
+    Временная база после всех MIGRATIONS на сервере TEST_DATABASE_URL
+    (тест пропускается, если его нет). pg(coro) выполняет корутину в
+    собственном цикле событий с bot.db_pool, указывающим на эту базу.
+    """
+    import asyncpg
+    import bot
+
+    if not hasattr(asyncpg, 'connect'):
+        pytest.skip("asyncpg is not installed")
+    if not TEST_DATABASE_URL:
+        pytest.skip("needs PostgreSQL: set TEST_DATABASE_URL")
+    database = f"bot_test_{uuid.uuid4().hex[:12]}"
+    loop = asyncio.new_event_loop()
+    monkeypatch.setattr(bot, 'player_cache', bot.PlayerStateCache(100, 60))
+
+    async def setup():
+        admin = await asyncpg.connect(TEST_DATABASE_URL)
+        await admin.execute(f'CREATE DATABASE "{database}"')
+        await admin.close()
+        monkeypatch.setattr(bot, 'db_pool', await asyncpg.create_pool(
+            TEST_DATABASE_URL, database=database, min_size=1, max_size=2))
+        await bot.init_db()
+
+    async def teardown():
+        await bot.db_pool.close()
+        admin = await asyncpg.connect(TEST_DATABASE_URL)
+        await admin.execute(f'DROP DATABASE "{database}"')
+        await admin.close()
+
+    loop.run_until_complete(setup())
+    try:
+        yield loop.run_until_complete
+    finally:
+        loop.run_until_complete(teardown())
+        loop.close()
@@ -0,0 +1,265 @@
+"""
+Заменители telegram, starlette, uvicorn и asyncpg для тестов и бенчмарков.
+
+Ставятся в sys.modules только для тех пакетов, которые не установлены, так
+что при полном окружении из requirements.txt тесты идут на настоящих
+библиотеках. Повторяют лишь то, что bot.py использует при импорте и на
+проверяемых путях: равенство клавиатур по содержимому, экранирование
+Markdown v1, семафор BaseUpdateProcessor и т.п.
+"""
+import asyncio
+import importlib.util
+import json
+import re
+import sys
+import types
+
+
+def _module(name: str, **attrs) -> types.ModuleType:
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+# ---------- telegram ----------
+
+class TelegramObject:
+    _fields = ()
+
+    def __init__(self, *args, **kwargs):
+        for name, value in zip(self._fields, args):
+            setattr(self, name, value)
+        for name in self._fields[len(args):]:
+            setattr(self, name, kwargs.get(name))
+
+    def _key(self):
+        return tuple(getattr(self, name) for name in self._fields)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+
+class InlineKeyboardButton(TelegramObject):
+    _fields = ('text', 'callback_data', 'url', 'web_app')
+
+
+class InlineKeyboardMarkup(TelegramObject):
+    _fields = ('inline_keyboard',)
+
+    def __init__(self, inline_keyboard):
+        self.inline_keyboard = tuple(tuple(row) for row in inline_keyboard)
+
+
+class WebAppInfo(TelegramObject):
+    _fields = ('url',)
+
+
+class Chat(TelegramObject):
+    _fields = ('id', 'type')
+
+
+class Message(TelegramObject):
+    _fields = ('message_id', 'date', 'chat', 'text', 'reply_markup')
+
+
+class Update(TelegramObject):
+    _fields = ('update_id', 'message', 'callback_query', 'effective_user')
+
+    @classmethod
+    def de_json(cls, data, bot):
+        if not data:
+            return None
+        if not isinstance(data, dict) or 'update_id' not in data:
+            raise KeyError('update_id')
+        return cls(data['update_id'])
+
+
+class TelegramError(Exception):
+    pass
+
+
+class BadRequest(TelegramError):
+    pass
+
+
+class Forbidden(TelegramError):
+    pass
+
+
+class RetryAfter(TelegramError):
+    def __init__(self, retry_after):
+        super().__init__(f"Flood control exceeded. Retry in {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+def escape_markdown(text: str, version: int = 1, entity_type: str = None) -> str:
+    return re.sub(r'([_*`\[])', r'\\\1', text)
+
+
+class BaseUpdateProcessor:
+    """Как в python-telegram-bot 20.x: семафор на max_concurrent_updates вокруг do_process_update."""
+
+    def __init__(self, max_concurrent_updates: int):
+        self._max_concurrent_updates = max_concurrent_updates
+        self._semaphore = asyncio.BoundedSemaphore(max_concurrent_updates)
+
+    @property
+    def max_concurrent_updates(self) -> int:
+        return self._max_concurrent_updates
+
+    async def process_update(self, update, coroutine):
+        async with self._semaphore:
+            await self.do_process_update(update, coroutine)
+
+
+class _Handler:
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+
+
+class ContextTypes:
+    DEFAULT_TYPE = object
+
+
+class Application:
+    @classmethod
+    def builder(cls):
+        raise RuntimeError("python-telegram-bot is not installed")
+
+
+# ---------- starlette ----------
+
+class Headers:
+    def __init__(self, scope=None, raw=None):
+        raw = raw if raw is not None else (scope or {}).get('headers', [])
+        self.raw = raw
+
+    def get(self, key: str, default=None):
+        key = key.lower().encode('latin-1')
+        for name, value in self.raw:
+            if name.lower() == key:
+                return value.decode('latin-1')
+        return default
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+
+class MutableHeaders(Headers):
+    def __setitem__(self, key: str, value: str):
+        key = key.lower().encode('latin-1')
+        self.raw[:] = [(k, v) for k, v in self.raw if k.lower() != key]
+        self.raw.append((key, value.encode('latin-1')))
+
+    def __delitem__(self, key: str):
+        key = key.lower().encode('latin-1')
+        self.raw[:] = [(k, v) for k, v in self.raw if k.lower() != key]
+
+    def add_vary_header(self, vary: str):
+        existing = self.get('vary')
+        self['vary'] = f"{existing}, {vary}" if existing else vary
+
+
+class Request:
+    def __init__(self, scope, receive=None):
+        self.scope = scope
+        self.headers = Headers(scope)
+        self.path_params = scope.get('path_params', {})
+        self._body = scope.get('body', b'')
+
+    async def json(self):
+        return json.loads(self._body)
+
+
+class Response:
+    media_type = None
+
+    def __init__(self, content=None, status_code: int = 200, headers=None, media_type=None):
+        self.status_code = status_code
+        self.headers = dict(headers or {})
+        self.body = self.render(content)
+
+    def render(self, content) -> bytes:
+        if content is None:
+            return b''
+        return content if isinstance(content, bytes) else content.encode('utf-8')
+
+    async def __call__(self, scope, receive, send):
+        await send({'type': 'http.response.start', 'status': self.status_code,
+                    'headers': [(k.encode('latin-1'), v.encode('latin-1')) for k, v in self.headers.items()]})
+        await send({'type': 'http.response.body', 'body': self.body})
+
+
+class JSONResponse(Response):
+    media_type = 'application/json'
+
+    def render(self, content) -> bytes:
+        return json.dumps(content, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class Route:
+    def __init__(self, path, endpoint, methods=None):
+        self.path = path
+        self.endpoint = endpoint
+        self.methods = methods
+
+
+class _Router:
+    def __init__(self, routes):
+        self.routes = list(routes or [])
+
+
+class Starlette:
+    def __init__(self, routes=None, **kwargs):
+        self.router = _Router(routes)
+        self.middleware = []
+        self.kwargs = kwargs
+
+    def add_middleware(self, cls, **options):
+        self.middleware.append((cls, options))
+
+
+class CORSMiddleware:
+    def __init__(self, app, **options):
+        self.app = app
+
+
+# ---------- asyncpg ----------
+
+class PostgresError(Exception):
+    pass
+
+
+async def create_pool(*args, **kwargs):
+    raise RuntimeError("asyncpg is not installed")
+
+
+def install():
+    if importlib.util.find_spec('telegram') is None:
+        telegram = _module('telegram', Update=Update, Message=Message, Chat=Chat, WebAppInfo=WebAppInfo,
+                           InlineKeyboardButton=InlineKeyboardButton,
+                           InlineKeyboardMarkup=InlineKeyboardMarkup)
+        telegram.ext = _module('telegram.ext', Application=Application, BaseUpdateProcessor=BaseUpdateProcessor,
+                               CommandHandler=_Handler, CallbackQueryHandler=_Handler, ContextTypes=ContextTypes)
+        telegram.error = _module('telegram.error', TelegramError=TelegramError, BadRequest=BadRequest,
+                                 Forbidden=Forbidden, RetryAfter=RetryAfter)
+        telegram.helpers = _module('telegram.helpers', escape_markdown=escape_markdown)
+    if importlib.util.find_spec('starlette') is None:
+        starlette = _module('starlette')
+        starlette.applications = _module('starlette.applications', Starlette=Starlette)
+        starlette.responses = _module('starlette.responses', Response=Response, JSONResponse=JSONResponse)
+        starlette.routing = _module('starlette.routing', Route=Route)
+        starlette.requests = _module('starlette.requests', Request=Request)
+        starlette.middleware = _module('starlette.middleware')
+        starlette.middleware.cors = _module('starlette.middleware.cors', CORSMiddleware=CORSMiddleware)
+        starlette.datastructures = _module('starlette.datastructures', MutableHeaders=MutableHeaders)
+    if importlib.util.find_spec('uvicorn') is None:
+        _module('uvicorn', run=lambda *args, **kwargs: None)
+    if importlib.util.find_spec('asyncpg') is None:
+        _module('asyncpg', Connection=type('Connection', (), {}), Pool=type('Pool', (), {}),
+                PostgresError=PostgresError, create_pool=create_pool)
@@ -0,0 +1,56 @@
+import json
+
+import bot
+
+BOSS = 'goblin_king'
+MAX_HP = bot.BOSS_LOCATIONS[BOSS]['boss']['health']
+EPOCH_SECONDS = bot.BOSS_RESPAWN_HOURS * 3600
+
+
+def test_epoch_changes_on_the_respawn_boundary():
+    assert bot.boss_epoch(0) == 0
+    assert bot.boss_epoch(EPOCH_SECONDS - 1) == 0
+    assert bot.boss_epoch(EPOCH_SECONDS) == 1
+    assert bot.boss_epoch(10 * EPOCH_SECONDS + 5) == 10
+
+
+def test_progress_from_an_older_epoch_is_a_fresh_boss():
+    row = {'current_health': 0, 'defeated': True, 'epoch': 4}
+    assert bot.boss_state(row, BOSS, 4) == {'current_health': 0, 'defeated': True}
+    assert bot.boss_state(row, BOSS, 5) == {'current_health': MAX_HP, 'defeated': False}
+    assert bot.boss_state(None, BOSS, 5) == {'current_health': MAX_HP, 'defeated': False}
+
+
+def test_cached_snapshot_respawns_without_reload(monkeypatch):
+    row = {
+        'level': 5, 'exp': 0, 'gold': 0, 'total_clicks': 0, 'total_gold_earned': 0,
+        'total_crits': 0, 'current_crit_streak': 0, 'max_crit_streak': 0,
+        'perm_tool_power_bonus': 0, 'perm_crit_bonus': 0,
+        'current_location': 'coal_mine', 'active_tool': 'wooden_pickaxe',
+        'upgrades': [0] * len(bot.UPGRADE_IDS), 'inventory': bot.inventory_state({}),
+        'tools': '{}', 'achievements': [], 'recent_achievements': '[]', 'items': '{}', 'effects': '[]',
+        'bosses': json.dumps({BOSS: {'current_health': 0, 'defeated': True, 'epoch': 7}}),
+    }
+    state = bot.PlayerState(1, row)
+    monkeypatch.setattr(bot, 'boss_epoch', lambda now=None: 7)
+    assert state.boss_progress(BOSS)['defeated']
+    # Снимок тот же, эпоха сменилась по часам
+    monkeypatch.setattr(bot, 'boss_epoch', lambda now=None: 8)
+    assert state.boss_progress(BOSS) == {'current_health': MAX_HP, 'defeated': False}
+
+
+def test_attack_respawns_a_boss_from_the_previous_epoch(pg, monkeypatch):
+    epoch = [7]
+    monkeypatch.setattr(bot, 'boss_epoch', lambda now=None: epoch[0])
+
+    async def attack(damage):
+        async with bot.db_pool.acquire() as conn:
+            row = await bot.attack_boss(1, BOSS, damage, conn)
+            return None if row is None else (row['current_health'], row['defeated'])
+
+    pg(bot.provision_players([(1, 'miner')]))
+    assert pg(attack(MAX_HP - 10)) == (10, False)
+    assert pg(attack(50)) == (0, True)
+    assert pg(attack(50)) is None  # в этой эпохе уже побеждён
+    epoch[0] = 8
+    assert pg(attack(30)) == (MAX_HP - 30, False)
@@ -0,0 +1,74 @@
+import asyncio
+
+import bot
+
+GOOD, BAD = 3001, 3002
+STATS = ('level', 'exp', 'gold', 'clicks', 'total_gold', 'total_crits', 'current_crit_streak', 'max_crit_streak')
+
+
+def outcome(clicks):
+    return bot.build_click_outcome([(5, 2, False, None, 0)] * clicks)
+
+
+class FlakyAccumulator(bot.ClickAccumulator):
+    """Запись в БД подменена: игроки из broken не записываются."""
+
+    def __init__(self):
+        super().__init__(1000, 10 ** 6)
+        self.broken = {BAD}
+        self.written = {}
+
+    async def _commit(self, batch):
+        if self.broken & batch.keys():
+            raise RuntimeError("flush failed")
+        for uid, o in batch.items():
+            self.written[uid] = self.written.get(uid, 0) + o['clicks']
+
+
+def test_unflushable_clicks_are_kept_and_bypass_the_buffer():
+    acc = FlakyAccumulator()
+    acc.pending = {GOOD: outcome(2), BAD: outcome(3)}
+    good_clicks = 2
+
+    async def scenario():
+        nonlocal good_clicks
+        # Сначала пачка целиком, затем сбойный игрок поштучно
+        for _ in range(2 * bot.CLICK_FLUSH_MAX_RETRIES):
+            if not acc.accepts(BAD):
+                break
+            await acc.flush()
+            if GOOD not in acc.pending:
+                acc.pending[GOOD] = outcome(1)
+                good_clicks += 1
+
+    asyncio.run(scenario())
+    assert not acc.accepts(BAD)
+    assert acc.accepts(GOOD)
+    # Остальные игроки записаны, дельты сбойного не потеряны и не считаются в порог сброса
+    assert acc.written[GOOD] + acc.pending[GOOD]['clicks'] == good_clicks
+    assert acc.pending[BAD]['clicks'] == 3
+    assert BAD not in acc.written
+    assert acc.pending_clicks == 0
+
+    acc.broken.clear()
+    asyncio.run(acc.flush())
+    assert acc.written[BAD] == 3
+    assert acc.written[GOOD] == good_clicks
+    assert acc.accepts(BAD)
+    assert acc.pending == {}
+
+
+def test_close_flushes_threshold_flush_and_stops_buffering():
+    acc = FlakyAccumulator()
+    acc.broken.clear()
+    acc.max_clicks = 2
+
+    async def scenario():
+        acc._add(GOOD, {'stats': dict.fromkeys(STATS, 0), 'inv': {}}, outcome(2))
+        assert len(acc._flushes) == 1
+        await acc.close()
+
+    asyncio.run(scenario())
+    assert acc.written[GOOD] == 2
+    assert not acc._flushes
+    assert not acc.accepts(GOOD)
@@ -0,0 +1,28 @@
+import asyncio
+import json
+import types
+
+import pytest
+
+import bot
+
+
+class FakeRequest:
+    """Ровно то, что читает api_click_batch: request.state.user и тело."""
+
+    def __init__(self, body: bytes, uid: int):
+        self.state = types.SimpleNamespace(user={'id': uid})
+        self._body = body
+
+    async def json(self):
+        return json.loads(self._body)
+
+
+BODIES = [b'[5]', b'"5"', b'5', b'null', b'{"count": "many"}', b'{"count": 0}', b'{']
+
+
+@pytest.mark.parametrize('uid, body', list(enumerate(BODIES, 4001)))
+def test_invalid_batch_is_rejected_with_400(uid, body):
+    # У каждого случая свой игрок: лимит запросов в секунду общий на игрока
+    response = asyncio.run(bot.api_click_batch(FakeRequest(body, uid)))
+    assert response.status_code == 400
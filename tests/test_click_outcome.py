@@ -0,0 +1,140 @@
+"""
+Итог кликов в закрытой форме: build_click_outcome, merge_click_outcomes,
+apply_outcome_to_context и запись CLICK_COMMIT_SQL. Последнему тесту нужен
+PostgreSQL (фикстура pg из conftest.py).
+"""
+import asyncio
+import random
+
+import bot
+
+
+def rolls(crits, exp=1, found=None):
+    return [(3, exp, is_crit, found, 1 if found else 0) for is_crit in crits]
+
+
+def context(level=1, exp=0, streak=0, max_streak=0):
+    stats = {'level': level, 'exp': exp, 'gold': 0, 'clicks': 0, 'total_gold': 0, 'total_crits': 0,
+             'current_crit_streak': streak, 'max_crit_streak': max_streak}
+    return {'stats': stats, 'inv': {}}
+
+
+def reference_streaks(crits, streak=0, max_streak=0):
+    """Серии критов, посчитанные клик за кликом."""
+    for is_crit in crits:
+        streak = streak + 1 if is_crit else 0
+        max_streak = max(max_streak, streak)
+    return streak, max_streak
+
+
+def test_crit_streak_carries_across_batches():
+    rng = random.Random(3)
+    for _ in range(500):
+        crits = [rng.random() < 0.6 for _ in range(rng.randrange(1, 40))]
+        cuts = sorted(rng.sample(range(1, len(crits)), min(3, len(crits) - 1))) if len(crits) > 1 else []
+        ctx = context(streak=2, max_streak=3)
+        for start, end in zip([0] + cuts, cuts + [len(crits)]):
+            bot.apply_outcome_to_context(ctx, bot.build_click_outcome(rolls(crits[start:end])))
+        streak, max_streak = reference_streaks(crits, 2, 3)
+        assert ctx['stats']['current_crit_streak'] == streak, crits
+        assert ctx['stats']['max_crit_streak'] == max_streak, crits
+
+
+def test_all_crit_batches_extend_the_streak():
+    ctx = context(streak=4, max_streak=4)
+    for _ in range(3):
+        bot.apply_outcome_to_context(ctx, bot.build_click_outcome(rolls([True, True])))
+    assert ctx['stats']['current_crit_streak'] == 10
+    assert ctx['stats']['max_crit_streak'] == 10
+    bot.apply_outcome_to_context(ctx, bot.build_click_outcome(rolls([False])))
+    assert ctx['stats']['current_crit_streak'] == 0
+    assert ctx['stats']['max_crit_streak'] == 10
+
+
+def test_several_level_ups_in_one_batch():
+    ctx = context(level=3, exp=90)
+    outcome = bot.build_click_outcome(rolls([False] * 10, exp=35))  # 350 опыта
+    bot.apply_outcome_to_context(ctx, outcome)
+    assert ctx['stats']['level'] == 3 + (90 + 350) // bot.EXP_PER_LEVEL
+    assert ctx['stats']['exp'] == (90 + 350) % bot.EXP_PER_LEVEL
+    assert ctx['stats']['total_exp'] == (ctx['stats']['level'] - 1) * bot.EXP_PER_LEVEL + ctx['stats']['exp']
+
+
+def test_merge_equals_outcome_of_concatenated_clicks():
+    rng = random.Random(5)
+    for _ in range(500):
+        a = [(rng.randrange(10), rng.randrange(5), rng.random() < 0.5, rng.choice([None, 'coal', 'iron']), 1)
+             for _ in range(rng.randrange(1, 12))]
+        b = [(rng.randrange(10), rng.randrange(5), rng.random() < 0.5, rng.choice([None, 'coal', 'iron']), 1)
+             for _ in range(rng.randrange(1, 12))]
+        merged = bot.merge_click_outcomes(bot.build_click_outcome(a), bot.build_click_outcome(b))
+        assert merged == bot.build_click_outcome(a + b)
+
+
+def test_effect_reward_applies_effects_like_a_click():
+    random.seed(1)
+    stats = {'upgrades': {'click_power': 0, 'crit_chance': 0}}
+    exp_multiplier, crit_bonus = bot.effect_modifiers([{'exp_multiplier': 2}, {'crit_chance_bonus': 100}])
+    for _ in range(50):
+        gold, exp, is_crit = bot.get_effect_reward(stats, exp_multiplier, crit_bonus)
+        assert is_crit
+        assert exp % 4 == 0  # удвоен эффектом и критом
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.args = None
+
+    def get_server_pid(self):
+        return 0
+
+    async def fetch(self, sql, *args):
+        assert sql == bot.queries.sql['click_commit']
+        self.args = args
+        return [{'user_id': uid} for uid in args[0]]
+
+
+def test_commit_passes_every_player_in_one_statement():
+    conn = RecordingConnection()
+    outcomes = {
+        1: bot.build_click_outcome(rolls([True, True], found='coal')),
+        2: bot.build_click_outcome(rolls([True, False, True])),
+    }
+    rows = asyncio.run(bot.commit_click_outcomes(outcomes, conn))
+    assert set(rows) == {1, 2}
+    uids, gold, exp, clicks, crits, all_crit, leading, trailing, longest, resources, \
+        inv_uids, inv_rids, inv_amts = conn.args[:13]
+    assert uids == [1, 2]
+    assert clicks == [2, 3]
+    assert all_crit == [True, False]
+    assert (leading, trailing, longest) == ([2, 1], [2, 1], [2, 1])
+    assert resources == [2, 0]
+    assert (inv_uids, inv_rids, inv_amts) == ([1], ['coal'], [2])
+
+
+def test_click_commit_sql_updates_several_players(pg):
+    outcomes = {
+        # 330 опыта от 90: четыре уровня; серия 2 продолжается двумя критами
+        1: bot.build_click_outcome([(5, 60, True, 'coal', 2), (5, 60, True, None, 0),
+                                    (5, 60, False, 'iron', 1), (5, 150, True, 'coal', 1)]),
+        2: bot.build_click_outcome(rolls([True, True, True])),
+    }
+
+    async def scenario():
+        await bot.provision_players([(1, 'a'), (2, 'b')])
+        async with bot.db_pool.acquire() as conn:
+            # Без заданий: награды за них не смешиваются с проверяемыми числами
+            await conn.execute("DELETE FROM daily_tasks")
+            await conn.execute("DELETE FROM weekly_tasks")
+            await conn.execute("UPDATE players SET exp = 90, current_crit_streak = 2, max_crit_streak = 2 "
+                               "WHERE user_id = 1")
+            return await bot.commit_click_outcomes(outcomes, conn)
+
+    rows = pg(scenario())
+    first, second = rows[1], rows[2]
+    assert (first['level'], first['exp']) == (5, 20)
+    assert (first['gold'], first['total_clicks'], first['total_crits']) == (20, 4, 3)
+    assert (first['current_crit_streak'], first['max_crit_streak']) == (1, 4)
+    assert bot.json.loads(first['inventory']) == {'coal': 3, 'iron': 1}
+    assert (second['current_crit_streak'], second['max_crit_streak']) == (3, 3)
+    assert second['total_clicks'] == 3
@@ -0,0 +1,63 @@
+import random
+
+import pytest
+
+import bot
+
+np = pytest.importorskip('numpy')
+
+CLICKS = 40_000
+BATCHES, BATCH = 5000, 40
+# Вероятности в сумме 0.55: почти половина кликов ничего не находит
+TEST_MINE = {'resources': [{'res_id': 'coal', 'prob': 0.4, 'min': 1, 'max': 3},
+                           {'res_id': 'diamond', 'prob': 0.15, 'min': 1, 'max': 2}]}
+
+
+@pytest.fixture
+def ctx(monkeypatch):
+    monkeypatch.setitem(bot.LOCATIONS, 'test_mine', TEST_MINE)
+    monkeypatch.setattr(bot, 'click_rng', np.random.default_rng(7))
+    random.seed(7)
+    return {
+        'stats': {'upgrades': {'click_power': 3, 'crit_chance': 10}, 'perm_crit_bonus': 2},
+        'location': 'test_mine',
+        'tool_power': 3,
+        'exp_multiplier': 1.5,
+        'crit_bonus': 10,
+    }
+
+
+def scalar(ctx, count):
+    return bot.build_click_outcome(bot.roll_click(ctx) for _ in range(count))
+
+
+def close(a, b, rel):
+    return abs(a - b) <= rel * max(abs(a), abs(b))
+
+
+def test_vectorized_totals_match_scalar_distribution(ctx):
+    expected = scalar(ctx, CLICKS)
+    got = bot.roll_clicks_vectorized(ctx, CLICKS)
+    assert got['clicks'] == CLICKS
+    assert close(got['gold'], expected['gold'], 0.02)
+    assert close(got['exp'], expected['exp'], 0.02)
+    # Крит: 24% от улучшений и ещё 10% от эффекта среди не-критов
+    crit_rate = 0.24 + 0.76 * 0.10
+    assert abs(got['crits'] / CLICKS - crit_rate) < 0.01
+    assert abs(expected['crits'] / CLICKS - crit_rate) < 0.01
+    assert got['resources'].keys() == expected['resources'].keys() == {'coal', 'diamond'}
+    for rid in ('coal', 'diamond'):
+        assert close(got['resources'][rid], expected['resources'][rid], 0.07)
+
+
+def test_vectorized_streaks_match_scalar_distribution(ctx):
+    def summary(outcomes):
+        return [sum(o[key] for o in outcomes) / len(outcomes)
+                for key in ('longest_crits', 'leading_crits', 'trailing_crits')]
+
+    expected = summary([scalar(ctx, BATCH) for _ in range(BATCHES)])
+    got = summary([bot.roll_clicks_vectorized(ctx, BATCH) for _ in range(BATCHES)])
+    assert close(got[0], expected[0], 0.05)
+    for g, e in zip(got[1:], expected[1:]):
+        # Ведущая и хвостовая серии – геометрические со средним p/(1-p) ≈ 0.46
+        assert abs(g - e) < 0.07
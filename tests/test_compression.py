@@ -0,0 +1,92 @@
+import asyncio
+import gzip
+
+import pytest
+
+import bot
+
+BIG = b'{"entries": [' + b','.join(b'{"rank": %d}' % i for i in range(500)) + b']}'
+SMALL = b'{"ok": true}'
+
+
+@pytest.fixture
+def with_brotli(monkeypatch):
+    monkeypatch.setattr(bot, 'brotli', object())  # choose_encoding смотрит только на наличие модуля
+
+
+@pytest.fixture
+def without_brotli(monkeypatch):
+    monkeypatch.setattr(bot, 'brotli', None)
+
+
+def test_parse_accept_encoding():
+    assert bot.parse_accept_encoding('gzip;q=0.5, BR , ;') == {'gzip': 0.5, 'br': 1.0}
+    assert bot.parse_accept_encoding('gzip; q=abc') == {'gzip': 0.0}
+    assert bot.parse_accept_encoding('') == {}
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('', None),
+    ('identity', None),
+    ('gzip;q=0', None),
+    ('*;q=0', None),
+    ('gzip, br', 'br'),
+    ('*', 'br'),
+    ('br;q=0, *', 'gzip'),
+    ('br;q=0.5, gzip', 'gzip'),
+    ('br;q=0.5, gzip;q=0.5', 'br'),
+    ('gzip;q=0, *;q=0.3', 'br'),
+])
+def test_choose_encoding_with_brotli(with_brotli, header, expected):
+    assert bot.choose_encoding(header) == expected
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('br', None),
+    ('br, gzip;q=0.1', 'gzip'),
+    ('*', 'gzip'),
+    ('gzip;q=0, *', None),
+])
+def test_choose_encoding_without_brotli(without_brotli, header, expected):
+    assert bot.choose_encoding(header) == expected
+
+
+def respond(accept_encoding, *bodies):
+    """Прогоняет ответ из частей bodies через CompressionMiddleware; возвращает (заголовки, тело)."""
+    async def app(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'application/json')]})
+        for i, body in enumerate(bodies):
+            await send({'type': 'http.response.body', 'body': body, 'more_body': i < len(bodies) - 1})
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'path': '/api/leaderboard', 'headers': [(b'accept-encoding', accept_encoding)]}
+    asyncio.run(bot.CompressionMiddleware(app, minimum_size=1024)(scope, None, send))
+    start, *rest = sent
+    assert start['type'] == 'http.response.start'
+    headers = {k.decode().lower(): v.decode() for k, v in start['headers']}
+    return headers, b''.join(m.get('body', b'') for m in rest)
+
+
+def test_large_body_is_gzipped(without_brotli):
+    headers, body = respond(b'gzip, deflate', BIG)
+    assert headers['content-encoding'] == 'gzip'
+    assert headers['content-length'] == str(len(body))
+    assert 'accept-encoding' in headers['vary'].lower()
+    assert gzip.decompress(body) == BIG
+
+
+@pytest.mark.parametrize('accept_encoding, bodies', [
+    (b'gzip', (SMALL,)),          # меньше minimum_size
+    (b'gzip;q=0', (BIG,)),        # клиент отказался от gzip
+    (b'identity', (BIG,)),
+    (b'gzip', (BIG, BIG)),        # потоковый ответ
+])
+def test_body_is_passed_through(without_brotli, accept_encoding, bodies):
+    headers, body = respond(accept_encoding, *bodies)
+    assert 'content-encoding' not in headers
+    assert body == b''.join(bodies)
@@ -0,0 +1,86 @@
+import hashlib
+import hmac
+import json
+import time
+from urllib.parse import urlencode
+
+import pytest
+
+import bot
+
+USER = {'id': 42, 'first_name': 'Шахтёр'}
+
+
+def sign(auth_date, user=USER, token=None):
+    """initData так, как её подписывает Telegram."""
+    fields = {'auth_date': str(auth_date), 'query_id': 'AAE', 'user': json.dumps(user, ensure_ascii=False)}
+    check = '\n'.join(f"{k}={v}" for k, v in sorted(fields.items()))
+    secret = hmac.new(b"WebAppData", (token or bot.TOKEN).encode(), hashlib.sha256).digest()
+    fields['hash'] = hmac.new(secret, check.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [time.time()]
+    monkeypatch.setattr(bot.time, 'time', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def verifications(monkeypatch):
+    calls = []
+    verify = bot.verify_telegram_data
+
+    def counting_verify(token, init_data):
+        calls.append(init_data)
+        return verify(token, init_data)
+
+    monkeypatch.setattr(bot, 'verify_telegram_data', counting_verify)
+    return calls
+
+
+def test_valid_init_data_is_verified_once(clock, verifications):
+    cache = bot.InitDataCache(10, 3600)
+    init_data = sign(int(clock[0]))
+    assert cache.verify(init_data)['id'] == 42
+    assert cache.verify(init_data)['id'] == 42
+    assert len(verifications) == 1
+
+
+def test_hash_mismatch_is_rejected_and_not_cached(clock, verifications):
+    cache = bot.InitDataCache(10, 3600)
+    forged = sign(int(clock[0]), token='other-token')
+    tampered = sign(int(clock[0])).replace('42', '43')
+    for init_data in (forged, tampered, forged):
+        assert cache.verify(init_data) is None
+    assert len(verifications) == 3
+
+
+def test_entry_expires_at_auth_date_plus_max_age(clock, verifications):
+    cache = bot.InitDataCache(10, 3600)
+    init_data = sign(int(clock[0]))
+    assert cache.verify(init_data) is not None
+    clock[0] += 3599
+    assert cache.verify(init_data) is not None
+    clock[0] += 1
+    assert cache.verify(init_data) is None
+    # Просроченная запись удалена, повторная проверка подписи тоже её отвергает
+    assert cache.verify(init_data) is None
+    assert len(verifications) == 2
+
+
+def test_stale_init_data_is_rejected_before_caching(clock):
+    cache = bot.InitDataCache(10, 3600)
+    assert cache.verify(sign(int(clock[0]) - 3600)) is None
+
+
+def test_cache_keeps_maxsize_most_recent(clock, verifications):
+    cache = bot.InitDataCache(2, 3600)
+    first, second, third = (sign(int(clock[0]), {**USER, 'id': uid}) for uid in (1, 2, 3))
+    for init_data in (first, second, first, third):
+        cache.verify(init_data)
+    assert len(verifications) == 3
+    cache.verify(first)   # недавно использованная – осталась
+    cache.verify(second)  # вытеснена
+    assert verifications[3:] == [second]
@@ -0,0 +1,138 @@
+import asyncio
+import contextlib
+
+import pytest
+
+import bot
+
+UID = 2002
+
+
+class FakeConnection:
+    """Соединение, у которого есть только транзакции и ответ на achievement_unlock."""
+
+    def __init__(self, inserted=()):
+        self.inserted = list(inserted)
+
+    def transaction(self):
+        return contextlib.AsyncExitStack()
+
+    def get_server_pid(self):
+        return 0
+
+    async def fetchrow(self, sql, *args):
+        assert sql == bot.queries.sql['achievement_unlock']
+        return {'level': 1, 'exp': 0, 'gold': 0, 'inserted': self.inserted}
+
+
+@pytest.fixture(autouse=True)
+def boards(monkeypatch):
+    monkeypatch.setattr(bot, 'leaderboards', bot.Leaderboards())
+    bot.commit_callbacks.clear()
+    return bot.leaderboards
+
+
+def test_after_commit_waits_for_outer_transaction():
+    conn = FakeConnection()
+    calls = []
+
+    async def scenario():
+        async with bot.transaction(conn):
+            async with bot.transaction(conn):
+                bot.after_commit(conn, lambda: calls.append('inner'))
+            assert calls == []
+            bot.after_commit(conn, lambda: calls.append('outer'))
+            assert calls == []
+        bot.after_commit(conn, lambda: calls.append('autocommit'))
+
+    asyncio.run(scenario())
+    assert calls == ['inner', 'outer', 'autocommit']
+    assert bot.commit_callbacks == {}
+
+
+def test_rollback_drops_callbacks_of_its_block_only():
+    conn = FakeConnection()
+    calls = []
+
+    async def scenario():
+        async with bot.transaction(conn):
+            bot.after_commit(conn, lambda: calls.append('kept'))
+            with pytest.raises(RuntimeError):
+                async with bot.transaction(conn):
+                    bot.after_commit(conn, lambda: calls.append('savepoint'))
+                    raise RuntimeError
+        with pytest.raises(RuntimeError):
+            async with bot.transaction(conn):
+                bot.after_commit(conn, lambda: calls.append('rolled back'))
+                raise RuntimeError
+
+    asyncio.run(scenario())
+    assert calls == ['kept']
+    assert bot.commit_callbacks == {}
+
+
+def test_rolled_back_unlock_leaves_board_unchanged(boards):
+    conn = FakeConnection(inserted=['first_click'])
+    unlocks = [(bot.ACHIEVEMENTS[0], 1, 1)]
+
+    async def scenario():
+        with pytest.raises(RuntimeError):
+            async with bot.transaction(conn):
+                await bot.unlock_achievements(UID, unlocks, conn)
+                raise RuntimeError
+        assert boards.rank('achievements', UID) is None
+        async with bot.transaction(conn):
+            await bot.unlock_achievements(UID, unlocks, conn)
+            assert boards.rank('achievements', UID) is None
+
+    asyncio.run(scenario())
+    assert boards.rank('achievements', UID) == (0, 1)
+
+
+def click_row(clicks):
+    return {'level': 1, 'exp': 0, 'gold': 0, 'total_clicks': clicks, 'total_gold_earned': 0,
+            'total_crits': 0, 'current_crit_streak': 0, 'max_crit_streak': 0,
+            'perm_tool_power_bonus': 0, 'perm_crit_bonus': 0,
+            'inventory': None, 'daily_done': 1, 'weekly_done': 0}
+
+
+def test_rolled_back_click_keeps_context_and_boards(boards):
+    conn = FakeConnection(inserted=['first_click'])
+    ctx = {'stats': {'upgrades': {}}, 'inv': {}, 'tools': {}, 'achievements': 0,
+           'daily_completed': 0, 'weekly_completed': 0}
+    first_click = bot.ACHIEVEMENT_INDEX.mask(['first_click'])
+
+    async def scenario():
+        with pytest.raises(RuntimeError):
+            async with bot.transaction(conn):
+                await bot.apply_committed_click(UID, ctx, click_row(1), conn)
+                raise RuntimeError
+        # Откат: достижение не отмечено в контексте, задания не посчитаны
+        assert not ctx['achievements'] & first_click
+        assert boards.rank('tasks_completed', UID) is None
+        async with bot.transaction(conn):
+            await bot.apply_committed_click(UID, ctx, click_row(1), conn)
+
+    asyncio.run(scenario())
+    assert ctx['achievements'] & first_click
+    assert boards.rank('tasks_completed', UID) == (0, 1)
+    assert boards.rank('achievements', UID) == (0, 1)
+
+
+CONTAINERS = [bot.BisectList] + ([bot.SortedList] if bot.SortedList is not None else [])
+
+
+@pytest.mark.parametrize('container', CONTAINERS)
+def test_sorted_board_matches_full_sort(monkeypatch, container):
+    monkeypatch.setattr(bot, 'SortedKeys', container)
+    board = bot.SortedBoard()
+    board.load({uid: uid % 7 for uid in range(50)})
+    for uid in range(0, 80, 3):
+        board.set(uid, (uid * 13) % 11)
+    expected = sorted(board.scores.items(), key=lambda item: (-item[1], item[0]))
+    assert [(uid, score) for _, uid, score in board.slice(0, 100)] == expected
+    for rank, (uid, score) in enumerate(expected):
+        assert board.rank(uid) == rank
+    # Keyset-страница после курсора (очки, user_id) продолжает тот же порядок
+    after = expected[9]
+    assert [uid for _, uid, _ in board.page((after[1], after[0]), 5)] == [uid for uid, _ in expected[10:15]]
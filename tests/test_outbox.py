@@ -0,0 +1,134 @@
+import asyncio
+import contextlib
+
+import pytest
+
+import bot
+
+
+def row(id, chat_id, text, kind='text', parse_mode=None, attempts=0):
+    return {'id': id, 'chat_id': chat_id, 'kind': kind, 'text': text, 'parse_mode': parse_mode,
+            'attempts': attempts}
+
+
+def test_achievements_of_one_chat_are_merged_in_id_order():
+    chats = bot.coalesce_outbox([
+        row(3, 1, 'B', 'achievement', attempts=2),
+        row(1, 1, 'A', 'achievement'),
+        row(2, 1, 'text'),
+        row(4, 2, 'C', 'achievement'),
+    ])
+    assert chats[1] == [
+        {'ids': [1, 3], 'text': 'A\n\nB', 'parse_mode': None, 'attempts': 2},
+        {'ids': [2], 'text': 'text', 'parse_mode': None, 'attempts': 0},
+    ]
+    assert chats[2] == [{'ids': [4], 'text': 'C', 'parse_mode': None, 'attempts': 0}]
+
+
+def test_merge_respects_parse_mode_and_message_length():
+    long = 'x' * (bot.TELEGRAM_MAX_MESSAGE_LENGTH - 2)  # ни к чему не приклеится
+    chats = bot.coalesce_outbox([
+        row(1, 1, 'A', 'achievement', parse_mode='Markdown'),
+        row(2, 1, 'B', 'achievement'),
+        row(3, 1, long, 'achievement'),
+        row(4, 1, 'C', 'achievement'),
+    ])
+    assert [msg['ids'] for msg in chats[1]] == [[1], [2], [3], [4]]
+
+
+class OutboxConnection:
+    def __init__(self, rows):
+        self.rows = rows
+        self.executed = []
+
+    def get_server_pid(self):
+        return 0
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def fetch(self, sql, *args):
+        assert sql == bot.queries.sql['outbox_claim']
+        rows, self.rows = self.rows, []
+        return rows
+
+    async def execute(self, sql, *args):
+        self.executed.append((sql.split()[0], args))
+
+
+class FakePool:
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def acquire(self, timeout=None):
+        return self.conn
+
+    async def release(self, conn):
+        pass
+
+
+class FakeBot:
+    def __init__(self, errors):
+        self.errors = errors
+        self.sent = []
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        if chat_id in self.errors:
+            raise self.errors[chat_id]
+        self.sent.append((chat_id, text))
+
+
+@pytest.fixture
+def conn(monkeypatch):
+    conn = OutboxConnection([
+        row(1, 1, 'A', 'achievement'), row(2, 1, 'B', 'achievement'),   # отправлены одним сообщением
+        row(3, 2, 'flood'),                                              # RetryAfter
+        row(4, 3, 'blocked'),                                            # Forbidden
+        row(5, 4, 'flaky'),                                              # сбой, будет повтор
+        row(6, 5, 'hopeless', attempts=bot.OUTBOX_MAX_ATTEMPTS - 1),    # сбой, попытки кончились
+    ])
+    monkeypatch.setattr(bot, 'db_pool', FakePool(conn))
+    monkeypatch.setattr(bot, 'outbox_backoff', lambda attempts: 10.0 * attempts)
+    return conn
+
+
+def test_dispatch_deletes_sent_and_reschedules_failed(conn):
+    dispatcher = bot.OutboxDispatcher(1000, 1000, 10)
+    dispatcher.bot = FakeBot({
+        2: bot.RetryAfter(30),
+        3: bot.Forbidden('bot was blocked by the user'),
+        4: bot.TelegramError('Timed out'),
+        5: bot.TelegramError('Timed out'),
+    })
+
+    assert asyncio.run(dispatcher.dispatch()) == 6
+    assert dispatcher.bot.sent == [(1, 'A\n\nB')]
+    (delete, (done,)), (update, (ids, incs, delays)) = conn.executed
+    assert delete == 'DELETE' and sorted(done) == [1, 2, 4, 6]
+    retries = {i: (inc, delay) for i, inc, delay in zip(ids, incs, delays)}
+    # RetryAfter не тратит попытку и ждёт ровно указанное время
+    assert update == 'UPDATE' and retries == {3: (0, 30.0), 5: (1, 10.0)}
+    assert dispatcher.stats() == {'sent': 1, 'retried': 2, 'dropped': 2}
+
+
+def test_empty_claim_sends_nothing(conn):
+    conn.rows = []
+    dispatcher = bot.OutboxDispatcher(1000, 1000, 10)
+    dispatcher.bot = FakeBot({})
+    assert asyncio.run(dispatcher.dispatch()) == 0
+    assert conn.executed == []
+
+
+def test_claimed_rows_are_leased_to_one_dispatcher(pg):
+    async def scenario():
+        async with bot.db_pool.acquire() as conn:
+            for chat_id in (1, 2, 3):
+                await bot.enqueue_message(chat_id, f"hi {chat_id}", conn=conn)
+            first = await bot.queries.fetch(conn, 'outbox_claim', 2, 60.0)
+            second = await bot.queries.fetch(conn, 'outbox_claim', 10, 60.0)
+            third = await bot.queries.fetch(conn, 'outbox_claim', 10, 60.0)
+        return [[r['chat_id'] for r in rows] for rows in (first, second, third)]
+
+    # Пачка ограничена LIMIT, забранное скрыто от следующих выборок на время аренды
+    assert pg(scenario()) == [[1, 2], [3], []]
@@ -0,0 +1,73 @@
+import asyncio
+import time
+
+import bot
+
+
+def make_state(uid, gold=100):
+    return bot.PlayerState(uid, {
+        'level': 5, 'exp': 0, 'gold': gold, 'total_clicks': 0, 'total_gold_earned': 0,
+        'total_crits': 0, 'current_crit_streak': 0, 'max_crit_streak': 0,
+        'perm_tool_power_bonus': 0, 'perm_crit_bonus': 0,
+        'current_location': 'coal_mine', 'active_tool': 'wooden_pickaxe',
+        'upgrades': [0] * len(bot.UPGRADE_IDS),
+        'inventory': bot.inventory_state({'coal': 10}),
+        'tools': '{"wooden_pickaxe": 1}', 'achievements': [], 'recent_achievements': '[]',
+        'items': '{}', 'effects': '[]', 'bosses': '{}',
+    })
+
+
+def stats_with_gold(state, gold):
+    stats = state.stats()
+    stats['gold'] = gold
+    return stats
+
+
+def test_update_bumps_lru_and_keeps_the_bound():
+    cache = bot.PlayerStateCache(2, 60)
+    for uid in (1, 2):
+        cache.put(make_state(uid), time.monotonic())
+    cache.update(1, stats_with_gold(make_state(1), 150))
+    cache.put(make_state(3), time.monotonic())
+    # 1 обновлён последним из старых – вытеснен 2
+    assert cache.get(2) is None
+    assert cache.get(1).gold == 150
+    assert cache.get(3) is not None
+
+
+def test_update_inside_request_scope_survives_scope_exit(monkeypatch):
+    cache = bot.PlayerStateCache(10, 60)
+    monkeypatch.setattr(bot, 'player_cache', cache)  # его инвалидирует run_deferred
+    cache.put(make_state(1), time.monotonic())
+    stale = []
+    cache.on_invalidate.append(stale.append)
+
+    async def scenario():
+        scope = bot.RequestConnection()
+        token = bot.request_scope.set(scope)
+        try:
+            scope.depth = 1  # открыт внешний блок acquire_conn()
+            cache.update(1, stats_with_gold(make_state(1), 150))
+            scope.depth = 0
+            scope.run_deferred()
+        finally:
+            bot.request_scope.reset(token)
+
+    asyncio.run(scenario())
+    assert cache.get(1).gold == 150
+    assert stale == [1]
+
+
+def test_update_rejects_loads_started_before_it():
+    cache = bot.PlayerStateCache(10, 60)
+    cache.put(make_state(1), time.monotonic())
+    started_at = time.monotonic()
+    cache.update(1, stats_with_gold(make_state(1), 150))
+    cache.put(make_state(1, gold=100), started_at)
+    assert cache.get(1).gold == 150
+
+
+def test_update_of_missing_entry_only_invalidates():
+    cache = bot.PlayerStateCache(10, 60)
+    cache.update(1, stats_with_gold(make_state(1), 150))
+    assert cache.get(1) is None
@@ -0,0 +1,77 @@
+import asyncio
+import contextlib
+import json
+
+import bot
+
+
+class ProvisionConnection:
+    """Записывает пачки provision и отвечает строками «созданных» игроков."""
+
+    def __init__(self, existing=()):
+        self.existing = set(existing)
+        self.batches = []
+        self.committed = 0
+
+    def get_server_pid(self):
+        return 0
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        yield
+        self.committed += 1
+
+    async def fetch(self, sql, *args):
+        assert sql == bot.queries.sql['provision']
+        uids, names, _, _, _, _, daily, weekly = args
+        self.batches.append((uids, json.loads(daily), json.loads(weekly)))
+        new = [(uid, name) for uid, name in zip(uids, names) if uid not in self.existing]
+        self.existing.update(uids)
+        return [{'user_id': uid, 'username': name, 'level': 1, 'exp': 0, 'gold': 0} for uid, name in new]
+
+
+def test_players_are_created_one_statement_per_batch(monkeypatch):
+    monkeypatch.setattr(bot, 'PROVISION_BATCH_SIZE', 2)
+    added = []
+    monkeypatch.setattr(bot.leaderboards, 'add_players', lambda rows: added.extend(r['user_id'] for r in rows))
+    conn = ProvisionConnection(existing={3})
+    players = [(uid, f"p{uid}") for uid in range(1, 6)]
+
+    rows = asyncio.run(bot.provision_players(players, conn))
+
+    assert [uids for uids, _, _ in conn.batches] == [[1, 2], [3, 4], [5]]
+    assert conn.committed == 3
+    # Уже существующий игрок пропущен и в ответе, и в рейтингах
+    assert [row['user_id'] for row in rows] == [1, 2, 4, 5]
+    assert added == [1, 2, 4, 5]
+    for uids, daily, weekly in conn.batches:
+        for tasks, templates in ((daily, bot.DAILY_TASK_TEMPLATES), (weekly, bot.WEEKLY_TASK_TEMPLATES)):
+            per_player = min(4, len(templates))
+            assert sorted(t['user_id'] for t in tasks) == sorted(uids * per_player)
+            assert all(t['goal'] > 0 for t in tasks)
+
+
+def test_rolled_tasks_are_distinct_and_numbered():
+    for _ in range(50):
+        tasks = bot.roll_tasks(bot.DAILY_TASK_TEMPLATES)
+        assert [t['task_id'] for t in tasks] == list(range(len(tasks)))
+        assert len({t['task_name'] for t in tasks}) == len(tasks) <= 4
+
+
+def test_bulk_provisioning_against_the_database(pg, monkeypatch):
+    monkeypatch.setattr(bot, 'PROVISION_BATCH_SIZE', 100)
+    players = [(uid, f"p{uid}") for uid in range(1, 251)]
+
+    async def scenario():
+        first = await bot.provision_players(players)
+        again = await bot.provision_players(players[:10] + [(251, 'late')])
+        async with bot.db_pool.acquire() as conn:
+            counts = {table: await conn.fetchval(f"SELECT COUNT(DISTINCT user_id) FROM {table}")
+                      for table in ('players', 'daily_tasks', 'weekly_tasks', 'player_tools')}
+        return first, again, counts, await bot.get_player_stats(125)
+
+    first, again, counts, stats = pg(scenario())
+    assert len(first) == 250
+    assert [row['user_id'] for row in again] == [251]
+    assert counts == {'players': 251, 'daily_tasks': 251, 'weekly_tasks': 251, 'player_tools': 251}
+    assert stats['level'] == 1 and stats['upgrades'] == {up: 0 for up in bot.UPGRADE_IDS}
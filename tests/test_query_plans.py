@@ -0,0 +1,115 @@
+"""
+Планы горячих запросов на схеме после всех MIGRATIONS. Нужен PostgreSQL:
+TEST_DATABASE_URL – сервер, на котором тесту можно создать и удалить
+временную базу, например postgresql://postgres@localhost/postgres.
+"""
+import asyncio
+import datetime
+import os
+import uuid
+
+import asyncpg
+import pytest
+
+import bot
+
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+PLAYERS = 5000
+
+pytestmark = [
+    pytest.mark.skipif(not hasattr(asyncpg, 'connect'), reason="asyncpg is not installed"),
+    pytest.mark.skipif(not TEST_DATABASE_URL, reason="EXPLAIN needs PostgreSQL: set TEST_DATABASE_URL"),
+]
+
+BIG_TABLES = ('players', 'user_achievements', 'daily_tasks', 'weekly_tasks')
+
+
+async def seed(conn):
+    """Столько строк, чтобы планировщик выбирал индекс по стоимости, а не по пустой таблице."""
+    await conn.execute("INSERT INTO players (user_id, username) SELECT g, 'p' || g FROM generate_series(1, $1) g",
+                       PLAYERS)
+    await conn.execute("""
+        INSERT INTO user_achievements (user_id, achievement_id, unlocked_at, progress, max_progress)
+        SELECT p, a.id, current_date - ((p + a.ord) % 300)::int, 1, 1
+        FROM generate_series(1, $1) p CROSS JOIN unnest($2::text[]) WITH ORDINALITY AS a(id, ord)
+    """, PLAYERS, [ach.id for ach in bot.ACHIEVEMENTS])
+    today = datetime.date.today()
+    history = {
+        'daily_tasks': ('date', 'date', [today - datetime.timedelta(days=i) for i in range(10)]),
+        'weekly_tasks': ('week', 'text', [f"{today.year - 1}-{w}" for w in range(10)] + [bot.get_week_number()]),
+    }
+    for table, (column, kind, periods) in history.items():
+        await conn.execute(f"""
+            INSERT INTO {table} (user_id, task_id, task_name, task_type, goal, completed, reward_gold, reward_exp, {column})
+            SELECT p, t, 'task', (ARRAY['clicks', 'gold_earned', 'crits', 'resources'])[t + 1], 10, TRUE, 1, 1, d
+            FROM generate_series(1, $1) p CROSS JOIN generate_series(0, 3) t CROSS JOIN unnest($2::{kind}[]) d
+            ON CONFLICT DO NOTHING
+        """, PLAYERS, periods)
+    await conn.execute("ANALYZE")
+
+
+@pytest.fixture(scope='module')
+def explain():
+    database = f"bot_plans_{uuid.uuid4().hex[:12]}"
+    loop = asyncio.new_event_loop()
+
+    async def setup():
+        admin = await asyncpg.connect(TEST_DATABASE_URL)
+        await admin.execute(f'CREATE DATABASE "{database}"')
+        await admin.close()
+        bot.db_pool = await asyncpg.create_pool(TEST_DATABASE_URL, database=database, min_size=1, max_size=2)
+        await bot.init_db()
+        async with bot.db_pool.acquire() as conn:
+            await seed(conn)
+
+    async def plan(name, *args):
+        async with bot.db_pool.acquire() as conn:
+            rows = await conn.fetch('EXPLAIN ' + bot.queries.sql[name], *args)
+        return '\n'.join(row[0] for row in rows)
+
+    async def teardown():
+        await bot.db_pool.close()
+        bot.db_pool = None
+        admin = await asyncpg.connect(TEST_DATABASE_URL)
+        await admin.execute(f'DROP DATABASE "{database}"')
+        await admin.close()
+
+    def run_plan(name, *args):
+        return loop.run_until_complete(plan(name, *args))
+
+    run_plan.run = loop.run_until_complete  # для прочих запросов к той же базе
+    loop.run_until_complete(setup())
+    try:
+        yield run_plan
+    finally:
+        loop.run_until_complete(teardown())
+        loop.close()
+
+
+def assert_no_seq_scans(plan):
+    for table in BIG_TABLES:
+        assert f"Seq Scan on {table}" not in plan, plan
+
+
+def test_player_state_reads_recent_achievements_from_index(explain):
+    plan = explain('player_state', 42, bot.UPGRADE_IDS)
+    assert "Index Scan using idx_user_achievements_recent" in plan, plan
+    assert "Sort" not in plan, plan
+    assert_no_seq_scans(plan)
+
+
+def test_task_progress_uses_task_type_indexes(explain):
+    plan = explain('task_progress', 42, ['clicks'], [5], datetime.date.today(), bot.get_week_number(),
+                   bot.EXP_PER_LEVEL)
+    assert "idx_daily_tasks_type on daily_tasks" in plan, plan
+    assert "idx_weekly_tasks_type on weekly_tasks" in plan, plan
+    assert_no_seq_scans(plan)
+
+
+def test_unused_indexes_are_dropped(explain):
+    async def existing():
+        async with bot.db_pool.acquire() as conn:
+            return await conn.fetch("SELECT indexname FROM pg_indexes WHERE indexname = ANY($1::text[])",
+                                    list(bot.UNUSED_INDEXES))
+
+    assert explain.run(existing()) == []
@@ -0,0 +1,101 @@
+"""
+Ресурсы меняются одним оператором RESOURCE_DELTA_SQL: крафт списывает
+ингредиенты и начисляет результат вместе. Тестам с фикстурой pg нужен PostgreSQL.
+"""
+import asyncio
+import contextlib
+
+import bot
+
+UID = 3001
+
+
+class LedgerConnection:
+    """Инвентарь в памяти с той же семантикой, что у RESOURCE_DELTA_SQL."""
+
+    def __init__(self, inventory):
+        self.inventory = dict(inventory)
+        self.deltas = []
+
+    def get_server_pid(self):
+        return 0
+
+    def is_in_transaction(self):
+        return False
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def fetch(self, sql, *args):
+        if sql == bot.queries.sql['inventory_read']:
+            return [{'resource_id': rid, 'amount': amt} for rid, amt in self.inventory.items()]
+        assert sql == bot.queries.sql['resource_delta']
+        _, rids, amounts, cap = args
+        self.deltas.append(dict(zip(rids, amounts)))
+        new = {rid: min(self.inventory.get(rid, 0) + amt, cap) for rid, amt in zip(rids, amounts)}
+        if any(amt < 0 for amt in new.values()):
+            return []
+        self.inventory.update(new)
+        return [{'resource_id': rid, 'amount': amt} for rid, amt in new.items()]
+
+
+def test_zero_deltas_do_not_touch_the_database(monkeypatch):
+    monkeypatch.setattr(bot, 'db_pool', None)
+    assert asyncio.run(bot.apply_resource_deltas(UID, {'coal': 0})) == {}
+
+
+def test_resource_craft_is_one_delta():
+    conn = LedgerConnection({'gold': 25, 'iron': 10})
+    ok, _ = asyncio.run(bot.craft_item(UID, 'diamond_craft', conn))
+    assert ok
+    assert conn.deltas == [{'gold': -20, 'iron': -10, 'diamond': 1}]
+    assert conn.inventory == {'gold': 5, 'iron': 0, 'diamond': 1}
+
+
+def test_failed_craft_changes_nothing_and_names_the_missing_resource():
+    conn = LedgerConnection({'coal': 5, 'iron': 1, 'magic_essence': 1})
+    ok, message = asyncio.run(bot.craft_item(UID, 'speed_potion', conn))
+    assert not ok
+    assert bot.RESOURCES['iron']['name'] in message
+    assert conn.inventory == {'coal': 5, 'iron': 1, 'magic_essence': 1}
+
+
+def test_deltas_are_atomic_and_saturating(pg):
+    async def scenario():
+        await bot.provision_players([(UID, 'miner')])
+        async with bot.db_pool.acquire() as conn:
+            results = [
+                await bot.apply_resource_deltas(UID, {'coal': 10, 'iron': 3}, conn),
+                # Железа не хватает – уголь тоже не списывается
+                await bot.apply_resource_deltas(UID, {'coal': -5, 'iron': -4}, conn),
+                await bot.apply_resource_deltas(UID, {'coal': -5, 'iron': -3, 'gold': 2}, conn),
+                await bot.apply_resource_deltas(UID, {'diamond': bot.MAX_RESOURCE_AMOUNT}, conn),
+                await bot.apply_resource_deltas(UID, {'diamond': 5}, conn),
+            ]
+            return results, await bot.get_inventory(UID, conn)
+
+    results, inventory = pg(scenario())
+    assert results == [
+        {'coal': 10, 'iron': 3},
+        None,
+        {'coal': 5, 'iron': 0, 'gold': 2},
+        {'diamond': bot.MAX_RESOURCE_AMOUNT},
+        {'diamond': bot.MAX_RESOURCE_AMOUNT},
+    ]
+    assert {rid: amt for rid, amt in inventory.items() if amt} == {
+        'coal': 5, 'gold': 2, 'diamond': bot.MAX_RESOURCE_AMOUNT}
+
+
+def test_craft_against_the_database(pg):
+    async def scenario():
+        await bot.provision_players([(UID, 'miner')])
+        async with bot.db_pool.acquire() as conn:
+            await bot.apply_resource_deltas(UID, {'coal': 12, 'iron': 5}, conn)
+            crafted = await bot.craft_item(UID, 'gold_ore_craft', conn)
+            again = await bot.craft_item(UID, 'gold_ore_craft', conn)
+            return crafted[0], again[0], await bot.get_inventory(UID, conn)
+
+    crafted, again, inventory = pg(scenario())
+    assert crafted and not again
+    assert (inventory.get('coal'), inventory.get('iron'), inventory.get('gold')) == (2, 0, 1)
@@ -0,0 +1,72 @@
+import asyncio
+
+import bot
+
+
+class FakeUser:
+    def __init__(self, uid):
+        self.id = uid
+
+
+class FakeBot:
+    """answerCallbackQuery: журнал ответов на нажатия."""
+
+    def __init__(self):
+        self.answers = []
+
+    async def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        self.answers.append((callback_query_id, text))
+
+
+class FakeCallbackQuery:
+    def __init__(self, query_id, fake_bot):
+        self.id = query_id
+        self.bot = fake_bot
+
+    async def answer(self, text=None, **kwargs):
+        await self.bot.answer_callback_query(self.id, text)
+
+
+def make_update(update_id, uid, fake_bot):
+    try:
+        from telegram import CallbackQuery, User
+    except ImportError:  # заменитель из fake_deps.py
+        return bot.Update(update_id, callback_query=FakeCallbackQuery(str(update_id), fake_bot),
+                          effective_user=FakeUser(uid))
+    query = CallbackQuery(str(update_id), User(uid, 'miner', False), 'test')
+    query.set_bot(fake_bot)
+    return bot.Update(update_id, callback_query=query)
+
+
+def run(processor, updates):
+    fake_bot = FakeBot()
+    handled = []
+
+    async def handle(update_id, uid):
+        await asyncio.sleep(0.01)
+        handled.append((update_id, uid))
+
+    async def scenario():
+        await asyncio.gather(*(processor.process_update(make_update(i, uid, fake_bot), handle(i, uid))
+                               for i, uid in updates))
+
+    asyncio.run(scenario())
+    return handled, fake_bot.answers
+
+
+def test_flooding_user_cannot_take_every_pending_slot():
+    processor = bot.PerUserUpdateProcessor(2, 8, max_per_user=3)
+    updates = [(i, 1) for i in range(20)] + [(20, 2), (21, 3)]
+    handled, _ = run(processor, updates)
+    uids = [uid for _, uid in handled]
+    assert uids.count(1) == 3
+    assert sorted(u for u in uids if u != 1) == [2, 3]
+    assert processor.dropped == 17
+
+
+def test_dropped_callback_is_answered_and_burst_under_cap_is_serialised():
+    processor = bot.PerUserUpdateProcessor(2, 8, max_per_user=2)
+    handled, answers = run(processor, [(0, 1), (1, 1), (2, 1)])
+    # Первые два выполняются по очереди, третий сразу получает «подождите»
+    assert handled == [(0, 1), (1, 1)]
+    assert answers == [('2', bot.UPDATE_DROPPED_TEXT)]
@@ -0,0 +1,133 @@
+import asyncio
+import datetime
+import functools
+
+import pytest
+
+import bot
+
+UID = 2001
+TASK_QUERIES = 2  # check_*_reset и get_*_tasks: задания не кэшируются
+
+
+class CountingConnection:
+    """Считает запросы; отвечает так, будто игрок есть, а задания уже выданы."""
+
+    def __init__(self):
+        self.queries = []
+
+    def get_server_pid(self):
+        return 0
+
+    def is_in_transaction(self):
+        return False
+
+    async def fetchrow(self, sql, *args):
+        self.queries.append(sql)
+        assert sql == bot.queries.sql['player_state']
+        return {
+            'level': 5, 'exp': 0, 'gold': 100, 'total_clicks': 0, 'total_gold_earned': 0,
+            'total_crits': 0, 'current_crit_streak': 0, 'max_crit_streak': 0,
+            'perm_tool_power_bonus': 0, 'perm_crit_bonus': 0,
+            'current_location': 'coal_mine', 'active_tool': 'wooden_pickaxe',
+            'upgrades': [0] * len(bot.UPGRADE_IDS),
+            'inventory': bot.inventory_state({'coal': 10}),
+            'tools': '{"wooden_pickaxe": 1}', 'achievements': [], 'recent_achievements': '[]',
+            'items': '{"energy_potion": 1}', 'effects': '[]', 'bosses': '{}',
+        }
+
+    async def fetchval(self, sql, *args):
+        self.queries.append(sql)
+        if 'last_daily_reset' in sql:
+            return datetime.date.today()
+        assert 'last_weekly_reset' in sql
+        return bot.get_week_number()
+
+    async def fetch(self, sql, *args):
+        self.queries.append(sql)
+        return []
+
+
+class FakePool:
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def acquire(self, timeout=None):
+        return self.conn
+
+    async def release(self, conn):
+        pass
+
+
+class FakeUser:
+    id = UID
+    username = 'miner'
+
+
+class FakeQuery:
+    from_user = FakeUser()
+    message = None
+
+    async def edit_message_text(self, text, reply_markup=None, parse_mode=None):
+        return None
+
+
+VIEWS = {
+    'show_main_menu': (bot.show_main_menu, 1),
+    'show_locations': (bot.show_locations, 1),
+    'show_shop_menu': (bot.show_shop_menu, 0),
+    'show_shop_upgrades': (bot.show_shop_upgrades, 1),
+    'show_shop_tools': (bot.show_shop_tools, 1),
+    'show_profile': (bot.show_profile, 1),
+    'show_inventory': (bot.show_inventory, 1),
+    'show_market': (bot.show_market, 1),
+    'show_craft_menu': (bot.show_craft_menu, 0),
+    'show_craft_category': (functools.partial(bot.show_craft_category, category='potions'), 1),
+    'show_craft_my_items': (bot.show_craft_my_items, 1),
+    'show_leaderboard_menu': (bot.show_leaderboard_menu, 0),
+    'show_leaderboard_gold': (bot.show_leaderboard_gold, 0),
+    'show_daily_tasks': (bot.show_daily_tasks, None),
+    'show_weekly_tasks': (bot.show_weekly_tasks, None),
+}
+
+
+@pytest.fixture
+def conn(monkeypatch):
+    conn = CountingConnection()
+    monkeypatch.setattr(bot, 'db_pool', FakePool(conn))
+    monkeypatch.setattr(bot, 'player_cache', bot.PlayerStateCache(100, 60))
+    return conn
+
+
+@pytest.mark.parametrize('name', VIEWS)
+def test_view_query_count(conn, name):
+    view, miss_queries = VIEWS[name]
+
+    async def queries_for_one_render():
+        before = len(conn.queries)
+        await view(FakeQuery(), None)
+        return len(conn.queries) - before
+
+    miss = asyncio.run(queries_for_one_render())
+    hit = asyncio.run(queries_for_one_render())
+    if miss_queries is None:
+        # Экраны заданий читают свои таблицы при каждом показе
+        assert miss == hit == TASK_QUERIES
+    else:
+        assert miss == miss_queries
+        assert hit == 0
+
+
+@pytest.mark.parametrize('name', ['show_locations', 'show_shop_tools'])
+def test_view_reads_one_snapshot(conn, monkeypatch, name):
+    view, _ = VIEWS[name]
+    calls = []
+    get_player_state = bot.get_player_state
+
+    async def counting_get_player_state(uid):
+        calls.append(uid)
+        return await get_player_state(uid)
+
+    monkeypatch.setattr(bot, 'get_player_state', counting_get_player_state)
+    asyncio.run(view(FakeQuery(), None))
+    assert calls == [UID]
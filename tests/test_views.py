@@ -0,0 +1,152 @@
+import asyncio
+import contextlib
+import datetime
+
+import pytest
+from telegram import Chat
+
+import bot
+
+UID = 1001
+
+
+class FakeConnection:
+    """Одна строка players и её инвентарь в памяти: ровно то, что читают экраны."""
+
+    def __init__(self, inventory):
+        self.inventory = dict(inventory)
+
+    def get_server_pid(self):
+        return 0
+
+    def is_in_transaction(self):
+        return False
+
+    def transaction(self):
+        return contextlib.AsyncExitStack()
+
+    async def fetch(self, sql, *args):
+        if sql == bot.queries.sql['inventory_read']:
+            return [{'resource_id': rid, 'amount': amt} for rid, amt in self.inventory.items()]
+        assert sql == bot.queries.sql['resource_delta']
+        uid, rids, amounts, cap = args
+        new = {rid: self.inventory.get(rid, 0) + amt for rid, amt in zip(rids, amounts)}
+        if any(amt < 0 for amt in new.values()):
+            return []
+        self.inventory.update({rid: min(amt, cap) for rid, amt in new.items()})
+        return [{'resource_id': rid, 'amount': self.inventory[rid]} for rid in rids]
+
+    async def fetchrow(self, sql, *args):
+        assert sql == bot.queries.sql['player_state']
+        return {
+            'level': 1, 'exp': 0, 'gold': 0, 'total_clicks': 0, 'total_gold_earned': 0,
+            'total_crits': 0, 'current_crit_streak': 0, 'max_crit_streak': 0,
+            'perm_tool_power_bonus': 0, 'perm_crit_bonus': 0,
+            'current_location': 'coal_mine', 'active_tool': 'wooden_pickaxe',
+            'upgrades': [0] * len(bot.UPGRADE_IDS),
+            'inventory': bot.inventory_state(self.inventory),
+            'tools': '{"wooden_pickaxe": 1}', 'achievements': [], 'recent_achievements': '[]',
+            'items': '{}', 'effects': '[]', 'bosses': '{}',
+        }
+
+
+class FakePool:
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def acquire(self, timeout=None):
+        return self.conn
+
+    async def release(self, conn):
+        pass
+
+
+@pytest.fixture
+def db(monkeypatch):
+    conn = FakeConnection({'coal': 10, 'iron': 5})
+    monkeypatch.setattr(bot, 'db_pool', FakePool(conn))
+    monkeypatch.setattr(bot, 'player_cache', bot.PlayerStateCache(100, 60))
+    return conn
+
+
+async def render(name):
+    return bot.views.render(name, bot.inventory_state(await bot.get_inventory(UID)))
+
+
+@pytest.mark.parametrize('name', ['inventory', 'market'])
+def test_view_rerendered_after_craft(db, name):
+    async def scenario():
+        before = await render(name)
+        ok, _ = await bot.craft_item(UID, 'gold_ore_craft')
+        assert ok
+        return before, await render(name)
+
+    before, after = asyncio.run(scenario())
+    assert db.inventory == {'coal': 0, 'iron': 0, 'gold': 1}
+    assert after is not before
+    assert after.text != before.text
+
+
+def test_failed_craft_keeps_cached_view(db):
+    async def scenario():
+        await bot.craft_item(UID, 'gold_ore_craft')
+        before = await render('inventory')
+        ok, _ = await bot.craft_item(UID, 'gold_ore_craft')
+        assert not ok
+        return before, await render('inventory')
+
+    before, after = asyncio.run(scenario())
+    assert after is before
+
+
+def message(text, markup):
+    return bot.Message(1, datetime.datetime.now(), Chat(UID, 'private'), text=text, reply_markup=markup)
+
+
+class FakeQuery:
+    """CallbackQuery: сообщение под кнопкой и журнал edit_message_text."""
+
+    def __init__(self, message=None):
+        self.message = message
+        self.edits = []
+
+    async def edit_message_text(self, text, reply_markup=None, parse_mode=None):
+        self.edits.append(text)
+        # Telegram возвращает текст без разметки
+        self.message = message(text.replace('*', ''), reply_markup)
+        return self.message
+
+
+def test_show_skips_edit_of_unchanged_message():
+    bot.views.rendered.clear()
+    query = FakeQuery()
+    state = (7,) + (0,) * (len(bot.RESOURCE_IDS) - 1)
+
+    async def scenario():
+        await bot.views.show(query, 'inventory', state)
+        skipped = bot.views.counters['skipped_edits']
+        await bot.views.show(query, 'inventory', state)
+        assert bot.views.counters['skipped_edits'] == skipped + 1
+        # Другое состояние – другой текст, сообщение редактируется
+        await bot.views.show(query, 'inventory', (8,) + state[1:])
+
+    asyncio.run(scenario())
+    assert len(query.edits) == 2
+    assert '8' in query.edits[1]
+
+
+def test_show_edits_message_showing_another_screen():
+    bot.views.rendered.clear()
+    state = (0,) * len(bot.RESOURCE_IDS)
+    query = FakeQuery()
+
+    async def scenario():
+        await bot.views.show(query, 'market', state)
+        # Пользователь ушёл в инвентарь, а потом нажал старую кнопку рынка
+        query.message = message('🎒 Инвентарь', bot.views.render('inventory', state).markup)
+        await bot.views.show(query, 'market', state)
+        query.message = None
+        await bot.views.show(query, 'market', state)
+
+    asyncio.run(scenario())
+    assert len(query.edits) == 3
@@ -0,0 +1,61 @@
+import asyncio
+import json
+import types
+
+import pytest
+
+import bot
+
+SECRET = 'webhook-secret'
+
+
+class FakeRequest:
+    """То, что читает telegram_webhook: секрет в пути, заголовок и тело."""
+
+    def __init__(self, body: bytes, path_secret=SECRET, header=SECRET):
+        self.path_params = {'secret': path_secret}
+        self.headers = {'x-telegram-bot-api-secret-token': header} if header is not None else {}
+        self._body = body
+
+    async def json(self):
+        return json.loads(self._body)
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    queue = asyncio.Queue()
+    monkeypatch.setattr(bot, 'WEBHOOK_SECRET', SECRET)
+    monkeypatch.setattr(bot, 'bot_app', types.SimpleNamespace(bot=None, update_queue=queue))
+    return queue
+
+
+def post(request):
+    return asyncio.run(bot.telegram_webhook(request)).status_code
+
+
+def test_update_is_queued_and_acknowledged(queue):
+    assert post(FakeRequest(b'{"update_id": 7}')) == 200
+    assert queue.get_nowait().update_id == 7
+    assert queue.empty()
+
+
+@pytest.mark.parametrize('request_kwargs', [
+    {'path_secret': 'guess'},
+    {'header': 'guess'},
+    {'header': None},
+])
+def test_wrong_secret_is_forbidden(queue, request_kwargs):
+    assert post(FakeRequest(b'{"update_id": 7}', **request_kwargs)) == 403
+    assert queue.empty()
+
+
+def test_not_ready_before_the_bot_starts(queue, monkeypatch):
+    monkeypatch.setattr(bot, 'bot_app', None)
+    assert post(FakeRequest(b'{"update_id": 7}')) == 403
+
+
+@pytest.mark.parametrize('body', [b'{', b'[1, 2]', b'{}', b'null'])
+def test_malformed_update_is_acknowledged_and_dropped(queue, body):
+    # 200, иначе Telegram будет слать то же обновление снова
+    assert post(FakeRequest(body)) == 200
+    assert queue.empty()